@@ -5,7 +5,6 @@ from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils import executor
-import sqlite3
 from datetime import datetime, timedelta
 import os
 import sys
@@ -18,7 +17,9 @@ logger = logging.getLogger(__name__)
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from db.init_db import init_db
-from config.config import BOT_TOKEN
+from db.connection import db_manager, db_dispatcher
+from db import queries
+from config.config import BOT_TOKEN, FSM_STORAGE, REDIS_HOST, REDIS_PORT, REDIS_DB, FSM_TTL
 from bot.premium import (
     check_premium_status, get_premium_keyboard,
     get_premium_features_message, check_subscription_limit,
@@ -30,7 +31,12 @@ init_db()
 
 # Инициализация бота и диспетчера
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+if FSM_STORAGE == 'redis':
+    # aioredis нужен только этому режиму
+    from aiogram.contrib.fsm_storage.redis import RedisStorage2
+    storage = RedisStorage2(REDIS_HOST, REDIS_PORT, db=REDIS_DB, state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+else:
+    storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 
 # Состояния для машины состояний
@@ -66,12 +72,8 @@ def get_back_keyboard():
     keyboard.add(KeyboardButton("⬅️ Назад"))
     return keyboard
 
-def get_categories_keyboard():
-    conn = sqlite3.connect('db/subscriptions.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name FROM categories')
-    categories = cursor.fetchall()
-    conn.close()
+async def get_categories_keyboard():
+    categories = await db_dispatcher.run(queries.get_categories)
 
     keyboard = InlineKeyboardMarkup()
     for category in categories:
@@ -86,29 +88,7 @@ async def send_welcome(message: types.Message):
     first_name = message.from_user.first_name
     last_name = message.from_user.last_name
 
-    conn = sqlite3.connect('db/subscriptions.db')
-    cursor = conn.cursor()
-
-    # Проверяем, есть ли пользователь в базе
-    cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (user_id,))
-    user = cursor.fetchone()
-
-    if not user:
-        # Добавляем нового пользователя
-        cursor.execute('''
-        INSERT INTO users (telegram_id, username, first_name, last_name)
-        VALUES (?, ?, ?, ?)
-        ''', (user_id, username, first_name, last_name))
-
-        # Добавляем настройки уведомлений по умолчанию
-        cursor.execute('''
-        INSERT INTO notification_settings (user_id)
-        VALUES (?)
-        ''', (user_id,))
-
-        conn.commit()
-
-    conn.close()
+    await db_dispatcher.run(queries.register_user, user_id, username, first_name, last_name)
 
     await message.reply(
         "🌟 Добро пожаловать в Органайзер Подписок!\n\n"
@@ -127,30 +107,15 @@ async def send_welcome(message: types.Message):
 async def list_subscriptions(message: types.Message):
     user_id = message.from_user.id
 
-    conn = sqlite3.connect('db/subscriptions.db')
-    cursor = conn.cursor()
-
     # Получаем пользователя
-    cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (user_id,))
-    user = cursor.fetchone()
+    user_db_id = await db_dispatcher.run(queries.get_user_db_id, user_id)
 
-    if not user:
+    if not user_db_id:
         await message.reply("Вы не зарегистрированы. Пожалуйста, начните с команды /start")
         return
 
-    user_db_id = user[0]
-
     # Получаем подписки пользователя
-    cursor.execute('''
-    SELECT s.id, s.name, s.amount, s.currency, s.start_date, s.end_date, s.free_trial_end_date, s.is_active, c.name
-    FROM subscriptions s
-    LEFT JOIN categories c ON s.category_id = c.id
-    WHERE s.user_id = ?
-    ORDER BY s.end_date
-    ''', (user_db_id,))
-
-    subscriptions = cursor.fetchall()
-    conn.close()
+    subscriptions = await db_dispatcher.run(queries.get_user_subscriptions, user_db_id)
 
     if not subscriptions:
         await message.reply("У вас пока нет подписок. Добавьте первую подписку!", reply_markup=get_main_keyboard())
@@ -285,7 +250,7 @@ async def process_subscription_free_trial_end_date(message: types.Message, state
         else:
             data['free_trial_end_date'] = None
 
-    await message.reply("Выберите категорию подписки:", reply_markup=get_categories_keyboard())
+    await message.reply("Выберите категорию подписки:", reply_markup=await get_categories_keyboard())
     await SubscriptionStates.next()
 
 @dp.callback_query_handler(lambda c: c.data.startswith('category_'), state=SubscriptionStates.adding_category)
@@ -317,32 +282,7 @@ async def process_subscription_notes(message: types.Message, state: FSMContext):
 
         # Сохраняем подписку в базу данных
         user_id = message.from_user.id
-        conn = sqlite3.connect('db/subscriptions.db')
-        cursor = conn.cursor()
-
-        # Получаем пользователя
-        cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (user_id,))
-        user = cursor.fetchone()
-        user_db_id = user[0]
-
-        # Вставляем подписку
-        cursor.execute('''
-        INSERT INTO subscriptions (
-            user_id, name, amount, start_date, end_date, free_trial_end_date, category_id, notes
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            user_db_id,
-            data['name'],
-            data['amount'],
-            data['start_date'],
-            data['end_date'],
-            data['free_trial_end_date'],
-            data['category_id'],
-            data['notes']
-        ))
-
-        conn.commit()
-        conn.close()
+        await db_dispatcher.run(queries.add_subscription, user_id, data.as_dict())
 
         await state.finish()
         await message.reply(
@@ -390,22 +330,9 @@ async def process_edit_subscription_id(message: types.Message, state: FSMContext
             data['subscription_id'] = subscription_id
 
         # Получаем информацию о подписке
-        conn = sqlite3.connect('db/subscriptions.db')
-        cursor = conn.cursor()
-
         user_id = message.from_user.id
-        cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (user_id,))
-        user = cursor.fetchone()
-        user_db_id = user[0]
-
-        cursor.execute('''
-        SELECT id, name, amount, start_date, end_date, free_trial_end_date, category_id, notes, is_active
-        FROM subscriptions
-        WHERE id = ? AND user_id = ?
-        ''', (subscription_id, user_db_id))
-
-        subscription = cursor.fetchone()
-        conn.close()
+        user_db_id = await db_dispatcher.run(queries.get_user_db_id, user_id)
+        subscription = await db_dispatcher.run(queries.get_subscription, subscription_id, user_db_id)
 
         if not subscription:
             await message.reply("Подписка с таким ID не найдена. Пожалуйста, введите корректный ID:")
@@ -479,7 +406,7 @@ async def process_edit_field(message: types.Message, state: FSMContext):
                                   f"Введите новое значение (1 для активна, 0 для неактивна):")
             elif field_name == 'category_id':
                 await message.reply(f"Текущая категория: {current_value}\n"
-                                  f"Выберите новую категорию:", reply_markup=get_categories_keyboard())
+                                  f"Выберите новую категорию:", reply_markup=await get_categories_keyboard())
             else:
                 await message.reply(f"Текущее значение: {current_value}\n"
                                   f"Введите новое значение:")
@@ -528,17 +455,7 @@ async def process_edit_value(message: types.Message, state: FSMContext):
             new_value = message.text
 
         # Обновляем подписку в базе данных
-        conn = sqlite3.connect('db/subscriptions.db')
-        cursor = conn.cursor()
-
-        cursor.execute(f'''
-        UPDATE subscriptions
-        SET {field_name} = ?, updated_at = CURRENT_TIMESTAMP
-        WHERE id = ?
-        ''', (new_value, subscription_id))
-
-        conn.commit()
-        conn.close()
+        await db_dispatcher.run(queries.update_subscription_field, subscription_id, field_name, new_value)
 
         await state.finish()
         await message.reply(
@@ -551,7 +468,7 @@ async def process_edit_value(message: types.Message, state: FSMContext):
 @dp.message_handler(lambda message: message.text == "💎 Premium")
 async def show_premium_menu(message: types.Message):
     user_id = message.from_user.id
-    is_premium, expiry_date = check_premium_status(user_id)
+    is_premium, expiry_date = await db_dispatcher.run(check_premium_status, user_id)
 
     if is_premium:
         premium_info = f"💎 Ваш Premium статус активен до: {expiry_date}\n\n"
@@ -569,50 +486,18 @@ async def show_premium_menu(message: types.Message):
 @dp.message_handler(lambda message: message.text == "📊 Статистика")
 async def show_statistics(message: types.Message):
     user_id = message.from_user.id
-    is_premium, _ = check_premium_status(user_id)
-
-    conn = sqlite3.connect('db/subscriptions.db')
-    cursor = conn.cursor()
+    is_premium, _ = await db_dispatcher.run(check_premium_status, user_id)
 
-    cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (user_id,))
-    user = cursor.fetchone()
+    user_db_id = await db_dispatcher.run(queries.get_user_db_id, user_id)
 
-    if not user:
+    if not user_db_id:
         await message.reply("Вы не зарегистрированы. Пожалуйста, начните с команды /start")
         return
 
-    user_db_id = user[0]
-
-    # Получаем общую сумму расходов
-    cursor.execute('''
-    SELECT SUM(amount)
-    FROM subscriptions
-    WHERE user_id = ? AND is_active = TRUE
-    ''', (user_db_id,))
-
-    total_expenses = cursor.fetchone()[0] or 0
-
-    # Получаем количество активных подписок
-    cursor.execute('''
-    SELECT COUNT(*)
-    FROM subscriptions
-    WHERE user_id = ? AND is_active = TRUE
-    ''', (user_db_id,))
-
-    active_subscriptions = cursor.fetchone()[0]
-
-    # Получаем ближайшие продления
-    cursor.execute('''
-    SELECT name, end_date
-    FROM subscriptions
-    WHERE user_id = ? AND is_active = TRUE AND end_date IS NOT NULL
-    ORDER BY end_date
-    LIMIT 3
-    ''', (user_db_id,))
-
-    upcoming_renewals = cursor.fetchall()
+    total_expenses, active_subscriptions, upcoming_renewals = await db_dispatcher.run(
+        queries.get_statistics, user_db_id
+    )
 
-    conn.close()
 
     response = "📊 Ваша статистика\n\n"
     response += f"💰 Общие расходы: {total_expenses:.2f} RUB/мес\n"
@@ -631,7 +516,7 @@ async def show_statistics(message: types.Message):
 
     if is_premium:
         # Для Premium пользователей показываем расширенную статистику
-        analytics = get_premium_analytics(user_id)
+        analytics = await db_dispatcher.run(get_premium_analytics, user_id)
         response += "\n💎 Premium Аналитика:\n" + analytics
     else:
         response += "💎 Оформите Premium, чтобы получить расширенную аналитику и дополнительные функции!"
@@ -653,7 +538,7 @@ async def buy_premium(callback_query: types.CallbackQuery):
 
     # В реальном приложении здесь будет интеграция с платежной системой
     # Для демонстрации просто активируем Premium на 1 месяц
-    expiry_date = activate_premium(user_id, months=1)
+    expiry_date = await db_dispatcher.run(activate_premium, user_id, months=1)
 
     await bot.answer_callback_query(callback_query.id)
     await bot.send_message(
@@ -687,5 +572,9 @@ async def show_settings(message: types.Message):
 async def handle_unknown_message(message: types.Message):
     await message.reply("Извините, я не понял ваше сообщение. Пожалуйста, используйте меню.")
 
+async def on_shutdown(dp):
+    db_dispatcher.shutdown()
+    db_manager.close_all()
+
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
+    executor.start_polling(dp, skip_updates=True, on_shutdown=on_shutdown)
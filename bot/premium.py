@@ -1,21 +1,45 @@
-import sqlite3
 from datetime import datetime, timedelta
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from config.config import PREMIUM_PRICE_MONTHLY, MAX_FREE_SUBSCRIPTIONS
+from config.config import (
+    PREMIUM_PRICE_MONTHLY, MAX_FREE_SUBSCRIPTIONS,
+    PREMIUM_CACHE_SIZE, PREMIUM_CACHE_TTL,
+    FX_BASE_CURRENCY, DISPLAY_CURRENCY
+)
+from db.connection import db_manager, get_connection
+from db.queries import get_fx_rates
+from subscription_bot.cache import TTLCache
+from subscription_bot.cost_engine import CostColumns, summarize
+from subscription_bot.currency import FXRates
+
+# Кэш (is_premium, premium_expiry_date) по telegram_id; срок действия
+# проверяется при каждом обращении, activate_premium сбрасывает запись
+premium_cache = TTLCache(PREMIUM_CACHE_SIZE, PREMIUM_CACHE_TTL)
+
+# Курсы валют загружаются из fx_rates при первом обращении;
+# refresh_fx_rates перечитывает таблицу после обновления курсов
+fx_rates = FXRates(FX_BASE_CURRENCY, loader=get_fx_rates)
+
+def refresh_fx_rates():
+    """Перечитать курсы валют"""
+    fx_rates.refresh()
 
 def check_premium_status(user_id):
     """Проверка Premium статуса пользователя"""
-    conn = sqlite3.connect('db/subscriptions.db')
-    cursor = conn.cursor()
+    result = premium_cache.get(user_id)
 
-    cursor.execute('''
-    SELECT is_premium, premium_expiry_date
-    FROM users
-    WHERE telegram_id = ?
-    ''', (user_id,))
+    if result is None:
+        conn = get_connection()
+        cursor = conn.cursor()
 
-    result = cursor.fetchone()
-    conn.close()
+        cursor.execute('''
+        SELECT is_premium, premium_expiry_date
+        FROM users
+        WHERE telegram_id = ?
+        ''', (user_id,))
+
+        result = cursor.fetchone()
+        if result:
+            premium_cache.set(user_id, result)
 
     if not result:
         return False, None
@@ -77,14 +101,13 @@ def check_subscription_limit(user_id):
     if is_premium:
         return True, None  # Нет ограничений для Premium
 
-    conn = sqlite3.connect('db/subscriptions.db')
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (user_id,))
     user = cursor.fetchone()
 
     if not user:
-        conn.close()
         return False, "Пользователь не найден"
 
     user_db_id = user[0]
@@ -96,7 +119,6 @@ def check_subscription_limit(user_id):
     ''', (user_db_id,))
 
     count = cursor.fetchone()[0]
-    conn.close()
 
     if count >= MAX_FREE_SUBSCRIPTIONS:
         return False, f"Вы достигли лимита в {MAX_FREE_SUBSCRIPTIONS} подписок. Оформите Premium для неограниченного количества."
@@ -105,19 +127,16 @@ def check_subscription_limit(user_id):
 
 def activate_premium(user_id, months=1):
     """Активация Premium статуса для пользователя"""
-    conn = sqlite3.connect('db/subscriptions.db')
-    cursor = conn.cursor()
-
     expiry_date = (datetime.now() + timedelta(days=30*months)).strftime('%Y-%m-%d')
 
-    cursor.execute('''
-    UPDATE users
-    SET is_premium = TRUE, premium_expiry_date = ?
-    WHERE telegram_id = ?
-    ''', (expiry_date, user_id))
+    with db_manager.transaction() as cursor:
+        cursor.execute('''
+        UPDATE users
+        SET is_premium = TRUE, premium_expiry_date = ?
+        WHERE telegram_id = ?
+        ''', (expiry_date, user_id))
 
-    conn.commit()
-    conn.close()
+    premium_cache.invalidate(user_id)
 
     return expiry_date
 
@@ -128,37 +147,37 @@ def get_premium_stats(user_id):
     if not is_premium:
         return None
 
-    conn = sqlite3.connect('db/subscriptions.db')
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (user_id,))
     user = cursor.fetchone()
 
     if not user:
-        conn.close()
         return None
 
     user_db_id = user[0]
 
-    # Получаем общую сумму расходов
-    cursor.execute('''
-    SELECT SUM(amount)
-    FROM subscriptions
-    WHERE user_id = ? AND is_active = TRUE
-    ''', (user_db_id,))
-
-    total_expenses = cursor.fetchone()[0] or 0
-
-    # Получаем расходы по категориям
+    # Расходы считаются общим cost_engine; amount в этой базе уже указан за месяц
     cursor.execute('''
-    SELECT c.name, SUM(s.amount)
+    SELECT s.amount, s.currency, c.name
     FROM subscriptions s
-    JOIN categories c ON s.category_id = c.id
+    LEFT JOIN categories c ON s.category_id = c.id
     WHERE s.user_id = ? AND s.is_active = TRUE
-    GROUP BY c.name
     ''', (user_db_id,))
 
-    category_expenses = cursor.fetchall()
+    columns = CostColumns.from_rows(
+        cursor.fetchall(), price=0, cycle=None, currency=1, category=2
+    )
+    if fx_rates.loaded_at is None:
+        refresh_fx_rates()
+    summary = summarize(columns, rates=fx_rates.factors(columns.currencies, DISPLAY_CURRENCY))
+
+    total_expenses = summary['monthly_cost']
+    category_expenses = [
+        (category, amount) for category, amount in summary['by_category'].items()
+        if category is not None
+    ]
 
     # Получаем ближайшие продления
     cursor.execute('''
@@ -171,11 +190,12 @@ def get_premium_stats(user_id):
 
     upcoming_renewals = cursor.fetchall()
 
-    conn.close()
 
     return {
         'is_premium': True,
         'expiry_date': expiry_date,
+        'currency': DISPLAY_CURRENCY,
+        'unconverted': summary['unconverted'],
         'total_expenses': total_expenses,
         'category_expenses': category_expenses,
         'upcoming_renewals': upcoming_renewals
@@ -191,13 +211,16 @@ def get_premium_analytics(user_id):
     response = "📊 Premium Аналитика\n\n"
 
     # Общая сумма расходов
-    response += f"💰 Общие расходы: {stats['total_expenses']:.2f} RUB/мес\n\n"
+    response += f"💰 Общие расходы: {stats['total_expenses']:.2f} {stats['currency']}/мес\n"
+    for currency, amount in stats['unconverted'].items():
+        response += f"   + {amount:.2f} {currency}/мес (нет курса)\n"
+    response += "\n"
 
     # Расходы по категориям
     response += "📋 Расходы по категориям:\n"
     for category, amount in stats['category_expenses']:
         percentage = (amount / stats['total_expenses']) * 100 if stats['total_expenses'] > 0 else 0
-        response += f"   • {category}: {amount:.2f} RUB ({percentage:.1f}%)\n"
+        response += f"   • {category}: {amount:.2f} {stats['currency']} ({percentage:.1f}%)\n"
     response += "\n"
 
     # Ближайшие продления
@@ -7,9 +7,37 @@ BOT_TOKEN = 'YOUR_TELEGRAM_BOT_TOKEN'
 DATABASE_NAME = 'subscriptions.db'
 DATABASE_PATH = 'db/subscriptions.db'
 
+# Настройки SQLite (применяются к каждому подключению)
+SQLITE_SYNCHRONOUS = 'NORMAL'  # в режиме WAL NORMAL безопасен и быстрее FULL
+SQLITE_CACHE_SIZE_KB = 16384  # кэш страниц на подключение
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024  # отображение файла БД в память, байт
+SQLITE_BUSY_TIMEOUT_MS = 5000  # ожидание блокировки писателем
+
+# Пул потоков для запросов к БД (обработчики не блокируют event loop)
+DB_WORKERS = 4
+DB_MAX_QUEUE = 100  # сверх этого вызовы ждут или отклоняются
+DB_QUEUE_TIMEOUT = 2.0  # секунды ожидания места в очереди
+DB_SLOW_CALL_MS = 500  # порог для логирования медленных запросов
+
+# Хранилище состояний FSM: 'memory' или 'redis' (любой сервер с протоколом Redis).
+# С Redis недописанные диалоги переживают перезапуск и общие для всех процессов
+FSM_STORAGE = 'memory'
+REDIS_HOST = 'localhost'
+REDIS_PORT = 6379
+REDIS_DB = 0
+FSM_TTL = 86400  # секунды хранения состояния и данных
+
 # Настройки Premium
 PREMIUM_PRICE_MONTHLY = 2.99  # в долларах
 MAX_FREE_SUBSCRIPTIONS = 5
+PREMIUM_CACHE_SIZE = 10000  # записей в кэше Premium статуса
+PREMIUM_CACHE_TTL = 300  # секунды
+
+# Курсы валют: базовая валюта таблицы fx_rates, курсы по умолчанию
+# (единиц валюты за единицу базовой) и валюта итогов Premium аналитики
+FX_BASE_CURRENCY = 'USD'
+FX_DEFAULT_RATES = {'EUR': 0.92, 'RUB': 92.0}
+DISPLAY_CURRENCY = 'RUB'
 
 # Настройки уведомлений
 DEFAULT_REMINDER_DAYS = 3
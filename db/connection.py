@@ -0,0 +1,95 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from config.config import (
+    DATABASE_PATH, SQLITE_SYNCHRONOUS, SQLITE_CACHE_SIZE_KB,
+    SQLITE_MMAP_SIZE, SQLITE_BUSY_TIMEOUT_MS,
+    DB_WORKERS, DB_MAX_QUEUE, DB_QUEUE_TIMEOUT, DB_SLOW_CALL_MS
+)
+from subscription_bot.db_dispatcher import DBDispatcher
+
+
+class SQLiteConnectionManager:
+    """Менеджер подключений к SQLite: одно настроенное подключение на поток"""
+
+    def __init__(self, path, synchronous='NORMAL', cache_size_kb=16384,
+                 mmap_size=0, busy_timeout_ms=5000):
+        self.path = path
+        self.synchronous = synchronous
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000)
+        cursor = conn.cursor()
+        # WAL: читатели не блокируются писателем, режим сохраняется в файле БД
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA synchronous={self.synchronous}')
+        # Отрицательное значение cache_size задается в KiB, а не в страницах
+        cursor.execute(f'PRAGMA cache_size=-{int(self.cache_size_kb)}')
+        cursor.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        cursor.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
+        return conn
+
+    def get_connection(self):
+        """Получение подключения текущего потока (создается при первом обращении)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Курсор в транзакции: commit при успехе, rollback при ошибке"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            yield cursor
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def close_all(self):
+        """Закрытие всех открытых подключений (при остановке бота)"""
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+db_manager = SQLiteConnectionManager(
+    DATABASE_PATH,
+    synchronous=SQLITE_SYNCHRONOUS,
+    cache_size_kb=SQLITE_CACHE_SIZE_KB,
+    mmap_size=SQLITE_MMAP_SIZE,
+    busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS
+)
+
+
+def get_connection():
+    """Подключение к БД бота для текущего потока"""
+    return db_manager.get_connection()
+
+
+# Все запросы обработчиков выполняются в этом пуле потоков,
+# у каждого потока свое подключение из db_manager
+db_dispatcher = DBDispatcher(
+    max_workers=DB_WORKERS,
+    max_queue=DB_MAX_QUEUE,
+    queue_timeout=DB_QUEUE_TIMEOUT,
+    slow_call_ms=DB_SLOW_CALL_MS
+)
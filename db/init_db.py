@@ -1,98 +1,119 @@
-import sqlite3
+import os
+import sys
 from datetime import datetime
 
+# Добавляем путь к модулям в sys.path (для запуска как скрипта)
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from config.config import FX_DEFAULT_RATES
+from db.connection import db_manager
+
 def init_db():
-    conn = sqlite3.connect('subscriptions.db')
-    cursor = conn.cursor()
+    with db_manager.transaction() as cursor:
+        # Создание таблицы пользователей
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            language TEXT DEFAULT 'ru',
+            is_premium BOOLEAN DEFAULT FALSE,
+            premium_expiry_date TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+
+        # Создание таблицы категорий подписок
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            description TEXT
+        )
+        ''')
 
-    # Создание таблицы пользователей
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER UNIQUE NOT NULL,
-        username TEXT,
-        first_name TEXT,
-        last_name TEXT,
-        language TEXT DEFAULT 'ru',
-        is_premium BOOLEAN DEFAULT FALSE,
-        premium_expiry_date TEXT,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
+        # Добавим стандартные категории
+        categories = [
+            ('Развлечения', 'Фильмы, музыка, игры'),
+            ('Работа', 'Инструменты для работы'),
+            ('Обучение', 'Образовательные сервисы'),
+            ('VPN', 'Сервисы VPN'),
+            ('Другое', 'Прочие подписки')
+        ]
 
-    # Создание таблицы категорий подписок
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS categories (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT UNIQUE NOT NULL,
-        description TEXT
-    )
-    ''')
+        for category in categories:
+            cursor.execute('''
+            INSERT OR IGNORE INTO categories (name, description)
+            VALUES (?, ?)
+            ''', category)
 
-    # Добавим стандартные категории
-    categories = [
-        ('Развлечения', 'Фильмы, музыка, игры'),
-        ('Работа', 'Инструменты для работы'),
-        ('Обучение', 'Образовательные сервисы'),
-        ('VPN', 'Сервисы VPN'),
-        ('Другое', 'Прочие подписки')
-    ]
+        # Создание таблицы подписок
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            amount REAL NOT NULL,
+            currency TEXT DEFAULT 'RUB',
+            start_date TEXT NOT NULL,
+            end_date TEXT,
+            free_trial_end_date TEXT,
+            category_id INTEGER,
+            is_active BOOLEAN DEFAULT TRUE,
+            notes TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (category_id) REFERENCES categories (id)
+        )
+        ''')
 
-    for category in categories:
+        # Создание таблицы уведомлений
         cursor.execute('''
-        INSERT OR IGNORE INTO categories (name, description)
-        VALUES (?, ?)
-        ''', category)
+        CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            subscription_id INTEGER,
+            message TEXT NOT NULL,
+            is_sent BOOLEAN DEFAULT FALSE,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (subscription_id) REFERENCES subscriptions (id)
+        )
+        ''')
 
-    # Создание таблицы подписок
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS subscriptions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        name TEXT NOT NULL,
-        amount REAL NOT NULL,
-        currency TEXT DEFAULT 'RUB',
-        start_date TEXT NOT NULL,
-        end_date TEXT,
-        free_trial_end_date TEXT,
-        category_id INTEGER,
-        is_active BOOLEAN DEFAULT TRUE,
-        notes TEXT,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id),
-        FOREIGN KEY (category_id) REFERENCES categories (id)
-    )
-    ''')
+        # Создание таблицы настроек уведомлений
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS notification_settings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE NOT NULL,
+            subscription_reminder_days INTEGER DEFAULT 3,
+            free_trial_reminder_days INTEGER DEFAULT 1,
+            daily_summary BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''')
 
-    # Создание таблицы уведомлений
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS notifications (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        subscription_id INTEGER,
-        message TEXT NOT NULL,
-        is_sent BOOLEAN DEFAULT FALSE,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id),
-        FOREIGN KEY (subscription_id) REFERENCES subscriptions (id)
-    )
-    ''')
+        # Создание таблицы курсов валют (rate единиц currency за единицу базовой валюты)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fx_rates (
+            currency TEXT NOT NULL,
+            day TEXT NOT NULL,
+            rate REAL NOT NULL,
+            PRIMARY KEY (currency, day)
+        )
+        ''')
 
-    # Создание таблицы настроек уведомлений
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS notification_settings (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER UNIQUE NOT NULL,
-        subscription_reminder_days INTEGER DEFAULT 3,
-        free_trial_reminder_days INTEGER DEFAULT 1,
-        daily_summary BOOLEAN DEFAULT FALSE,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )
-    ''')
+        # Курсы по умолчанию для валют, по которым еще нет данных
+        for currency, rate in FX_DEFAULT_RATES.items():
+            cursor.execute('''
+            INSERT INTO fx_rates (currency, day, rate)
+            SELECT ?, DATE('now'), ?
+            WHERE NOT EXISTS (SELECT 1 FROM fx_rates WHERE currency = ?)
+            ''', (currency, rate, currency))
 
-    conn.commit()
-    conn.close()
     print("База данных успешно инициализирована.")
 
 if __name__ == '__main__':
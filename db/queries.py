@@ -0,0 +1,139 @@
+from db.connection import db_manager, get_connection
+
+
+def get_categories():
+    """Список категорий (id, name)"""
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT id, name FROM categories')
+    return cursor.fetchall()
+
+
+def register_user(telegram_id, username, first_name, last_name):
+    """Регистрация пользователя и его настроек уведомлений, если его еще нет"""
+    with db_manager.transaction() as cursor:
+        # Проверяем, есть ли пользователь в базе
+        cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (telegram_id,))
+        user = cursor.fetchone()
+
+        if not user:
+            # Добавляем нового пользователя
+            cursor.execute('''
+            INSERT INTO users (telegram_id, username, first_name, last_name)
+            VALUES (?, ?, ?, ?)
+            ''', (telegram_id, username, first_name, last_name))
+
+            # Добавляем настройки уведомлений по умолчанию
+            cursor.execute('''
+            INSERT INTO notification_settings (user_id)
+            VALUES (?)
+            ''', (telegram_id,))
+
+
+def get_user_db_id(telegram_id):
+    """Внутренний id пользователя по Telegram ID (None, если не зарегистрирован)"""
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (telegram_id,))
+    user = cursor.fetchone()
+    return user[0] if user else None
+
+
+def get_user_subscriptions(user_db_id):
+    """Все подписки пользователя с названием категории"""
+    cursor = get_connection().cursor()
+    cursor.execute('''
+    SELECT s.id, s.name, s.amount, s.currency, s.start_date, s.end_date, s.free_trial_end_date, s.is_active, c.name
+    FROM subscriptions s
+    LEFT JOIN categories c ON s.category_id = c.id
+    WHERE s.user_id = ?
+    ORDER BY s.end_date
+    ''', (user_db_id,))
+    return cursor.fetchall()
+
+
+def add_subscription(telegram_id, data):
+    """Сохранение новой подписки из данных FSM"""
+    with db_manager.transaction() as cursor:
+        # Получаем пользователя
+        cursor.execute('SELECT id FROM users WHERE telegram_id = ?', (telegram_id,))
+        user = cursor.fetchone()
+        user_db_id = user[0]
+
+        # Вставляем подписку
+        cursor.execute('''
+        INSERT INTO subscriptions (
+            user_id, name, amount, start_date, end_date, free_trial_end_date, category_id, notes
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            user_db_id,
+            data['name'],
+            data['amount'],
+            data['start_date'],
+            data['end_date'],
+            data['free_trial_end_date'],
+            data['category_id'],
+            data['notes']
+        ))
+
+
+def get_subscription(subscription_id, user_db_id):
+    """Подписка пользователя по id для редактирования"""
+    cursor = get_connection().cursor()
+    cursor.execute('''
+    SELECT id, name, amount, start_date, end_date, free_trial_end_date, category_id, notes, is_active
+    FROM subscriptions
+    WHERE id = ? AND user_id = ?
+    ''', (subscription_id, user_db_id))
+    return cursor.fetchone()
+
+
+def update_subscription_field(subscription_id, field_name, value):
+    """Обновление одного поля подписки"""
+    with db_manager.transaction() as cursor:
+        cursor.execute(f'''
+        UPDATE subscriptions
+        SET {field_name} = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+        ''', (value, subscription_id))
+
+
+def get_fx_rates():
+    """Все курсы валют (currency, day, rate)"""
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT currency, day, rate FROM fx_rates')
+    return cursor.fetchall()
+
+
+def get_statistics(user_db_id):
+    """Базовая статистика: сумма расходов, число активных подписок, ближайшие продления"""
+    cursor = get_connection().cursor()
+
+    # Получаем общую сумму расходов
+    cursor.execute('''
+    SELECT SUM(amount)
+    FROM subscriptions
+    WHERE user_id = ? AND is_active = TRUE
+    ''', (user_db_id,))
+
+    total_expenses = cursor.fetchone()[0] or 0
+
+    # Получаем количество активных подписок
+    cursor.execute('''
+    SELECT COUNT(*)
+    FROM subscriptions
+    WHERE user_id = ? AND is_active = TRUE
+    ''', (user_db_id,))
+
+    active_subscriptions = cursor.fetchone()[0]
+
+    # Получаем ближайшие продления
+    cursor.execute('''
+    SELECT name, end_date
+    FROM subscriptions
+    WHERE user_id = ? AND is_active = TRUE AND end_date IS NOT NULL
+    ORDER BY end_date
+    LIMIT 3
+    ''', (user_db_id,))
+
+    upcoming_renewals = cursor.fetchall()
+
+    return total_expenses, active_subscriptions, upcoming_renewals
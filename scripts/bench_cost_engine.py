@@ -0,0 +1,77 @@
+"""
+Бенчмарк cost_engine на пользователях с большим числом подписок
+
+Сравнивает колоночный расчет (summarize) с построчным
+подсчетом по словарям, как это делалось раньше, и проверяет, что итоги совпадают.
+
+Использование:
+    python scripts/bench_cost_engine.py [--subs 1000 5000 20000] [--repeat 20]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'subscription_bot'))
+
+from cost_engine import CYCLE_MONTHLY_FACTORS, CostColumns, summarize  # noqa: E402
+
+CYCLES = list(CYCLE_MONTHLY_FACTORS)
+CURRENCIES = ['USD', 'EUR', 'RUB']
+CATEGORIES = ['Streaming', 'Music', 'Work', 'VPN', 'Cloud Storage', None]
+
+
+def make_rows(count, seed=42):
+    rng = random.Random(seed)
+    return [
+        {
+            'price': round(rng.uniform(1, 50), 2),
+            'billing_cycle': rng.choice(CYCLES),
+            'currency': rng.choice(CURRENCIES),
+            'category': rng.choice(CATEGORIES),
+        }
+        for _ in range(count)
+    ]
+
+
+def naive_summary(rows):
+    """Построчный расчет: поиск множителя и словари на каждую подписку"""
+    monthly = 0.0
+    by_category = defaultdict(float)
+    for row in rows:
+        cost = row['price'] * float(CYCLE_MONTHLY_FACTORS.get(row['billing_cycle'], 1))
+        monthly += cost
+        by_category[row['category']] += cost
+    return monthly, by_category
+
+
+def timed(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subs', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'subs':>8} {'naive ms':>10} {'columns ms':>11} {'summarize ms':>13}")
+    for count in args.subs:
+        rows = make_rows(count)
+        naive_ms, (naive_monthly, _) = timed(lambda: naive_summary(rows), args.repeat)
+        columns_ms, columns = timed(lambda: CostColumns.from_rows(rows), args.repeat)
+        summary_ms, summary = timed(lambda: summarize(columns), args.repeat)
+
+        assert abs(summary['monthly_cost'] - naive_monthly) < 1e-6 * max(1.0, naive_monthly)
+        print(f"{count:>8} {naive_ms:>10.2f} {columns_ms:>11.2f} {summary_ms:>13.2f}")
+
+
+if __name__ == '__main__':
+    main()
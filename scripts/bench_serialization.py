@@ -0,0 +1,110 @@
+"""
+Бенчмарк сериализации ответов API (serialization.py)
+
+Строит ответ /api/subscriptions из строк как у RealDictCursor (Decimal, date,
+datetime) и сравнивает прежний путь — копия каждой строки в dict с ручным
+преобразованием полей и json.dumps — с serialization.dumps на стандартном json
+и на orjson (если установлен). Проверяет, что все варианты дают одинаковый JSON.
+
+Использование:
+    python scripts/bench_serialization.py [--subs 100 1000 5000] [--repeat 50]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'subscription_bot'))
+
+import serialization  # noqa: E402
+
+CYCLES = ['weekly', 'monthly', 'quarterly', 'yearly']
+CURRENCIES = ['USD', 'EUR', 'RUB']
+CATEGORIES = ['Streaming', 'Music', 'Work', 'VPN', 'Cloud Storage', None]
+
+
+def make_rows(count, seed=42):
+    """Строки subscriptions в том виде, в каком их возвращает psycopg2"""
+    rng = random.Random(seed)
+    today = date.today()
+    now = datetime.now()
+    return [
+        {
+            'id': i,
+            'user_id': 42,
+            'name': f'Подписка {i}',
+            'description': '',
+            'price': Decimal(f'{rng.uniform(1, 50):.2f}'),
+            'currency': rng.choice(CURRENCIES),
+            'category': rng.choice(CATEGORIES),
+            'billing_cycle': rng.choice(CYCLES),
+            'start_date': today - timedelta(days=rng.randint(0, 700)),
+            'next_payment': today + timedelta(days=rng.randint(0, 365)),
+            'trial_end_date': None,
+            'is_active': rng.random() > 0.2,
+            'icon': None,
+            'color': None,
+            'website_url': None,
+            'notes': None,
+            'created_at': now - timedelta(seconds=rng.randint(0, 10 ** 7)),
+            'updated_at': now,
+        }
+        for i in range(count)
+    ]
+
+
+def manual_dumps(rows):
+    """Прежний путь: копия строки и преобразование Decimal/дат по полям"""
+    subscriptions = []
+    for row in rows:
+        item = dict(row)
+        for key, value in item.items():
+            if isinstance(value, Decimal):
+                item[key] = float(value)
+            elif isinstance(value, (date, datetime)):
+                item[key] = value.isoformat()
+        subscriptions.append(item)
+    return json.dumps({'subscriptions': subscriptions}, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def timed(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subs', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    variants = [('manual', manual_dumps), ('json', lambda rows: serialization.dumps_stdlib({'subscriptions': rows}))]
+    if serialization.orjson is not None:
+        variants.append(('orjson', lambda rows: serialization.dumps_orjson({'subscriptions': rows})))
+    else:
+        print('orjson не установлен, сравниваются только стандартные варианты')
+
+    print(f"{'subs':>8} " + ' '.join(f"{name + ' ms':>11}" for name, _ in variants) + f" {'KB':>8}")
+    for count in args.subs:
+        rows = make_rows(count)
+        timings, payloads = [], []
+        for _, func in variants:
+            ms, payload = timed(lambda: func(rows), args.repeat)
+            timings.append(ms)
+            payloads.append(payload)
+
+        parsed = json.loads(payloads[0])
+        assert all(json.loads(payload) == parsed for payload in payloads)
+        print(f"{count:>8} " + ' '.join(f"{ms:>11.2f}" for ms in timings) + f" {len(payloads[0]) / 1024:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Проверка планов горячих запросов subscription_bot на локальном PostgreSQL
+
+Создает отдельную схему, инициализирует ее через Database.init_db,
+заполняет тестовыми данными и через EXPLAIN проверяет, что запросы
+уведомлений и статистики используют индексы, а не Seq Scan.
+Запросы повторяют WHERE/ORDER BY соответствующих методов Database.
+
+Использование (настройки подключения берутся из subscription_bot/config.py):
+    python scripts/check_query_plans.py [--users 20000] [--subs-per-user 5] [--keep]
+"""
+import argparse
+import json
+import os
+import sys
+
+SCHEMA = 'query_plan_check'
+
+# Database читает search_path из PGOPTIONS, поэтому все таблицы создаются в SCHEMA
+os.environ['PGOPTIONS'] = f'-c search_path={SCHEMA}'
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'subscription_bot'))
+
+import psycopg2  # noqa: E402
+from database import Database  # noqa: E402
+
+# (название, запрос, параметры, индекс, требуется ли index-only scan)
+CHECKS = [
+    ('get_user_stats: by category', """
+        SELECT category, currency, monthly_cost
+        FROM user_category_spending
+        WHERE user_id = %s AND active_subscriptions > 0
+    """, (42,), 'user_category_spending_pkey', False),
+    ('get_upcoming_renewals', """
+        SELECT s.*, c.charge_date, c.amount
+        FROM upcoming_charges c
+        JOIN subscriptions s ON s.id = c.subscription_id
+        WHERE c.user_id = %s
+        AND c.charge_date BETWEEN CURRENT_DATE AND CURRENT_DATE + 30
+        ORDER BY c.charge_date ASC, s.id
+    """, (42,), 'idx_upcoming_charges_user_date', False),
+    ('get_cash_flow', """
+        SELECT to_char(charge_date, 'YYYY-MM'), currency, SUM(amount)
+        FROM upcoming_charges
+        WHERE user_id = %s
+        AND charge_date >= CURRENT_DATE
+        AND charge_date < date_trunc('month', CURRENT_DATE) + make_interval(months => 12)
+        GROUP BY 1, 2
+    """, (42,), 'idx_upcoming_charges_user_date', True),
+    ('get_user_payload: subscriptions', """
+        SELECT json_agg(s ORDER BY s.next_payment)
+        FROM subscriptions s
+        WHERE s.user_id = %s
+    """, (42,), 'idx_subscriptions_user_active_next', False),
+    ('claim_notifications', """
+        SELECT n.id
+        FROM notifications n
+        JOIN users u ON n.user_id = u.user_id
+        WHERE n.is_sent = FALSE
+        AND n.scheduled_date <= CURRENT_TIMESTAMP
+        AND u.notifications_enabled = TRUE
+        AND (n.lease_until IS NULL OR n.lease_until < CURRENT_TIMESTAMP)
+        ORDER BY n.id
+        LIMIT 500
+        FOR UPDATE OF n SKIP LOCKED
+    """, (), 'idx_notifications_pending', False),
+    ('get_seconds_until_next_notification', """
+        SELECT MIN(GREATEST(n.scheduled_date, COALESCE(n.lease_until, n.scheduled_date)))
+        FROM notifications n
+        JOIN users u ON n.user_id = u.user_id
+        WHERE n.is_sent = FALSE
+        AND u.notifications_enabled = TRUE
+    """, (), 'idx_notifications_pending', False),
+]
+
+
+def seed(db, cur, users, subs_per_user):
+    """Пользователи, подписки и уведомления; неотправленных уведомлений ~1%"""
+    cur.execute("""
+        INSERT INTO users (user_id, username, full_name)
+        SELECT g, 'user' || g, 'User ' || g FROM generate_series(1, %s) g
+    """, (users,))
+    cur.execute("""
+        INSERT INTO subscriptions (user_id, name, price, currency, category, billing_cycle,
+                                   start_date, next_payment, is_active)
+        SELECT u, 'Service ' || s, (random() * 20)::numeric(10, 2),
+               (ARRAY['USD', 'EUR', 'RUB'])[1 + s %% 3],
+               (ARRAY['Streaming', 'Music', 'Work', 'VPN'])[1 + s %% 4],
+               (ARRAY['monthly', 'yearly', 'weekly'])[1 + s %% 3],
+               CURRENT_DATE - 365, CURRENT_DATE + (random() * 365)::int, s %% 5 <> 0
+        FROM generate_series(1, %s) u, generate_series(1, %s) s
+    """, (users, subs_per_user))
+    cur.execute("""
+        INSERT INTO notifications (user_id, subscription_id, notification_type, scheduled_date, is_sent)
+        SELECT user_id, id, 'renewal', next_payment - 3, random() > 0.01
+        FROM subscriptions
+    """)
+    # Данные вставлены в обход Database, поэтому агрегаты пересчитываются целиком
+    db._rebuild_spending_summary(cur)
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def check(cur, name, query, params, index, index_only):
+    cur.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+    raw = cur.fetchone()[0]
+    plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]['Plan']
+    nodes = list(plan_nodes(plan))
+
+    problems = []
+    used = [n for n in nodes if n.get('Index Name') == index]
+    if not used:
+        problems.append(f'index {index} is not used')
+    elif index_only and not any(n['Node Type'] == 'Index Only Scan' for n in used):
+        problems.append(f'{index} is used without Index Only Scan')
+    for n in nodes:
+        if n['Node Type'] == 'Seq Scan' and n.get('Relation Name') in ('subscriptions', 'notifications', 'upcoming_charges'):
+            problems.append(f"Seq Scan on {n['Relation Name']}")
+
+    status = 'FAIL' if problems else 'ok'
+    print(f'[{status}] {name}' + (': ' + '; '.join(problems) if problems else ''))
+    if problems:
+        print(json.dumps(plan, indent=2))
+    return not problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--subs-per-user', type=int, default=5)
+    parser.add_argument('--keep', action='store_true', help='не удалять схему после проверки')
+    args = parser.parse_args()
+
+    db = Database()
+    admin = psycopg2.connect(**db.connection_params)
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        cur.execute(f'CREATE SCHEMA {SCHEMA}')
+
+    try:
+        db.init_db()
+        with db.connection() as conn, conn.cursor() as cur:
+            seed(db, cur, args.users, args.subs_per_user)
+        db.refresh_upcoming_charges()
+
+        with admin.cursor() as cur:
+            cur.execute(f'SET search_path TO {SCHEMA}')
+            # Карта видимости нужна планировщику для index-only scan
+            cur.execute('VACUUM ANALYZE users, subscriptions, notifications, user_category_spending, upcoming_charges')
+
+        with db.connection() as conn, conn.cursor() as cur:
+            ok = all([check(cur, *c) for c in CHECKS])
+    finally:
+        db.close()
+        if not args.keep:
+            with admin.cursor() as cur:
+                cur.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        admin.close()
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,17 +4,33 @@ Telegram Bot для управления подписками
 """
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, types, F
+from datetime import date, datetime, timedelta
+from aiogram import Bot, types, F
 from aiogram.filters import CommandStart, Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 import aiohttp
-from database import Database
-from config import BOT_TOKEN, WEBAPP_URL, ADMIN_IDS
+from database import Database, AsyncDatabase
+from db_dispatcher import DispatcherOverloadedError
+from config import (
+    BOT_TOKEN, WEBAPP_URL, ADMIN_IDS, STATS_HISTORY_DAYS, STATS_ROLLUP_INTERVAL,
+    FX_REFRESH_INTERVAL, RENEWAL_JOB_INTERVAL, RENEWAL_BATCH_SIZE, RENEWAL_HORIZON_DAYS,
+    WEB_HOST, WEB_PORT, BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_CONCURRENCY,
+    FSM_STORAGE, FSM_REDIS_URL, FSM_TTL, FSM_CLEANUP_INTERVAL,
+    NOTIFICATION_PIPELINE_WORKERS, NOTIFICATION_GLOBAL_RATE, NOTIFICATION_PER_CHAT_INTERVAL,
+    NOTIFICATION_MAX_IN_FLIGHT, NOTIFICATION_MAX_RETRIES, NOTIFICATION_ACK_BATCH,
+    NOTIFICATION_PIPELINE_MAX_PENDING, SUBSCRIPTION_BATCH_MAX_OPS,
+    WEBAPP_DIR, STATIC_COMPRESS_MIN_SIZE, API_COMPRESS_MIN_SIZE
+)
 from notifications import NotificationService
+from notification_pipeline import NotificationPipeline
+from periodic import PeriodicTask
+from middlewares import UserContext, UserContextMiddleware, ConcurrencyLimitMiddleware
+from cost_engine import summarize
+from serialization import dumps, loads
+from fsm_storage import BatchedDispatcher, PostgresStorage, create_storage
+from static_assets import StaticAssets, compression_middleware
 
 # Настройка логирования
 logging.basicConfig(
@@ -24,11 +40,42 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Инициализация
-db = Database()
-storage = MemoryStorage()
+db = AsyncDatabase(Database())
+# Состояния FSM переживают перезапуск и общие для всех процессов бота;
+# чтения и записи состояния собираются в одну пачку на апдейт
+storage = create_storage(FSM_STORAGE, db=db, redis_url=FSM_REDIS_URL, ttl=FSM_TTL)
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=storage)
-notification_service = NotificationService(bot, db)
+dp = BatchedDispatcher(storage=storage)
+# Массовые рассылки: отправка в отдельных процессах, если они настроены
+notification_pipeline = None
+if NOTIFICATION_PIPELINE_WORKERS > 0:
+    notification_pipeline = NotificationPipeline(
+        db, BOT_TOKEN, NOTIFICATION_PIPELINE_WORKERS,
+        rate=NOTIFICATION_GLOBAL_RATE,
+        per_chat_interval=NOTIFICATION_PER_CHAT_INTERVAL,
+        max_in_flight=NOTIFICATION_MAX_IN_FLIGHT,
+        max_retries=NOTIFICATION_MAX_RETRIES,
+        ack_batch=NOTIFICATION_ACK_BATCH,
+        max_pending=NOTIFICATION_PIPELINE_MAX_PENDING
+    )
+notification_service = NotificationService(bot, db, pipeline=notification_pipeline)
+# Фоновое обслуживание: закрытие дней статистики, курсы валют, календарь списаний
+periodic_tasks = [
+    PeriodicTask('stats_rollup', db.rollup_daily_stats, STATS_ROLLUP_INTERVAL),
+    PeriodicTask('fx_refresh', db.refresh_fx_rates, FX_REFRESH_INTERVAL, run_at_start=False),
+    PeriodicTask('renewals', lambda: db.run_renewal_maintenance(RENEWAL_BATCH_SIZE), RENEWAL_JOB_INTERVAL),
+]
+if isinstance(storage.inner, PostgresStorage):
+    # Redis удаляет просроченные ключи сам, таблицу нужно чистить
+    periodic_tasks.append(PeriodicTask('fsm_cleanup', storage.inner.cleanup, FSM_CLEANUP_INTERVAL))
+
+# Ограничение числа одновременно обрабатываемых апдейтов (нужно в режиме webhook)
+update_limiter = ConcurrencyLimitMiddleware(WEBHOOK_MAX_CONCURRENCY)
+dp.update.outer_middleware(update_limiter)
+
+# Пользователь загружается один раз на апдейт и передается как user_ctx
+dp.message.middleware(UserContextMiddleware(db))
+dp.callback_query.middleware(UserContextMiddleware(db))
 
 # FSM States
 class AddSubscription(StatesGroup):
@@ -78,14 +125,14 @@ Click the button below to open the app!""",
     }
 }
 
-def get_text(user_id: int, key: str) -> str:
+def get_text(user_ctx: UserContext, key: str) -> str:
     """Получить текст с учетом языка пользователя"""
-    lang = db.get_user_language(user_id) or 'ru'
+    lang = user_ctx.language
     return TEXTS.get(lang, TEXTS['ru']).get(key, key)
 
-def get_main_keyboard(user_id: int) -> InlineKeyboardMarkup:
+def get_main_keyboard(user_ctx: UserContext) -> InlineKeyboardMarkup:
     """Главная клавиатура бота"""
-    lang = db.get_user_language(user_id) or 'ru'
+    lang = user_ctx.language
     buttons = [
         [InlineKeyboardButton(
             text=TEXTS[lang]['open_app'],
@@ -99,51 +146,68 @@ def get_main_keyboard(user_id: int) -> InlineKeyboardMarkup:
     ]
     
     # Админ-кнопка для администраторов
-    if user_id in ADMIN_IDS:
+    if user_ctx.user_id in ADMIN_IDS:
         buttons.append([InlineKeyboardButton(text=TEXTS[lang]['admin'], callback_data='admin')])
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 @dp.message(CommandStart())
-async def cmd_start(message: types.Message):
+async def cmd_start(message: types.Message, user_ctx: UserContext):
     """Обработчик команды /start"""
     user_id = message.from_user.id
     username = message.from_user.username or ''
     full_name = message.from_user.full_name or ''
     
     # Регистрация пользователя
-    db.add_user(user_id, username, full_name)
+    await db.add_user(user_id, username, full_name)
+    await user_ctx.refresh()
     
-    welcome_text = get_text(user_id, 'welcome')
-    keyboard = get_main_keyboard(user_id)
+    welcome_text = get_text(user_ctx, 'welcome')
+    keyboard = get_main_keyboard(user_ctx)
     
     await message.answer(welcome_text, reply_markup=keyboard)
     logger.info(f"User {user_id} started the bot")
 
 @dp.message(Command('menu'))
-async def cmd_menu(message: types.Message):
+async def cmd_menu(message: types.Message, user_ctx: UserContext):
     """Показать главное меню"""
-    user_id = message.from_user.id
-    menu_text = get_text(user_id, 'menu')
-    keyboard = get_main_keyboard(user_id)
+    menu_text = get_text(user_ctx, 'menu')
+    keyboard = get_main_keyboard(user_ctx)
     
     await message.answer(menu_text, reply_markup=keyboard)
 
+@dp.message(Command('currency'))
+async def cmd_currency(message: types.Message, user_ctx: UserContext):
+    """Сменить валюту отображения итогов: /currency EUR"""
+    lang = user_ctx.language
+    parts = message.text.split()
+    currencies = sorted(db.fx.currencies())
+    
+    if len(parts) < 2 or parts[1].upper() not in currencies:
+        text = (f"Валюта итогов: {user_ctx.display_currency}\nДоступные: {', '.join(currencies)}\nПример: /currency EUR"
+                if lang == 'ru' else
+                f"Totals currency: {user_ctx.display_currency}\nAvailable: {', '.join(currencies)}\nExample: /currency EUR")
+        await message.answer(text)
+        return
+    
+    await user_ctx.update_display_currency(parts[1].upper())
+    await message.answer(f"✅ {user_ctx.display_currency}")
+
 @dp.callback_query(F.data == 'stats')
-async def show_stats(callback: types.CallbackQuery):
+async def show_stats(callback: types.CallbackQuery, user_ctx: UserContext):
     """Показать статистику пользователя"""
     user_id = callback.from_user.id
-    stats = db.get_user_stats(user_id)
+    stats = await db.get_user_stats(user_id)
     
-    lang = db.get_user_language(user_id) or 'ru'
+    lang = user_ctx.language
     
     if lang == 'ru':
         stats_text = f"""📊 Ваша статистика:
 
 💳 Всего подписок: {stats['total_subscriptions']}
 ✅ Активных: {stats['active_subscriptions']}
-💰 Месячные расходы: ${stats['monthly_cost']:.2f}
-📅 Годовые расходы: ${stats['yearly_cost']:.2f}
+💰 Месячные расходы: {stats['monthly_cost']:.2f} {stats['currency']}
+📅 Годовые расходы: {stats['yearly_cost']:.2f} {stats['currency']}
 
 📈 По категориям:"""
     else:
@@ -151,20 +215,24 @@ async def show_stats(callback: types.CallbackQuery):
 
 💳 Total subscriptions: {stats['total_subscriptions']}
 ✅ Active: {stats['active_subscriptions']}
-💰 Monthly expenses: ${stats['monthly_cost']:.2f}
-📅 Yearly expenses: ${stats['yearly_cost']:.2f}
+💰 Monthly expenses: {stats['monthly_cost']:.2f} {stats['currency']}
+📅 Yearly expenses: {stats['yearly_cost']:.2f} {stats['currency']}
 
 📈 By category:"""
     
     for category, amount in stats['by_category'].items():
-        stats_text += f"\n  • {category}: ${amount:.2f}"
+        stats_text += f"\n  • {category}: {amount:.2f} {stats['currency']}"
+    
+    # Валюты без курса не входят в итоги, показываем их отдельно
+    for currency, amount in stats['unconverted'].items():
+        stats_text += f"\n  • {amount:.2f} {currency} (нет курса)" if lang == 'ru' else f"\n  • {amount:.2f} {currency} (no rate)"
     
     # Ближайшие продления
-    upcoming = db.get_upcoming_renewals(user_id, days=7)
+    upcoming = await db.get_upcoming_renewals(user_id, days=7)
     if upcoming:
         stats_text += "\n\n🔔 Ближайшие продления:" if lang == 'ru' else "\n\n🔔 Upcoming renewals:"
         for sub in upcoming[:3]:
-            days_left = (sub['next_payment'] - datetime.now()).days
+            days_left = (sub['charge_date'] - date.today()).days
             stats_text += f"\n  • {sub['name']} - через {days_left} дн." if lang == 'ru' else f"\n  • {sub['name']} - in {days_left} days"
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -175,11 +243,10 @@ async def show_stats(callback: types.CallbackQuery):
     await callback.answer()
 
 @dp.callback_query(F.data == 'settings')
-async def show_settings(callback: types.CallbackQuery):
+async def show_settings(callback: types.CallbackQuery, user_ctx: UserContext):
     """Показать настройки"""
-    user_id = callback.from_user.id
-    user = db.get_user(user_id)
-    lang = user.get('language', 'ru')
+    user = user_ctx.data
+    lang = user_ctx.language
     
     settings_text = "⚙️ Настройки\n\n" if lang == 'ru' else "⚙️ Settings\n\n"
     settings_text += f"🌐 Язык: {'Русский' if lang == 'ru' else 'English'}\n"
@@ -207,57 +274,53 @@ async def show_settings(callback: types.CallbackQuery):
     await callback.answer()
 
 @dp.callback_query(F.data == 'change_language')
-async def change_language(callback: types.CallbackQuery):
+async def change_language(callback: types.CallbackQuery, user_ctx: UserContext):
     """Сменить язык"""
-    user_id = callback.from_user.id
-    current_lang = db.get_user_language(user_id) or 'ru'
+    current_lang = user_ctx.language
     new_lang = 'en' if current_lang == 'ru' else 'ru'
     
-    db.update_user_language(user_id, new_lang)
+    await user_ctx.update_language(new_lang)
     
     text = "✅ Язык изменен на English" if new_lang == 'en' else "✅ Language changed to Русский"
     await callback.answer(text, show_alert=True)
     
     # Обновить настройки
-    await show_settings(callback)
+    await show_settings(callback, user_ctx)
 
 @dp.callback_query(F.data == 'toggle_notifications')
-async def toggle_notifications(callback: types.CallbackQuery):
+async def toggle_notifications(callback: types.CallbackQuery, user_ctx: UserContext):
     """Переключить уведомления"""
-    user_id = callback.from_user.id
-    current_state = db.get_user(user_id).get('notifications_enabled', True)
+    current_state = user_ctx.notifications_enabled
     new_state = not current_state
     
-    db.update_user_notifications(user_id, new_state)
+    await user_ctx.update_notifications(new_state)
     
-    lang = db.get_user_language(user_id) or 'ru'
+    lang = user_ctx.language
     text = f"✅ Уведомления {'включены' if new_state else 'выключены'}" if lang == 'ru' else f"✅ Notifications {'enabled' if new_state else 'disabled'}"
     await callback.answer(text, show_alert=True)
     
-    await show_settings(callback)
+    await show_settings(callback, user_ctx)
 
 @dp.callback_query(F.data == 'change_theme')
-async def change_theme(callback: types.CallbackQuery):
+async def change_theme(callback: types.CallbackQuery, user_ctx: UserContext):
     """Сменить тему"""
-    user_id = callback.from_user.id
-    current_theme = db.get_user(user_id).get('theme', 'light')
+    current_theme = user_ctx.theme
     new_theme = 'dark' if current_theme == 'light' else 'light'
     
-    db.update_user_theme(user_id, new_theme)
+    await user_ctx.update_theme(new_theme)
     
-    lang = db.get_user_language(user_id) or 'ru'
+    lang = user_ctx.language
     text = f"✅ Тема изменена на {'темную' if new_theme == 'dark' else 'светлую'}" if lang == 'ru' else f"✅ Theme changed to {new_theme}"
     await callback.answer(text, show_alert=True)
     
-    await show_settings(callback)
+    await show_settings(callback, user_ctx)
 
 @dp.callback_query(F.data == 'premium')
-async def show_premium(callback: types.CallbackQuery):
+async def show_premium(callback: types.CallbackQuery, user_ctx: UserContext):
     """Показать информацию о Premium"""
-    user_id = callback.from_user.id
-    user = db.get_user(user_id)
-    is_premium = user.get('is_premium', False)
-    lang = user.get('language', 'ru')
+    user = user_ctx.data
+    is_premium = user_ctx.is_premium
+    lang = user_ctx.language
     
     if is_premium:
         premium_until = user.get('premium_until', '')
@@ -337,14 +400,13 @@ Try 7 days free!"""
     await callback.answer()
 
 @dp.callback_query(F.data == 'buy_premium')
-async def buy_premium(callback: types.CallbackQuery):
+async def buy_premium(callback: types.CallbackQuery, user_ctx: UserContext):
     """Покупка Premium"""
-    user_id = callback.from_user.id
-    lang = db.get_user_language(user_id) or 'ru'
+    lang = user_ctx.language
     
     # Здесь должна быть интеграция с платежной системой
     # Для демо активируем пробный период
-    db.activate_premium_trial(user_id, days=7)
+    await user_ctx.activate_premium_trial(days=7)
     
     if lang == 'ru':
         text = """✅ Пробный период активирован!
@@ -362,7 +424,35 @@ All features are now available.
 For full activation use /premium"""
     
     await callback.answer(text, show_alert=True)
-    await show_premium(callback)
+    await show_premium(callback, user_ctx)
+
+def format_daily_history(history) -> str:
+    """Блок админ-панели с динамикой по закрытым дням"""
+    if not history:
+        return ''
+
+    lines = [f"\n📆 За {len(history)} дн. (пользователи / подписки / Premium):"]
+    for day in history:
+        lines.append(
+            f"{day['day']:%d.%m}: +{day['new_users']} / +{day['new_subscriptions']} / +{day['premium_conversions']}"
+        )
+
+    mrr = history[0]['mrr']
+    if mrr:
+        amounts = ', '.join(f"{amount:.2f} {currency}" for currency, amount in sorted(mrr.items()))
+        lines.append(f"💵 MRR на {history[0]['day']:%d.%m}: {amounts}")
+    return '\n'.join(lines) + '\n'
+
+def format_pipeline_run(run) -> str:
+    """Строка админ-панели с пропускной способностью этапов последней рассылки"""
+    if not run or not run['producer']['items']:
+        return ''
+    senders = sum(stage['per_second'] for stage in run['senders'].values())
+    return (
+        f"📬 Рассылка: {run['producer']['items']} за {run['elapsed_s']:.1f} с "
+        f"(аренда {run['producer']['per_second']}/с, отправка {senders:.1f}/с, "
+        f"подтверждение {run['collector']['per_second']}/с, ошибок {run['failed']})\n"
+    )
 
 @dp.callback_query(F.data == 'admin')
 async def show_admin_panel(callback: types.CallbackQuery):
@@ -373,7 +463,11 @@ async def show_admin_panel(callback: types.CallbackQuery):
         await callback.answer("❌ Access denied", show_alert=True)
         return
     
-    admin_stats = db.get_admin_stats()
+    admin_stats = await db.get_admin_stats()
+    history = await db.get_daily_stats(STATS_HISTORY_DAYS)
+    db_stats = db.dispatcher_stats()
+    cache_stats = db.cache_stats()
+    fsm_stats = storage.stats()
     
     text = f"""👨‍💼 Админ-панель
 
@@ -382,12 +476,17 @@ async def show_admin_panel(callback: types.CallbackQuery):
 ⭐ Premium пользователей: {admin_stats['premium_users']}
 💳 Всего подписок: {admin_stats['total_subscriptions']}
 📈 Активных подписок: {admin_stats['active_subscriptions']}
-💰 Общая сумма подписок: ${admin_stats['total_revenue']:.2f}
+💰 Общая сумма подписок: {admin_stats['total_revenue']:.2f} {admin_stats['currency']}
 
 📅 За сегодня:
 👤 Новых пользователей: {admin_stats['new_users_today']}
 ➕ Новых подписок: {admin_stats['new_subscriptions_today']}
-"""
+{format_daily_history(history)}
+🗄 Очередь БД: {db_stats['queued']} в ожидании, {db_stats['running']} выполняется, {db_stats['rejected']} отклонено
+👤 Кэш пользователей: {cache_stats['size']} записей, попаданий {cache_stats['hit_rate']:.0%}
+📨 Апдейты: {update_limiter.running} обрабатывается, {update_limiter.waiting} в ожидании
+🧭 FSM ({fsm_stats['backend']}): чтений {fsm_stats['reads']}, записей {fsm_stats['writes']}
+{format_pipeline_run(notification_pipeline.last_run if notification_pipeline else None)}"""
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text='📊 Полная статистика', callback_data='admin_full_stats')],
@@ -400,11 +499,10 @@ async def show_admin_panel(callback: types.CallbackQuery):
     await callback.answer()
 
 @dp.callback_query(F.data == 'back_to_menu')
-async def back_to_menu(callback: types.CallbackQuery):
+async def back_to_menu(callback: types.CallbackQuery, user_ctx: UserContext):
     """Вернуться в главное меню"""
-    user_id = callback.from_user.id
-    menu_text = get_text(user_id, 'menu')
-    keyboard = get_main_keyboard(user_id)
+    menu_text = get_text(user_ctx, 'menu')
+    keyboard = get_main_keyboard(user_ctx)
     
     await callback.message.edit_text(menu_text, reply_markup=keyboard)
     await callback.answer()
@@ -412,116 +510,223 @@ async def back_to_menu(callback: types.CallbackQuery):
 @dp.message(F.web_app_data)
 async def handle_webapp_data(message: types.Message):
     """Обработка данных от Web App"""
-    import json
-    
     user_id = message.from_user.id
-    data = json.loads(message.web_app_data.data)
+    data = loads(message.web_app_data.data)
     
     action = data.get('action')
     
     if action == 'add_subscription':
         # Добавить подписку
         subscription_data = data.get('subscription')
-        db.add_subscription(user_id, subscription_data)
+        await db.add_subscription(user_id, subscription_data)
         await message.answer("✅ Подписка добавлена!")
         
     elif action == 'update_subscription':
         # Обновить подписку
         subscription_id = data.get('subscription_id')
         subscription_data = data.get('subscription')
-        db.update_subscription(user_id, subscription_id, subscription_data)
+        await db.update_subscription(user_id, subscription_id, subscription_data)
         await message.answer("✅ Подписка обновлена!")
         
     elif action == 'delete_subscription':
         # Удалить подписку
         subscription_id = data.get('subscription_id')
-        db.delete_subscription(user_id, subscription_id)
+        await db.delete_subscription(user_id, subscription_id)
         await message.answer("✅ Подписка удалена!")
 
 # API эндпоинты для Web App
 from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+# Статика Mini App собирается в память при запуске веб-сервера
+static_assets = StaticAssets(WEBAPP_DIR, STATIC_COMPRESS_MIN_SIZE)
+
+def json_response(data, status: int = 200, headers=None) -> web.Response:
+    """JSON-ответ API через serialization: Decimal и даты без ручного преобразования"""
+    return web.Response(body=dumps(data), status=status, headers=headers, content_type='application/json')
+
+def user_etag(user_id: int, version: int) -> str:
+    return f'"{user_id}-{version}"'
+
+def etag_version(header, user_id: int):
+    """Версия данных из If-None-Match, если тег выдан этим сервером для user_id"""
+    prefix = f"{user_id}-"
+    for tag in (header or '').split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        tag = tag.strip('"')
+        if tag.startswith(prefix) and tag[len(prefix):].isdigit():
+            return int(tag[len(prefix):])
+    return None
 
 async def get_user_data(request):
-    """Получить данные пользователя"""
+    """
+    Получить данные пользователя. Пользователь и подписки читаются одним
+    запросом уже в виде JSON; если версия данных совпадает с If-None-Match,
+    отдается 304 без построения ответа
+    """
     user_id = int(request.query.get('user_id'))
-    user = db.get_user(user_id)
-    subscriptions = db.get_subscriptions(user_id)
-    
-    return web.json_response({
-        'user': user,
-        'subscriptions': subscriptions
-    })
+    known_version = etag_version(request.headers.get('If-None-Match'), user_id)
+    result = await db.get_user_payload(user_id, known_version)
+    if result is None:
+        return json_response({'user': None, 'subscriptions': []})
+    
+    version, payload = result
+    # no-cache: клиент хранит ответ, но каждый раз перепроверяет версию
+    headers = {'ETag': user_etag(user_id, version), 'Cache-Control': 'private, no-cache'}
+    if payload is None:
+        return web.Response(status=304, headers=headers)
+    return web.Response(text=payload, content_type='application/json', headers=headers)
 
 async def get_subscriptions(request):
     """Получить подписки пользователя"""
     user_id = int(request.query.get('user_id'))
-    subscriptions = db.get_subscriptions(user_id)
+    subscriptions = await db.get_subscriptions(user_id)
     
-    return web.json_response({
+    return json_response({
         'subscriptions': subscriptions
     })
 
+async def get_subscription_changes(request):
+    """
+    Изменения подписок после курсора ?since=: измененные строки и ID удаленных.
+    Ответ содержит новый курсор; full=true — пришел полный список
+    """
+    user_id = int(request.query.get('user_id'))
+    since = request.query.get('since')
+    changes = await db.get_subscription_changes(user_id, int(since) if since and since.isdigit() else None)
+    if changes is None:
+        return json_response({'cursor': 0, 'full': True, 'subscriptions': [], 'deleted': []})
+    
+    return json_response(changes)
+
+async def get_stats(request):
+    """Расходы пользователя и прогноз списаний по месяцам"""
+    user_id = int(request.query.get('user_id'))
+    months = min(int(request.query.get('months', 12)), RENEWAL_HORIZON_DAYS // 31)
+    user = await db.get_user(user_id) or {}
+    currency = request.query.get('currency') or user.get('display_currency') or db.fx.base
+    columns = await db.get_cost_columns(user_id)
+    
+    stats = summarize(columns, rates=db.fx.factors(columns.currencies, currency))
+    stats['currency'] = currency
+    
+    return json_response({
+        'stats': stats,
+        'cash_flow': await db.get_cash_flow(user_id, months, currency)
+    })
+
+async def get_calendar(request):
+    """Календарь списаний пользователя на days дней вперед"""
+    user_id = int(request.query.get('user_id'))
+    days = min(int(request.query.get('days', 31)), RENEWAL_HORIZON_DAYS)
+    charges = await db.get_charge_calendar(user_id, days)
+    
+    return json_response({'charges': charges})
+
 async def add_subscription(request):
     """Добавить подписку"""
-    data = await request.json()
+    data = await request.json(loads=loads)
     user_id = data['user_id']
     subscription = data['subscription']
     
-    subscription_id = db.add_subscription(user_id, subscription)
+    subscription_id = await db.add_subscription(user_id, subscription)
     
-    return web.json_response({
+    return json_response({
         'success': True,
         'subscription_id': subscription_id
     })
 
 async def update_subscription(request):
     """Обновить подписку"""
-    data = await request.json()
+    data = await request.json(loads=loads)
     user_id = data['user_id']
     subscription_id = data['subscription_id']
     subscription = data['subscription']
     
-    db.update_subscription(user_id, subscription_id, subscription)
+    await db.update_subscription(user_id, subscription_id, subscription)
     
-    return web.json_response({
+    return json_response({
         'success': True
     })
 
 async def delete_subscription(request):
     """Удалить подписку"""
-    data = await request.json()
+    data = await request.json(loads=loads)
     user_id = data['user_id']
     subscription_id = data['subscription_id']
     
-    db.delete_subscription(user_id, subscription_id)
+    await db.delete_subscription(user_id, subscription_id)
     
-    return web.json_response({
+    return json_response({
         'success': True
     })
 
-async def start_webapp():
-    """Запустить веб-сервер для Web App"""
+async def batch_subscriptions(request):
+    """
+    Пакет операций над подписками (add/update/delete/toggle) одной транзакцией.
+    Ответ содержит результат каждой операции в порядке запроса
+    """
+    data = await request.json(loads=loads)
+    user_id = data['user_id']
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return json_response({'success': False, 'error': 'invalid'}, status=400)
+    if len(operations) > SUBSCRIPTION_BATCH_MAX_OPS:
+        return json_response({'success': False, 'error': 'too_many_operations',
+                              'limit': SUBSCRIPTION_BATCH_MAX_OPS}, status=413)
+    
+    result = await db.apply_subscription_batch(user_id, operations)
+    if result is None:
+        return json_response({'success': False, 'error': 'user_not_found'}, status=404)
+    
+    return json_response(dict(result, success=all(r['ok'] for r in result['results'])))
+
+async def start_webapp(webhook_handler=None):
+    """
+    Запустить веб-сервер для Web App (и webhook Telegram в режиме webhook).
+    webhook_handler заменяет обработку апдейтов в этом процессе (ingress в cluster.py)
+    """
     app = web.Application()
     
     # Настройка CORS
     app.middlewares.append(cors_middleware)
+    app.middlewares.append(overload_middleware)
+    app.middlewares.append(compression_middleware(API_COMPRESS_MIN_SIZE))
     
     # Роуты API
     app.router.add_get('/api/user', get_user_data)
     app.router.add_get('/api/subscriptions', get_subscriptions)
+    app.router.add_get('/api/subscriptions/changes', get_subscription_changes)
+    app.router.add_get('/api/stats', get_stats)
+    app.router.add_get('/api/calendar', get_calendar)
     app.router.add_post('/api/subscriptions', add_subscription)
     app.router.add_put('/api/subscriptions', update_subscription)
     app.router.add_delete('/api/subscriptions', delete_subscription)
-    
-    # Статические файлы
-    app.router.add_static('/static/', path='webapp/static', name='static')
-    app.router.add_get('/', lambda req: web.FileResponse('webapp/index.html'))
+    app.router.add_post('/api/subscriptions/batch', batch_subscriptions)
+    
+    # Статические файлы: имена с хешем содержимого, заранее сжатые варианты
+    await asyncio.get_running_loop().run_in_executor(None, static_assets.build)
+    static_assets.register(app)
+    
+    # Апдейты Telegram: заголовок с секретом проверяется до разбора апдейта,
+    # ответ 200 отдается сразу, обработка идет в фоне под update_limiter
+    if webhook_handler is not None:
+        app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    elif BOT_MODE == 'webhook':
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET,
+            handle_in_background=True
+        ).register(app, path=WEBHOOK_PATH)
     
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', 8080)
+    site = web.TCPSite(runner, WEB_HOST, WEB_PORT)
     await site.start()
-    logger.info("Web app started on port 8080")
+    logger.info(f"Web app started on {WEB_HOST}:{WEB_PORT}")
 
 @web.middleware
 async def cors_middleware(request, handler):
@@ -529,23 +734,49 @@ async def cors_middleware(request, handler):
     response = await handler(request)
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, If-None-Match'
+    response.headers['Access-Control-Expose-Headers'] = 'ETag'
     return response
 
+@web.middleware
+async def overload_middleware(request, handler):
+    """Ответ 503, если очередь запросов к БД переполнена"""
+    try:
+        return await handler(request)
+    except DispatcherOverloadedError:
+        return json_response({'error': 'overloaded'}, status=503, headers={'Retry-After': '1'})
+
+def start_background_services():
+    """Сервис уведомлений и фоновые задачи обслуживания"""
+    asyncio.create_task(notification_service.start())
+    for task in periodic_tasks:
+        asyncio.create_task(task.start())
+
 async def main():
     """Главная функция"""
     # Инициализация базы данных
-    db.init_db()
+    await db.init_db()
     
     # Запуск веб-сервера
     await start_webapp()
     
-    # Запуск сервиса уведомлений
-    asyncio.create_task(notification_service.start())
+    # Уведомления и фоновые задачи
+    start_background_services()
     
     # Запуск бота
-    logger.info("Bot started")
-    await dp.start_polling(bot)
+    if BOT_MODE == 'webhook':
+        # Все реплики регистрируют один и тот же адрес, повторный вызов безопасен
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(WEBHOOK_MAX_CONCURRENCY, 100)
+        )
+        logger.info(f"Bot started in webhook mode at {WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    else:
+        logger.info("Bot started")
+        await dp.start_polling(bot)
 
 if __name__ == '__main__':
     asyncio.run(main())
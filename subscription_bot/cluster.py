@@ -0,0 +1,333 @@
+"""
+Шардированный запуск бота: python cluster.py
+Процесс-ingress получает апдейты (webhook или long polling) и по from_user.id
+через консистентное хеширование раздает их SHARD_WORKERS процессам-обработчикам.
+Апдейты одного пользователя всегда попадают в один процесс и обрабатываются
+там по очереди, кэши пользователей в каждом процессе остаются «теплыми».
+Ingress также обслуживает Web App API, уведомления и фоновые задачи
+"""
+import asyncio
+import logging
+import multiprocessing
+import queue
+from typing import Callable, Dict, List, Optional
+import aiohttp
+from aiohttp import web
+from config import (
+    BOT_TOKEN, BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_CONCURRENCY,
+    FX_REFRESH_INTERVAL, SHARD_WORKERS, SHARD_VNODES, SHARD_QUEUE_SIZE, SHARD_SUPERVISE_INTERVAL
+)
+from sharding import HashRing, update_user_id
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = 'https://api.telegram.org/bot{token}/{method}'
+
+# Предельная пауза между неудачными запросами getUpdates, секунд
+POLL_MAX_BACKOFF = 60
+
+
+def run_worker(name: str, updates, done):
+    """Точка входа процесса-обработчика"""
+    asyncio.run(_worker_main(name, updates, done))
+
+
+async def _worker_main(name: str, updates, done):
+    # Обработчики, диспетчер и подключение к БД создаются при импорте bot
+    import bot as app
+    from periodic import PeriodicTask
+
+    logger.info(f"Shard worker {name} started")
+    loop = asyncio.get_running_loop()
+    fx_refresh = PeriodicTask('fx_refresh', app.db.refresh_fx_rates, FX_REFRESH_INTERVAL)
+    asyncio.create_task(fx_refresh.start())
+
+    # Последний апдейт каждого пользователя: следующий ждет его завершения,
+    # разные пользователи обрабатываются параллельно
+    tails: Dict[int, asyncio.Task] = {}
+
+    async def process(update: Dict, previous: Optional[asyncio.Task]):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await app.dp.feed_raw_update(app.bot, update)
+        except Exception as e:
+            logger.error(f"Shard worker {name} failed on update {update.get('update_id')}: {e}")
+        finally:
+            with done.get_lock():
+                done.value += 1
+
+    def forget(user_id: int, task: asyncio.Task):
+        if tails.get(user_id) is task:
+            del tails[user_id]
+
+    while True:
+        item = await loop.run_in_executor(None, updates.get)
+        if item is None:
+            break
+        user_id, update = item
+        task = asyncio.create_task(process(update, tails.get(user_id)))
+        tails[user_id] = task
+        task.add_done_callback(lambda t, u=user_id: forget(u, t))
+
+    if tails:
+        await asyncio.wait(list(tails.values()))
+    fx_refresh.stop()
+    await app.bot.session.close()
+    app.db.close()
+    logger.info(f"Shard worker {name} stopped")
+
+
+class ShardWorker:
+    """Процесс-обработчик глазами ingress: очередь и счетчики отправленных/обработанных апдейтов"""
+
+    def __init__(self, context, name: str, queue_size: int):
+        self.name = name
+        self.queue = context.Queue(queue_size)
+        self.done = context.Value('q', 0)
+        self.sent = 0
+        self.process = context.Process(target=run_worker, args=(name, self.queue, self.done), name=name, daemon=True)
+
+    @property
+    def pending(self) -> int:
+        return self.sent - self.done.value
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+
+class ShardedIngress:
+    """
+    Маршрутизация апдейтов по процессам. При изменении состава кольца
+    (процесс добавлен, удален или упал) прием в очереди приостанавливается,
+    пока обработчики не закончат уже отправленные апдейты: пользователь,
+    переехавший на другой процесс, не обгонит собственные апдейты
+    """
+
+    def __init__(self, token: str, secret: str, vnodes: int = 128, queue_size: int = 1000):
+        self.token = token
+        self.secret = secret
+        self.queue_size = queue_size
+        self.ring = HashRing(vnodes=vnodes)
+        self.workers: Dict[str, ShardWorker] = {}
+        self.is_running = False
+        self.rebalances = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._paused = False
+        self._buffer: List[Dict] = []
+        self._ring_lock = asyncio.Lock()
+
+    def _spawn(self, name: str) -> ShardWorker:
+        worker = ShardWorker(self._context, name, self.queue_size)
+        worker.process.start()
+        self.workers[name] = worker
+        return worker
+
+    def start(self, count: int):
+        """Запустить count обработчиков (до приема апдейтов)"""
+        self.is_running = True
+        for i in range(count):
+            self.ring.add_node(self._spawn(f"worker-{i}").name)
+        logger.info(f"Sharded ingress started with {count} workers")
+
+    # === МАРШРУТИЗАЦИЯ ===
+
+    async def route(self, update: Dict):
+        """Передать апдейт процессу, отвечающему за пользователя"""
+        if self._paused:
+            self._buffer.append(update)
+            return
+        await self._dispatch(update)
+
+    async def _dispatch(self, update: Dict):
+        user_id = update_user_id(update)
+        worker = self.workers[self.ring.node_for(user_id)]
+        while True:
+            try:
+                worker.queue.put_nowait((user_id, update))
+                break
+            except queue.Full:
+                # Обработчик не успевает: ждем вместо роста очереди без ограничений
+                await asyncio.sleep(0.01)
+        worker.sent += 1
+
+    async def _change_ring(self, change: Callable[[], None]):
+        async with self._ring_lock:
+            self._paused = True
+            try:
+                while any(w.pending > 0 and w.is_alive() for w in self.workers.values()):
+                    await asyncio.sleep(0.01)
+                change()
+                self.rebalances += 1
+            finally:
+                # Буфер разбирается до снятия паузы: пока _dispatch ждет места
+                # в очереди, новые апдейты тоже копятся в буфере и не обгоняют
+                # накопленные. Без узлов в кольце прием остается на паузе
+                # до следующего изменения (перезапуска упавшего обработчика)
+                while self._buffer and len(self.ring):
+                    buffered, self._buffer = self._buffer, []
+                    for update in buffered:
+                        await self._dispatch(update)
+                if len(self.ring):
+                    self._paused = False
+
+    async def add_worker(self, name: str):
+        worker = self._spawn(name)
+        await self._change_ring(lambda: self.ring.add_node(worker.name))
+        logger.info(f"Shard worker {name} joined, {len(self.ring)} workers")
+
+    async def remove_worker(self, name: str):
+        """Вывести обработчик из кольца и дождаться, пока он доработает свою очередь"""
+        if len(self.ring) == 1 and name in self.ring:
+            raise ValueError(f"Cannot remove {name}: it is the last shard worker")
+        worker = self.workers[name]
+        await self._change_ring(lambda: self.ring.remove_node(name))
+        worker.queue.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, worker.process.join)
+        del self.workers[name]
+        logger.info(f"Shard worker {name} left, {len(self.ring)} workers")
+
+    async def scale(self, count: int):
+        """Довести число обработчиков до count"""
+        names = sorted(self.workers, key=lambda n: int(n.rsplit('-', 1)[1]))
+        for i in range(len(names), count):
+            await self.add_worker(f"worker-{i}")
+        for name in names[count:]:
+            await self.remove_worker(name)
+
+    async def _replace_dead(self, worker: ShardWorker):
+        """
+        Упавший обработчик выводится из кольца, неразобранные апдейты из его
+        очереди раздаются новым владельцам раньше буфера, затем процесс
+        с тем же именем перезапускается и возвращает свою долю ключей
+        """
+        logger.error(f"Shard worker {worker.name} died with exit code {worker.process.exitcode}")
+        leftovers = []
+
+        def detach():
+            self.ring.remove_node(worker.name)
+            del self.workers[worker.name]
+            while True:
+                try:
+                    item = worker.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    leftovers.append(item[1])
+            self._buffer[:0] = leftovers
+
+        await self._change_ring(detach)
+        if leftovers:
+            logger.warning(f"Rerouted {len(leftovers)} updates from {worker.name}")
+        if self.is_running:
+            await self.add_worker(worker.name)
+
+    async def supervise(self, interval: float = 1.0):
+        """Следить за процессами и перезапускать упавшие"""
+        while self.is_running:
+            for worker in list(self.workers.values()):
+                if not worker.is_alive() and worker.name in self.ring:
+                    await self._replace_dead(worker)
+            await asyncio.sleep(interval)
+
+    # === ИСТОЧНИКИ АПДЕЙТОВ ===
+
+    async def handle_webhook(self, request: web.Request) -> web.Response:
+        """Webhook Telegram: апдейт разбирается только до словаря"""
+        if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret:
+            return web.Response(status=401)
+        await self.route(await request.json())
+        return web.Response()
+
+    async def poll(self, allowed_updates: Optional[List[str]] = None, timeout: int = 30):
+        """
+        Long polling без разбора апдейтов в объекты aiogram:
+        ingress только читает from.id и пересылает словарь
+        """
+        async with aiohttp.ClientSession() as session:
+            def url(method):
+                return TELEGRAM_API_URL.format(token=self.token, method=method)
+
+            await session.post(url('deleteWebhook'))
+            offset = 0
+            backoff = 1.0
+            while self.is_running:
+                try:
+                    async with session.post(
+                        url('getUpdates'),
+                        json={'offset': offset, 'timeout': timeout, 'allowed_updates': allowed_updates},
+                        timeout=aiohttp.ClientTimeout(total=timeout + 10)
+                    ) as response:
+                        payload = await response.json(content_type=None)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    logger.error(f"Polling error: {e}, retrying in {backoff:.0f}s")
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, POLL_MAX_BACKOFF)
+                    continue
+
+                if not payload.get('ok'):
+                    # 409 (другой getUpdates или webhook), 401, 429: без паузы цикл
+                    # сразу повторил бы запрос. retry_after Telegram важнее своей паузы
+                    retry_after = (payload.get('parameters') or {}).get('retry_after')
+                    delay = retry_after if retry_after is not None else backoff
+                    logger.error(f"getUpdates failed: {payload.get('error_code')} "
+                                 f"{payload.get('description')}, retrying in {delay:.0f}s")
+                    await asyncio.sleep(delay)
+                    if retry_after is None:
+                        backoff = min(backoff * 2, POLL_MAX_BACKOFF)
+                    continue
+                backoff = 1.0
+
+                for update in payload['result']:
+                    await self.route(update)
+                    offset = update['update_id'] + 1
+
+    async def stop(self):
+        """Дождаться обработки очередей и остановить все процессы"""
+        self.is_running = False
+        for worker in self.workers.values():
+            worker.queue.put(None)
+        loop = asyncio.get_running_loop()
+        for worker in self.workers.values():
+            await loop.run_in_executor(None, worker.process.join)
+
+    def stats(self) -> Dict:
+        return {
+            'workers': len(self.ring),
+            'rebalances': self.rebalances,
+            'pending': {name: worker.pending for name, worker in self.workers.items()},
+        }
+
+
+async def main():
+    import bot as app
+
+    await app.db.init_db()
+
+    ingress = ShardedIngress(BOT_TOKEN, WEBHOOK_SECRET, SHARD_VNODES, SHARD_QUEUE_SIZE)
+    ingress.start(SHARD_WORKERS)
+    asyncio.create_task(ingress.supervise(SHARD_SUPERVISE_INTERVAL))
+
+    await app.start_webapp(webhook_handler=ingress.handle_webhook)
+    app.start_background_services()
+
+    allowed_updates = app.dp.resolve_used_update_types()
+    try:
+        if BOT_MODE == 'webhook':
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=allowed_updates,
+                max_connections=min(WEBHOOK_MAX_CONCURRENCY, 100)
+            )
+            logger.info(f"Sharded bot started in webhook mode at {WEBHOOK_PATH}")
+            await asyncio.Event().wait()
+        else:
+            logger.info("Sharded bot started in polling mode")
+            await ingress.poll(allowed_updates)
+    finally:
+        await ingress.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,8 +1,10 @@
 """
 Конфигурационный файл бота
 """
+import hashlib
 import os
 from dotenv import load_dotenv
+from currency import parse_rates
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -20,19 +22,93 @@ DB_NAME = os.getenv('DB_NAME', 'subscription_bot')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASSWORD = os.getenv('DB_PASSWORD', 'postgres')
 
+# Пул подключений к PostgreSQL
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT', '5'))  # секунды
+
+# Очередь блокирующих вызовов БД (защита event loop от перегрузки)
+DB_DISPATCH_MAX_QUEUE = int(os.getenv('DB_DISPATCH_MAX_QUEUE', '100'))
+DB_DISPATCH_QUEUE_TIMEOUT = float(os.getenv('DB_DISPATCH_QUEUE_TIMEOUT', '2'))  # секунды
+DB_SLOW_CALL_MS = float(os.getenv('DB_SLOW_CALL_MS', '500'))
+
+# Кэш данных пользователя (язык, тема, уведомления, Premium)
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '300'))  # секунды
+
+# Дневная история статистики для админ-панели
+STATS_ROLLUP_INTERVAL = int(os.getenv('STATS_ROLLUP_INTERVAL', '3600'))  # секунды между попытками закрыть прошедшие дни
+STATS_HISTORY_DAYS = int(os.getenv('STATS_HISTORY_DAYS', '7'))
+
+# Курсы валют: базовая валюта таблицы fx_rates, курсы по умолчанию
+# (единиц валюты за единицу базовой) и период перечитывания таблицы
+FX_BASE_CURRENCY = os.getenv('FX_BASE_CURRENCY', 'USD')
+FX_DEFAULT_RATES = parse_rates(os.getenv('FX_DEFAULT_RATES', 'EUR:0.92,RUB:92'))
+FX_REFRESH_INTERVAL = int(os.getenv('FX_REFRESH_INTERVAL', '3600'))  # секунды
+
+# Календарь списаний: горизонт таблицы upcoming_charges и обслуживание
+RENEWAL_HORIZON_DAYS = int(os.getenv('RENEWAL_HORIZON_DAYS', '400'))
+RENEWAL_JOB_INTERVAL = int(os.getenv('RENEWAL_JOB_INTERVAL', '3600'))  # секунды
+RENEWAL_BATCH_SIZE = int(os.getenv('RENEWAL_BATCH_SIZE', '1000'))
+
+# Хранилище состояний FSM: 'memory', 'postgres' (UNLOGGED-таблица в основной БД)
+# или 'redis' (любой сервер с протоколом Redis). Состояния старше FSM_TTL удаляются
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'postgres').lower()
+FSM_REDIS_URL = os.getenv('FSM_REDIS_URL', 'redis://localhost:6379/0')
+FSM_TTL = int(os.getenv('FSM_TTL', '86400'))  # секунды
+FSM_CLEANUP_INTERVAL = int(os.getenv('FSM_CLEANUP_INTERVAL', '3600'))  # секунды
+
 # ID администраторов
 ADMIN_IDS = [int(id) for id in os.getenv('ADMIN_IDS', '').split(',') if id]
 
 # Настройки веб-сервера
 WEB_HOST = os.getenv('WEB_HOST', '0.0.0.0')
 WEB_PORT = int(os.getenv('WEB_PORT', '8080'))
+# Каталог Mini App (index.html и static/) и пороги сжатия: статика сжимается
+# заранее при запуске, JSON-ответы API — на лету
+WEBAPP_DIR = os.getenv('WEBAPP_DIR', 'webapp')
+STATIC_COMPRESS_MIN_SIZE = int(os.getenv('STATIC_COMPRESS_MIN_SIZE', '512'))
+API_COMPRESS_MIN_SIZE = int(os.getenv('API_COMPRESS_MIN_SIZE', '1024'))
+
+# Получение апдейтов: 'polling' или 'webhook'. В режиме webhook обработчик
+# Telegram монтируется в тот же aiohttp-сервер, что и API Web App
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', WEBAPP_URL)  # публичный адрес, на который Telegram шлет апдейты
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; по умолчанию выводится
+# из токена, чтобы все реплики проверяли один и тот же секрет
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv('WEBHOOK_MAX_CONCURRENCY', '50'))  # одновременно обрабатываемых апдейтов
+
+# Шардированный запуск (cluster.py): число процессов-обработчиков, точек
+# на кольце на процесс, размер очереди процесса и период проверки процессов
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', str(os.cpu_count() or 2)))
+SHARD_VNODES = int(os.getenv('SHARD_VNODES', '128'))
+SHARD_QUEUE_SIZE = int(os.getenv('SHARD_QUEUE_SIZE', '1000'))
+SHARD_SUPERVISE_INTERVAL = float(os.getenv('SHARD_SUPERVISE_INTERVAL', '1'))  # секунды
 
 # Настройки уведомлений
-NOTIFICATION_CHECK_INTERVAL = int(os.getenv('NOTIFICATION_CHECK_INTERVAL', '300'))  # 5 минут
+NOTIFICATION_CHECK_INTERVAL = int(os.getenv('NOTIFICATION_CHECK_INTERVAL', '300'))  # максимальный сон планировщика, 5 минут
+NOTIFICATION_LISTEN = os.getenv('NOTIFICATION_LISTEN', 'true').lower() == 'true'  # пробуждение через LISTEN/NOTIFY
+NOTIFICATION_CHANNEL = os.getenv('NOTIFICATION_CHANNEL', 'notifications_scheduled')
+NOTIFICATION_GLOBAL_RATE = float(os.getenv('NOTIFICATION_GLOBAL_RATE', '25'))  # сообщений в секунду на процесс (лимит бота делится между процессами)
+NOTIFICATION_PER_CHAT_INTERVAL = float(os.getenv('NOTIFICATION_PER_CHAT_INTERVAL', '1'))  # секунд между сообщениями в чат
+NOTIFICATION_MAX_IN_FLIGHT = int(os.getenv('NOTIFICATION_MAX_IN_FLIGHT', '20'))
+NOTIFICATION_BATCH_SIZE = int(os.getenv('NOTIFICATION_BATCH_SIZE', '500'))  # размер страницы выборки и пачки отправки
+NOTIFICATION_MAX_RETRIES = int(os.getenv('NOTIFICATION_MAX_RETRIES', '3'))
+NOTIFICATION_LEASE_SECONDS = int(os.getenv('NOTIFICATION_LEASE_SECONDS', '300'))  # аренда пачки воркером
+# Пайплайн рассылки: число процессов-отправителей (0 — отправка в процессе бота),
+# размер пачки подтверждений и максимум арендованных, но не отправленных уведомлений
+NOTIFICATION_PIPELINE_WORKERS = int(os.getenv('NOTIFICATION_PIPELINE_WORKERS', '0'))
+NOTIFICATION_ACK_BATCH = int(os.getenv('NOTIFICATION_ACK_BATCH', '500'))
+NOTIFICATION_PIPELINE_MAX_PENDING = int(os.getenv('NOTIFICATION_PIPELINE_MAX_PENDING', '5000'))
 
 # Лимиты для бесплатной версии
 FREE_SUBSCRIPTION_LIMIT = int(os.getenv('FREE_SUBSCRIPTION_LIMIT', '5'))
 
+# Максимум операций в одном запросе /api/subscriptions/batch
+SUBSCRIPTION_BATCH_MAX_OPS = int(os.getenv('SUBSCRIPTION_BATCH_MAX_OPS', '500'))
+
 # Настройки Premium
 PREMIUM_PRICE_MONTHLY = float(os.getenv('PREMIUM_PRICE_MONTHLY', '2.99'))
 PREMIUM_TRIAL_DAYS = int(os.getenv('PREMIUM_TRIAL_DAYS', '7'))
@@ -0,0 +1,163 @@
+"""
+Расчет расходов на подписки
+Единые правила приведения цены к месяцу для статистики бота, Premium-аналитики
+и Web App. Данные обрабатываются по колонкам, сгруппированным по периоду оплаты:
+множитель ищется один раз на группу, а не на каждую подписку.
+Модуль не зависит от конфигурации бота и используется обоими ботами
+"""
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal
+from fractions import Fraction
+from typing import Dict, Iterable, List, Optional, Sequence
+
+# Доля цены, приходящаяся на месяц. Неизвестный период считается месячным
+CYCLE_MONTHLY_FACTORS = {
+    'weekly': Fraction(52, 12),
+    'monthly': Fraction(1),
+    'quarterly': Fraction(1, 3),
+    'yearly': Fraction(1, 12),
+}
+
+# Шаг между списаниями: (месяцев, дней)
+CYCLE_STEPS = {
+    'weekly': (0, 7),
+    'monthly': (1, 0),
+    'quarterly': (3, 0),
+    'yearly': (12, 0),
+}
+
+DEFAULT_CYCLE = 'monthly'
+
+
+def monthly_factor(cycle: Optional[str]) -> Fraction:
+    return CYCLE_MONTHLY_FACTORS.get(cycle, CYCLE_MONTHLY_FACTORS[DEFAULT_CYCLE])
+
+
+def monthly_cost_decimal(price, cycle: Optional[str], places: int = 4) -> Decimal:
+    """Месячная стоимость одной подписки в Decimal, округленная как NUMERIC(_, places)"""
+    factor = monthly_factor(cycle)
+    value = Decimal(price) * factor.numerator / factor.denominator
+    return value.quantize(Decimal(1).scaleb(-places))
+
+
+def monthly_cost_sql(price: str = 'price', cycle: str = 'billing_cycle', places: Optional[int] = 4) -> str:
+    """SQL-выражение месячной стоимости с теми же множителями, что и в Python"""
+    branches = []
+    for name, factor in CYCLE_MONTHLY_FACTORS.items():
+        if factor == 1:
+            expr = price
+        elif factor.numerator == 1:
+            expr = f"{price} / {factor.denominator}"
+        else:
+            expr = f"{price} * {factor.numerator} / {factor.denominator}"
+        branches.append(f"WHEN {cycle} = '{name}' THEN {expr}")
+
+    case = f"CASE {' '.join(branches)} ELSE {price} END"
+    return f"ROUND({case}, {places})" if places is not None else case
+
+
+def add_months(day: date, months: int, day_of_month: Optional[int] = None) -> date:
+    """
+    Сдвинуть дату на months месяцев. Число берется из day_of_month
+    (по умолчанию — число day); если в месяце его нет, берется последний день
+    """
+    month_index = day.month - 1 + months
+    year, month = day.year + month_index // 12, month_index % 12 + 1
+    if month == 12:
+        last_day = 31
+    else:
+        last_day = (date(year, month + 1, 1) - timedelta(days=1)).day
+    return date(year, month, min(day_of_month or day.day, last_day))
+
+
+class CostColumns:
+    """Подписки в колоночном виде: по списку на каждое поле"""
+
+    __slots__ = ('prices', 'cycles', 'currencies', 'categories')
+
+    def __init__(self, prices: Sequence[float], cycles: Sequence[str],
+                 currencies: Optional[Sequence[str]] = None,
+                 categories: Optional[Sequence[Optional[str]]] = None):
+        size = len(prices)
+        self.prices = [float(p) for p in prices]
+        self.cycles = list(cycles)
+        self.currencies = list(currencies) if currencies is not None else [None] * size
+        self.categories = list(categories) if categories is not None else [None] * size
+
+    @classmethod
+    def from_rows(cls, rows: Iterable, price='price', cycle='billing_cycle', currency='currency',
+                  category='category') -> 'CostColumns':
+        """
+        Собрать колонки из строк БД. Поля задаются ключами словаря или индексами
+        кортежа; None вместо имени поля означает, что колонки нет
+        (cycle=None — все подписки месячные)
+        """
+        rows = list(rows)
+
+        def column(key, default=None):
+            if key is None:
+                return [default] * len(rows)
+            return [row[key] for row in rows]
+
+        return cls(
+            column(price),
+            column(cycle, DEFAULT_CYCLE),
+            column(currency),
+            column(category),
+        )
+
+    def __len__(self) -> int:
+        return len(self.prices)
+
+    def groups_by_cycle(self) -> Dict[str, List[int]]:
+        """Индексы подписок, сгруппированные по периоду оплаты"""
+        groups = defaultdict(list)
+        for i, cycle in enumerate(self.cycles):
+            groups[cycle].append(i)
+        return groups
+
+
+def monthly_costs(columns: CostColumns) -> List[float]:
+    """Месячная стоимость каждой подписки"""
+    result = [0.0] * len(columns)
+    prices = columns.prices
+    for cycle, indexes in columns.groups_by_cycle().items():
+        factor = float(monthly_factor(cycle))
+        for i in indexes:
+            result[i] = prices[i] * factor
+    return result
+
+
+def summarize(columns: CostColumns, rates: Optional[Dict[Optional[str], Optional[float]]] = None) -> Dict:
+    """
+    Месячные и годовые расходы, разбивка по категориям и валютам.
+    rates — множители пересчета в валюту отображения по валютам (см. FXRates.factors):
+    суммы пересчитываются одним умножением на валюту, валюты без курса
+    попадают в unconverted и в итоги не входят
+    """
+    costs = monthly_costs(columns)
+    by_currency = defaultdict(float)
+    for cost, currency in zip(costs, columns.currencies):
+        by_currency[currency] += cost
+
+    unconverted = {}
+    if rates is not None:
+        factors = [rates.get(currency) for currency in columns.currencies]
+        unconverted = {c: amount for c, amount in by_currency.items() if rates.get(c) is None}
+        costs = [cost * factor if factor is not None else 0.0 for cost, factor in zip(costs, factors)]
+
+    by_category = defaultdict(float)
+    for cost, category in zip(costs, columns.categories):
+        by_category[category] += cost
+
+    monthly_total = sum(costs)
+    return {
+        'count': len(costs),
+        'monthly_cost': monthly_total,
+        'yearly_cost': monthly_total * 12,
+        'by_category': dict(sorted(by_category.items(), key=lambda item: item[1], reverse=True)),
+        'by_currency': dict(by_currency),
+        'unconverted': unconverted,
+    }
+
@@ -0,0 +1,122 @@
+"""
+Пересчет сумм между валютами
+Курсы хранятся в таблице fx_rates и загружаются в память целиком;
+поиск курса на дату — одно обращение к словарю.
+Модуль не зависит от конфигурации бота и используется обоими ботами
+"""
+import threading
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+
+def parse_rates(value: str) -> Dict[str, float]:
+    """Разобрать строку вида 'EUR:0.92,RUB:92' из настроек"""
+    rates = {}
+    for item in value.split(','):
+        if item.strip():
+            currency, rate = item.split(':')
+            rates[currency.strip().upper()] = float(rate)
+    return rates
+
+
+def _as_date(value) -> date:
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+
+class FXRates:
+    """
+    Курсы валют к базовой валюте: rate — сколько единиц валюты стоит
+    одна единица base. Пропуски (выходные) заполняются последним известным
+    курсом при загрузке; даты вне диапазона получают крайний курс
+    """
+
+    def __init__(self, base: str = 'USD', loader: Optional[Callable[[], Iterable]] = None):
+        self.base = base
+        self.loader = loader
+        self.loaded_at: Optional[datetime] = None
+        # (курсы по (валюта, дата), (первая дата, первый курс, последняя дата, последний курс))
+        self._state: Tuple[Dict, Dict] = ({}, {})
+        self._lock = threading.Lock()
+
+    def load(self, rows: Iterable[Tuple[str, object, float]]):
+        """Заменить все курсы строками (currency, day, rate)"""
+        series: Dict[str, Dict[date, float]] = {}
+        for currency, day, rate in rows:
+            series.setdefault(currency, {})[_as_date(day)] = float(rate)
+
+        by_day, bounds = {}, {}
+        for currency, points in series.items():
+            days = sorted(points)
+            rate = points[days[0]]
+            day = days[0]
+            while day <= days[-1]:
+                rate = points.get(day, rate)
+                by_day[(currency, day)] = rate
+                day += timedelta(days=1)
+            bounds[currency] = (days[0], points[days[0]], days[-1], points[days[-1]])
+
+        # Подмена одной ссылкой: читатели видят либо старые, либо новые курсы
+        self._state = (by_day, bounds)
+        self.loaded_at = datetime.now()
+
+    def refresh(self):
+        """Перечитать курсы через loader (хук обновления)"""
+        if self.loader is None:
+            return
+        with self._lock:
+            self.load(self.loader())
+
+    def currencies(self):
+        return set(self._state[1]) | {self.base}
+
+    def rate(self, currency: Optional[str], day: Optional[date] = None) -> Optional[float]:
+        """Единиц currency за одну единицу base на дату day (по умолчанию последний курс)"""
+        if currency is None or currency == self.base:
+            return 1.0
+
+        by_day, bounds = self._state
+        bound = bounds.get(currency)
+        if bound is None:
+            return None
+        first_day, first_rate, last_day, last_rate = bound
+        if day is None or day >= last_day:
+            return last_rate
+        if day <= first_day:
+            return first_rate
+        return by_day[(currency, day)]
+
+    def factor(self, source: Optional[str], target: str, day: Optional[date] = None) -> Optional[float]:
+        """Множитель пересчета суммы из source в target; None, если курса нет"""
+        if source == target:
+            return 1.0
+        source_rate, target_rate = self.rate(source, day), self.rate(target, day)
+        if source_rate is None or target_rate is None:
+            return None
+        return target_rate / source_rate
+
+    def factors(self, currencies: Iterable[Optional[str]], target: str,
+                day: Optional[date] = None) -> Dict[Optional[str], Optional[float]]:
+        """Множители для набора валют: один поиск на валюту, а не на строку"""
+        return {currency: self.factor(currency, target, day) for currency in set(currencies)}
+
+    def convert(self, amount: float, source: Optional[str], target: str, day: Optional[date] = None) -> Optional[float]:
+        factor = self.factor(source, target, day)
+        return float(amount) * factor if factor is not None else None
+
+    def convert_totals(self, by_currency: Dict[Optional[str], float], target: str,
+                       day: Optional[date] = None) -> Tuple[float, Dict[Optional[str], float]]:
+        """
+        Сложить суммы по валютам в target. Возвращает итог и суммы
+        в валютах без курса (они в итог не входят)
+        """
+        total, unconverted = 0.0, {}
+        for currency, factor in self.factors(by_currency, target, day).items():
+            if factor is None:
+                unconverted[currency] = float(by_currency[currency])
+            else:
+                total += float(by_currency[currency]) * factor
+        return total, unconverted
@@ -2,19 +2,229 @@
 Модуль базы данных для бота управления подписками
 Использует PostgreSQL для хранения данных
 """
+import functools
+import random
+import threading
+import time
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
 from psycopg2.extras import RealDictCursor
-from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from psycopg2.pool import ThreadedConnectionPool
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 import logging
+from db_dispatcher import DBDispatcher
+from cache import TTLCache
+from cost_engine import CostColumns, monthly_cost_decimal, monthly_cost_sql
+from currency import FXRates
+from renewals import expand_charges, next_occurrence_sql
+from serialization import dumps_str
 
 logger = logging.getLogger(__name__)
 
+# Версионированный набор индексов. При любом изменении списка нужно
+# увеличить INDEX_SET_VERSION: init_db удалит устаревшие индексы и создаст новые
+INDEX_SET_VERSION = 5
+
+INDEXES = [
+    # Продления и статистика пользователя: фильтр (user_id, is_active, next_payment),
+    # INCLUDE позволяет считать суммы по категориям index-only scan'ом
+    ("idx_subscriptions_user_active_next", """
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_user_active_next
+        ON subscriptions(user_id, is_active, next_payment)
+        INCLUDE (price, billing_cycle, currency, category, name)
+    """),
+    ("idx_upcoming_charges_user_date", """
+        CREATE INDEX IF NOT EXISTS idx_upcoming_charges_user_date
+        ON upcoming_charges(user_id, charge_date)
+        INCLUDE (amount, currency)
+    """),
+    # Удаления подписок после курсора синхронизации (/api/subscriptions/changes)
+    ("idx_subscription_history_deletes", """
+        CREATE INDEX IF NOT EXISTS idx_subscription_history_deletes
+        ON subscription_history(user_id, data_version)
+        WHERE action = 'delete'
+    """),
+    # Очистка состояний FSM по TTL
+    ("idx_fsm_storage_updated", """
+        CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated
+        ON fsm_storage(updated_at)
+    """),
+    ("idx_subscriptions_next_payment", """
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_next_payment
+        ON subscriptions(next_payment)
+    """),
+    # Частичный индекс только по неотправленным уведомлениям: остается
+    # маленьким, сколько бы отправленных строк ни накопилось
+    ("idx_notifications_pending", """
+        CREATE INDEX IF NOT EXISTS idx_notifications_pending
+        ON notifications(scheduled_date, id)
+        WHERE is_sent = FALSE
+    """),
+]
+
+# Индексы предыдущих версий, которые перекрываются новыми
+DROPPED_INDEXES = [
+    "idx_subscriptions_user_id",      # префикс idx_subscriptions_user_active_next
+    "idx_notifications_scheduled",    # заменен частичным idx_notifications_pending
+]
+
+# Версия материализованных агрегатов (user_spending_summary, user_category_spending,
+# stats_counters, daily_counters). При изменении формулы агрегатов нужно увеличить
+# версию: init_db пересчитает их из subscriptions и users
+SPENDING_SUMMARY_VERSION = 3
+
+# Приведение цены к месяцу по правилам cost_engine. Округление до 4 знаков
+# совпадает с NUMERIC(14, 4) в таблицах агрегатов, поэтому добавление
+# и удаление подписки взаимно гасятся
+MONTHLY_COST_SQL = monthly_cost_sql('price', 'billing_cycle', places=4)
+
+# Поля подписки, нужные агрегатам и календарю списаний (RETURNING после записи)
+SUBSCRIPTION_TOTALS_COLUMNS = "id, user_id, price, currency, category, billing_cycle, next_payment, billing_day, is_active"
+
+# Поля, которые меняет обновление подписки, и ограничения, проверяемые
+# в пакетных операциях до записи: ошибка приведения в SQL отменила бы весь пакет
+SUBSCRIPTION_UPDATE_FIELDS = ('name', 'description', 'price', 'currency', 'category', 'billing_cycle',
+                              'next_payment', 'trial_end_date', 'icon', 'color', 'website_url', 'notes')
+SUBSCRIPTION_REQUIRED_FIELDS = ('name', 'price', 'start_date', 'next_payment')
+SUBSCRIPTION_DATE_FIELDS = ('start_date', 'next_payment', 'trial_end_date')
+SUBSCRIPTION_TEXT_FIELDS = ('name', 'description', 'currency', 'category', 'billing_cycle',
+                            'icon', 'color', 'website_url', 'notes')
+SUBSCRIPTION_VARCHAR_LIMITS = {'name': 255, 'currency': 10, 'category': 100, 'billing_cycle': 20,
+                               'icon': 255, 'color': 20}
+
+# Ближайшая будущая дата списания для просроченной подписки (alias s)
+NEXT_PAYMENT_SQL = next_occurrence_sql('s.next_payment', 's.billing_cycle', 'CURRENT_DATE', 's.billing_day')
+
+# Глобальные счетчики разбиты на слоты: параллельные транзакции обновляют
+# разные строки и не выстраиваются в очередь за блокировкой одной строки
+COUNTER_SLOTS = 16
+
+
+class PoolTimeoutError(Exception):
+    """Не удалось получить подключение из пула за отведенное время"""
+
+
+class ConnectionPool:
+    """Пул подключений к PostgreSQL с таймаутом ожидания и метриками"""
+
+    def __init__(self, connection_params: Dict, min_size: int, max_size: int, acquire_timeout: float):
+        self.acquire_timeout = acquire_timeout
+        self.max_size = max_size
+        self._pool = ThreadedConnectionPool(min_size, max_size, **connection_params)
+        # ThreadedConnectionPool не умеет ждать освобождения подключения,
+        # поэтому ожидание ограничиваем семафором на max_size слотов
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._acquired = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    @contextmanager
+    def connection(self):
+        """Взять подключение из пула; commit при успехе, rollback при ошибке"""
+        started = time.perf_counter()
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            with self._lock:
+                self._timeouts += 1
+            raise PoolTimeoutError(
+                f"No database connection available within {self.acquire_timeout}s"
+            )
+
+        waited = time.perf_counter() - started
+        with self._lock:
+            self._in_use += 1
+            self._acquired += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+        try:
+            conn = self._pool.getconn()
+        except Exception:
+            self._release_slot()
+            raise
+
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self._pool.putconn(conn, close=bool(conn.closed))
+            self._release_slot()
+
+    def _release_slot(self):
+        with self._lock:
+            self._in_use -= 1
+        self._slots.release()
+
+    def stats(self) -> Dict:
+        """Метрики пула: занятые подключения, ожидание и таймауты"""
+        with self._lock:
+            return {
+                'max_size': self.max_size,
+                'in_use': self._in_use,
+                'acquired': self._acquired,
+                'timeouts': self._timeouts,
+                'avg_wait_ms': self._wait_total / self._acquired * 1000 if self._acquired else 0.0,
+                'max_wait_ms': self._wait_max * 1000,
+            }
+
+    def close(self):
+        """Закрыть все подключения пула"""
+        self._pool.closeall()
+
+
+def _valid_subscription_data(data, required: bool) -> bool:
+    """
+    Данные подписки для пакетной операции: required — добавление (нужны все
+    обязательные поля), иначе обновление (обязательные поля нельзя обнулить)
+    """
+    if not isinstance(data, dict):
+        return False
+    for field in SUBSCRIPTION_REQUIRED_FIELDS:
+        if (required or field in data) and data.get(field) in (None, ''):
+            return False
+    # Объект или список из JSON psycopg2 не адаптирует, и ошибка отменила бы весь пакет
+    for field in SUBSCRIPTION_TEXT_FIELDS + SUBSCRIPTION_DATE_FIELDS:
+        if data.get(field) is not None and not isinstance(data[field], str):
+            return False
+    price = data.get('price')
+    if price is not None and (isinstance(price, bool) or not isinstance(price, (int, float, str))):
+        return False
+    for field, limit in SUBSCRIPTION_VARCHAR_LIMITS.items():
+        if data.get(field) is not None and len(data[field]) > limit:
+            return False
+    try:
+        if price is not None and not 0 <= Decimal(str(price)) < 10 ** 8:
+            return False
+        # Строка проверяется целиком: хвост после даты не прошел бы приведение ::date
+        for field in SUBSCRIPTION_DATE_FIELDS:
+            if data.get(field):
+                datetime.strptime(data[field], '%Y-%m-%d')
+    except (ArithmeticError, ValueError):
+        return False
+    return True
+
+
 class Database:
     def __init__(self):
-        """Инициализация подключения к БД"""
-        from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
-        
+        """Инициализация пула подключений к БД"""
+        from config import (
+            DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD,
+            DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_ACQUIRE_TIMEOUT,
+            USER_CACHE_SIZE, USER_CACHE_TTL, NOTIFICATION_CHANNEL,
+            FX_BASE_CURRENCY, FX_DEFAULT_RATES, RENEWAL_HORIZON_DAYS, FREE_SUBSCRIPTION_LIMIT
+        )
+
         self.connection_params = {
             'host': DB_HOST,
             'port': DB_PORT,
@@ -22,512 +232,1699 @@ class Database:
             'user': DB_USER,
             'password': DB_PASSWORD
         }
-    
-    def get_connection(self):
-        """Получить подключение к базе данных"""
-        return psycopg2.connect(**self.connection_params)
-    
+        self.pool = ConnectionPool(
+            self.connection_params,
+            DB_POOL_MIN_SIZE,
+            DB_POOL_MAX_SIZE,
+            DB_POOL_ACQUIRE_TIMEOUT
+        )
+        # Строки users читаются почти на каждом апдейте, а меняются редко;
+        # все методы, изменяющие пользователя, сбрасывают его запись
+        self.user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self.notification_channel = NOTIFICATION_CHANNEL
+        # Курсы валют читаются из fx_rates один раз (init_db) и по refresh_fx_rates
+        self.fx = FXRates(FX_BASE_CURRENCY, loader=self._load_fx_rows)
+        self.fx_default_rates = FX_DEFAULT_RATES
+        self.renewal_horizon_days = RENEWAL_HORIZON_DAYS
+        self.free_subscription_limit = FREE_SUBSCRIPTION_LIMIT
+        self._charges_refreshed_on: Optional[date] = None
+
+    def connection(self):
+        """Получить подключение к базе данных из пула"""
+        return self.pool.connection()
+
+    def pool_stats(self) -> Dict:
+        """Метрики пула подключений"""
+        return self.pool.stats()
+
+    def cache_stats(self) -> Dict:
+        """Счетчики кэша пользователей"""
+        return self.user_cache.stats()
+
+    def close(self):
+        """Закрыть пул подключений"""
+        self.pool.close()
+
     def init_db(self):
         """Инициализация таблиц базы данных"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        
-        # Таблица пользователей
+        with self.connection() as conn, conn.cursor() as cur:
+            # Таблица пользователей
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id BIGINT PRIMARY KEY,
+                    username VARCHAR(255),
+                    full_name VARCHAR(255),
+                    language VARCHAR(10) DEFAULT 'ru',
+                    theme VARCHAR(20) DEFAULT 'light',
+                    notifications_enabled BOOLEAN DEFAULT TRUE,
+                    notification_days INTEGER DEFAULT 3,
+                    is_premium BOOLEAN DEFAULT FALSE,
+                    premium_until TIMESTAMP,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            # Валюта, в которой пользователь видит итоги
+            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS display_currency VARCHAR(10) DEFAULT 'USD'")
+
+            # Версия данных пользователя (строка users и его подписки): увеличивается
+            # при каждой записи, по ней /api/user отвечает 304 Not Modified
+            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS data_version BIGINT NOT NULL DEFAULT 1")
+
+            # Таблица подписок
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS subscriptions (
+                    id SERIAL PRIMARY KEY,
+                    user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+                    name VARCHAR(255) NOT NULL,
+                    description TEXT,
+                    price DECIMAL(10, 2) NOT NULL,
+                    currency VARCHAR(10) DEFAULT 'USD',
+                    category VARCHAR(100),
+                    billing_cycle VARCHAR(20) DEFAULT 'monthly',
+                    start_date DATE NOT NULL,
+                    next_payment DATE NOT NULL,
+                    trial_end_date DATE,
+                    is_active BOOLEAN DEFAULT TRUE,
+                    icon VARCHAR(255),
+                    color VARCHAR(20),
+                    website_url TEXT,
+                    notes TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            # Таблица категорий
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS categories (
+                    id SERIAL PRIMARY KEY,
+                    name VARCHAR(100) UNIQUE NOT NULL,
+                    icon VARCHAR(50),
+                    color VARCHAR(20),
+                    translation_ru VARCHAR(100),
+                    translation_en VARCHAR(100)
+                )
+            """)
+
+            # Таблица уведомлений
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS notifications (
+                    id SERIAL PRIMARY KEY,
+                    user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+                    subscription_id INTEGER REFERENCES subscriptions(id) ON DELETE CASCADE,
+                    notification_type VARCHAR(50),
+                    scheduled_date TIMESTAMP NOT NULL,
+                    sent_at TIMESTAMP,
+                    is_sent BOOLEAN DEFAULT FALSE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            # Аренда уведомлений воркерами: claimed_by владеет строкой до lease_until
+            cur.execute("ALTER TABLE notifications ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(100)")
+            cur.execute("ALTER TABLE notifications ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP")
+
+            # Таблица истории изменений (для Premium)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS subscription_history (
+                    id SERIAL PRIMARY KEY,
+                    subscription_id INTEGER,
+                    user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+                    action VARCHAR(50),
+                    old_data JSONB,
+                    new_data JSONB,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            # Журнал служит и журналом удалений для синхронизации Mini App, поэтому
+            # записи переживают подписку (внешний ключ с каскадом снимается).
+            # data_version — версия данных пользователя, в которой сделана запись
+            cur.execute("""
+                ALTER TABLE subscription_history
+                DROP CONSTRAINT IF EXISTS subscription_history_subscription_id_fkey
+            """)
+            cur.execute("ALTER TABLE subscription_history ADD COLUMN IF NOT EXISTS data_version BIGINT")
+
+            # Версия данных пользователя, в которой строка подписки менялась последний раз
+            cur.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS row_version BIGINT NOT NULL DEFAULT 0")
+
+            # Число месяца списания: next_payment переносится с обрезкой до конца
+            # месяца, а billing_day — нет, поэтому подписка на 31-е после февраля
+            # снова списывается 31-го. Строки, уже съехавшие с конца месяца,
+            # восстанавливаются по числу start_date
+            cur.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS billing_day SMALLINT")
+            cur.execute("""
+                UPDATE subscriptions
+                SET billing_day = CASE
+                    WHEN billing_cycle <> 'weekly'
+                         AND EXTRACT(DAY FROM next_payment) >= 28
+                         AND EXTRACT(DAY FROM start_date) > EXTRACT(DAY FROM next_payment)
+                    THEN EXTRACT(DAY FROM start_date)
+                    ELSE EXTRACT(DAY FROM next_payment)
+                END
+                WHERE billing_day IS NULL
+            """)
+
+            # Материализованные агрегаты для статистики и админ-панели.
+            # Обновляются инкрементально в той же транзакции, что и подписки
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS user_spending_summary (
+                    user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+                    total_subscriptions INTEGER NOT NULL DEFAULT 0,
+                    active_subscriptions INTEGER NOT NULL DEFAULT 0,
+                    monthly_cost NUMERIC(14, 4) NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            # Категория без названия хранится как '' (NULL не может входить в PRIMARY KEY)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS user_category_spending (
+                    user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+                    category VARCHAR(100) NOT NULL,
+                    currency VARCHAR(10) NOT NULL,
+                    active_subscriptions INTEGER NOT NULL DEFAULT 0,
+                    monthly_cost NUMERIC(14, 4) NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, category, currency)
+                )
+            """)
+
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS stats_counters (
+                    name VARCHAR(50),
+                    slot SMALLINT,
+                    value NUMERIC(16, 4) NOT NULL DEFAULT 0,
+                    PRIMARY KEY (name, slot)
+                )
+            """)
+
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS daily_counters (
+                    day DATE,
+                    name VARCHAR(50),
+                    slot SMALLINT,
+                    value BIGINT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, name, slot)
+                )
+            """)
+
+            # Календарь списаний на RENEWAL_HORIZON_DAYS вперед: календарь и прогноз
+            # расходов читаются диапазоном по (user_id, charge_date)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS upcoming_charges (
+                    subscription_id INTEGER REFERENCES subscriptions(id) ON DELETE CASCADE,
+                    user_id BIGINT NOT NULL,
+                    charge_date DATE NOT NULL,
+                    amount DECIMAL(10, 2) NOT NULL,
+                    currency VARCHAR(10),
+                    PRIMARY KEY (subscription_id, charge_date)
+                )
+            """)
+
+            # Курсы валют: rate единиц currency за единицу базовой валюты
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS fx_rates (
+                    currency VARCHAR(10),
+                    day DATE,
+                    rate NUMERIC(18, 8) NOT NULL,
+                    PRIMARY KEY (currency, day)
+                )
+            """)
+
+            # Курсы по умолчанию из настроек для валют, по которым еще нет данных
+            for currency, rate in self.fx_default_rates.items():
+                cur.execute("""
+                    INSERT INTO fx_rates (currency, day, rate)
+                    SELECT %s, CURRENT_DATE, %s
+                    WHERE NOT EXISTS (SELECT 1 FROM fx_rates WHERE currency = %s)
+                """, (currency, rate, currency))
+
+            # Дневная история для админ-панели (только добавление строк).
+            # Срезы total_*/active_* и MRR снимаются для дня, закрытого последним
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS daily_stats (
+                    day DATE PRIMARY KEY,
+                    new_users INTEGER NOT NULL DEFAULT 0,
+                    new_subscriptions INTEGER NOT NULL DEFAULT 0,
+                    premium_conversions INTEGER NOT NULL DEFAULT 0,
+                    total_users INTEGER,
+                    premium_users INTEGER,
+                    active_subscriptions INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS daily_mrr (
+                    day DATE,
+                    currency VARCHAR(10),
+                    mrr NUMERIC(16, 4) NOT NULL,
+                    active_subscriptions INTEGER NOT NULL,
+                    PRIMARY KEY (day, currency)
+                )
+            """)
+
+            # Состояния FSM (PostgresStorage). UNLOGGED: запись без WAL, после
+            # аварийного падения сервера таблица очищается — для недописанных
+            # диалогов это допустимо, а при обычном перезапуске данные сохраняются
+            cur.execute("""
+                CREATE UNLOGGED TABLE IF NOT EXISTS fsm_storage (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data JSONB NOT NULL DEFAULT '{}',
+                    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            # Индексы для оптимизации
+            self._apply_index_set(cur)
+            self._apply_spending_summary(cur)
+
+            # Заполнение категорий по умолчанию
+            default_categories = [
+                ('Entertainment', '🎬', '#FF6B6B', 'Развлечения', 'Entertainment'),
+                ('Streaming', '📺', '#4ECDC4', 'Стриминг', 'Streaming'),
+                ('Music', '🎵', '#45B7D1', 'Музыка', 'Music'),
+                ('Gaming', '🎮', '#96CEB4', '#Игры', 'Gaming'),
+                ('Education', '📚', '#FFEAA7', 'Обучение', 'Education'),
+                ('Work', '💼', '#DFE6E9', 'Работа', 'Work'),
+                ('VPN', '🔒', '#A29BFE', 'VPN', 'VPN'),
+                ('Cloud Storage', '☁️', '#74B9FF', 'Облачное хранилище', 'Cloud Storage'),
+                ('News', '📰', '#FD79A8', 'Новости', 'News'),
+                ('Fitness', '💪', '#55EFC4', 'Фитнес', 'Fitness'),
+                ('Software', '💻', '#636E72', 'ПО', 'Software'),
+                ('Other', '📦', '#B2BEC3', 'Другое', 'Other')
+            ]
+
+            for cat in default_categories:
+                cur.execute("""
+                    INSERT INTO categories (name, icon, color, translation_ru, translation_en)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (name) DO NOTHING
+                """, cat)
+
+        self.refresh_fx_rates()
+        logger.info("Database initialized successfully")
+
+    # === СОСТОЯНИЯ FSM ===
+
+    def get_fsm_record(self, key: str, ttl: int) -> Optional[Tuple[Optional[str], Dict]]:
+        """Состояние и данные FSM по ключу; записи старше ttl секунд считаются удаленными"""
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT state, data FROM fsm_storage
+                WHERE key = %s
+                AND updated_at >= CURRENT_TIMESTAMP - make_interval(secs => %s)
+            """, (key, ttl))
+            row = cur.fetchone()
+
+        return (row[0], row[1]) if row else None
+
+    def save_fsm_records(self, records: List[Tuple[str, Optional[str], Dict]]):
+        """
+        Записать пачку (key, state, data) одной транзакцией.
+        Пустые записи (без состояния и данных) удаляются
+        """
+        upserts = [(key, state, psycopg2.extras.Json(data, dumps=dumps_str)) for key, state, data in records if state or data]
+        deletes = [key for key, state, data in records if not (state or data)]
+
+        with self.connection() as conn, conn.cursor() as cur:
+            if upserts:
+                psycopg2.extras.execute_values(cur, """
+                    INSERT INTO fsm_storage (key, state, data)
+                    VALUES %s
+                    ON CONFLICT (key) DO UPDATE
+                    SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = CURRENT_TIMESTAMP
+                """, upserts)
+            if deletes:
+                cur.execute("DELETE FROM fsm_storage WHERE key = ANY(%s)", (deletes,))
+
+    def cleanup_fsm_records(self, ttl: int) -> int:
+        """Удалить состояния FSM, не менявшиеся дольше ttl секунд"""
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                DELETE FROM fsm_storage
+                WHERE updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+            """, (ttl,))
+            deleted = cur.rowcount
+
+        if deleted:
+            logger.info(f"Removed {deleted} expired FSM records")
+        return deleted
+
+    # === КУРСЫ ВАЛЮТ ===
+
+    def _load_fx_rows(self) -> List:
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT currency, day, rate FROM fx_rates")
+            return cur.fetchall()
+
+    def refresh_fx_rates(self):
+        """Перечитать таблицу курсов в память"""
+        self.fx.refresh()
+        logger.info(f"FX rates loaded for {len(self.fx.currencies())} currencies")
+
+    def set_fx_rates(self, rates: Dict[str, float], day=None):
+        """Сохранить курсы на дату (по умолчанию сегодня) и обновить таблицу в памяти"""
+        with self.connection() as conn, conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO fx_rates (currency, day, rate) VALUES %s
+                ON CONFLICT (currency, day) DO UPDATE SET rate = EXCLUDED.rate
+            """, [(currency, day, rate) for currency, rate in rates.items()],
+                template="(%s, COALESCE(%s, CURRENT_DATE), %s)")
+        self.refresh_fx_rates()
+
+    def _apply_index_set(self, cur):
+        """Привести индексы к версии INDEX_SET_VERSION"""
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username VARCHAR(255),
-                full_name VARCHAR(255),
-                language VARCHAR(10) DEFAULT 'ru',
-                theme VARCHAR(20) DEFAULT 'light',
-                notifications_enabled BOOLEAN DEFAULT TRUE,
-                notification_days INTEGER DEFAULT 3,
-                is_premium BOOLEAN DEFAULT FALSE,
-                premium_until TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            CREATE TABLE IF NOT EXISTS schema_versions (
+                component VARCHAR(50) PRIMARY KEY,
+                version INTEGER NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        
-        # Таблица подписок
+        cur.execute("SELECT version FROM schema_versions WHERE component = 'indexes'")
+        row = cur.fetchone()
+        if row and row[0] >= INDEX_SET_VERSION:
+            return
+
+        for name in DROPPED_INDEXES:
+            cur.execute(f"DROP INDEX IF EXISTS {name}")
+        for name, ddl in INDEXES:
+            cur.execute(ddl)
+
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
-                name VARCHAR(255) NOT NULL,
-                description TEXT,
-                price DECIMAL(10, 2) NOT NULL,
-                currency VARCHAR(10) DEFAULT 'USD',
-                category VARCHAR(100),
-                billing_cycle VARCHAR(20) DEFAULT 'monthly',
-                start_date DATE NOT NULL,
-                next_payment DATE NOT NULL,
-                trial_end_date DATE,
-                is_active BOOLEAN DEFAULT TRUE,
-                icon VARCHAR(255),
-                color VARCHAR(20),
-                website_url TEXT,
-                notes TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+            INSERT INTO schema_versions (component, version)
+            VALUES ('indexes', %s)
+            ON CONFLICT (component) DO UPDATE
+            SET version = EXCLUDED.version, applied_at = CURRENT_TIMESTAMP
+        """, (INDEX_SET_VERSION,))
+        logger.info(f"Index set upgraded to version {INDEX_SET_VERSION}")
+
+    def _apply_spending_summary(self, cur):
+        """Пересчитать агрегаты из исходных таблиц, если их версия устарела"""
+        cur.execute("SELECT version FROM schema_versions WHERE component = 'spending_summary'")
+        row = cur.fetchone()
+        if row and row[0] >= SPENDING_SUMMARY_VERSION:
+            return
+
+        self._rebuild_spending_summary(cur)
+        cur.execute("""
+            INSERT INTO schema_versions (component, version)
+            VALUES ('spending_summary', %s)
+            ON CONFLICT (component) DO UPDATE
+            SET version = EXCLUDED.version, applied_at = CURRENT_TIMESTAMP
+        """, (SPENDING_SUMMARY_VERSION,))
+        logger.info(f"Spending summary rebuilt at version {SPENDING_SUMMARY_VERSION}")
+
+    def _rebuild_spending_summary(self, cur):
+        """Полный пересчет агрегатов; таблицы блокируются до конца транзакции"""
+        cur.execute("LOCK TABLE users, subscriptions IN SHARE MODE")
+        cur.execute("TRUNCATE user_spending_summary, user_category_spending, stats_counters")
+        # История прошлых дней не пересчитывается, заменяются только сегодняшние счетчики
+        cur.execute("""
+            DELETE FROM daily_counters
+            WHERE day = CURRENT_DATE AND name IN ('new_users', 'new_subscriptions')
         """)
-        
-        # Таблица категорий
+
+        cur.execute(f"""
+            INSERT INTO user_spending_summary (user_id, total_subscriptions, active_subscriptions, monthly_cost)
+            SELECT
+                user_id,
+                COUNT(*),
+                COUNT(*) FILTER (WHERE is_active = TRUE),
+                COALESCE(SUM({MONTHLY_COST_SQL}) FILTER (WHERE is_active = TRUE), 0)
+            FROM subscriptions
+            GROUP BY user_id
+        """)
+
+        cur.execute(f"""
+            INSERT INTO user_category_spending (user_id, category, currency, active_subscriptions, monthly_cost)
+            SELECT user_id, COALESCE(category, ''), COALESCE(currency, ''), COUNT(*), SUM({MONTHLY_COST_SQL})
+            FROM subscriptions
+            WHERE is_active = TRUE
+            GROUP BY user_id, COALESCE(category, ''), COALESCE(currency, '')
+        """)
+
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS categories (
-                id SERIAL PRIMARY KEY,
-                name VARCHAR(100) UNIQUE NOT NULL,
-                icon VARCHAR(50),
-                color VARCHAR(20),
-                translation_ru VARCHAR(100),
-                translation_en VARCHAR(100)
-            )
+            INSERT INTO stats_counters (name, slot, value)
+            SELECT name, 0, value FROM (VALUES
+                ('total_users', (SELECT COUNT(*) FROM users)),
+                ('premium_users', (SELECT COUNT(*) FROM users WHERE is_premium = TRUE)),
+                ('total_subscriptions', (SELECT COUNT(*) FROM subscriptions)),
+                ('active_subscriptions', (SELECT COUNT(*) FROM subscriptions WHERE is_active = TRUE))
+            ) AS totals(name, value)
         """)
-        
-        # Таблица уведомлений
+
+        # Сумма активных подписок хранится отдельно по каждой валюте
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS notifications (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
-                subscription_id INTEGER REFERENCES subscriptions(id) ON DELETE CASCADE,
-                notification_type VARCHAR(50),
-                scheduled_date TIMESTAMP NOT NULL,
-                sent_at TIMESTAMP,
-                is_sent BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+            INSERT INTO stats_counters (name, slot, value)
+            SELECT 'revenue:' || COALESCE(currency, ''), 0, SUM(price)
+            FROM subscriptions
+            WHERE is_active = TRUE
+            GROUP BY COALESCE(currency, '')
         """)
-        
-        # Таблица истории изменений (для Premium)
+
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS subscription_history (
-                id SERIAL PRIMARY KEY,
-                subscription_id INTEGER REFERENCES subscriptions(id) ON DELETE CASCADE,
-                user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
-                action VARCHAR(50),
-                old_data JSONB,
-                new_data JSONB,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+            INSERT INTO daily_counters (day, name, slot, value)
+            SELECT CURRENT_DATE, name, 0, value FROM (VALUES
+                ('new_users', (SELECT COUNT(*) FROM users WHERE created_at >= CURRENT_DATE)),
+                ('new_subscriptions', (SELECT COUNT(*) FROM subscriptions WHERE created_at >= CURRENT_DATE))
+            ) AS today(name, value)
         """)
-        
-        # Индексы для оптимизации
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_user_id ON subscriptions(user_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_next_payment ON subscriptions(next_payment)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_notifications_scheduled ON notifications(scheduled_date, is_sent)")
-        
-        # Заполнение категорий по умолчанию
-        default_categories = [
-            ('Entertainment', '🎬', '#FF6B6B', 'Развлечения', 'Entertainment'),
-            ('Streaming', '📺', '#4ECDC4', 'Стриминг', 'Streaming'),
-            ('Music', '🎵', '#45B7D1', 'Музыка', 'Music'),
-            ('Gaming', '🎮', '#96CEB4', '#Игры', 'Gaming'),
-            ('Education', '📚', '#FFEAA7', 'Обучение', 'Education'),
-            ('Work', '💼', '#DFE6E9', 'Работа', 'Work'),
-            ('VPN', '🔒', '#A29BFE', 'VPN', 'VPN'),
-            ('Cloud Storage', '☁️', '#74B9FF', 'Облачное хранилище', 'Cloud Storage'),
-            ('News', '📰', '#FD79A8', 'Новости', 'News'),
-            ('Fitness', '💪', '#55EFC4', 'Фитнес', 'Fitness'),
-            ('Software', '💻', '#636E72', 'ПО', 'Software'),
-            ('Other', '📦', '#B2BEC3', 'Другое', 'Other')
+
+    def _bump_counters(self, cur, deltas: Dict, daily: Optional[Dict] = None):
+        """Прибавить значения к глобальным и сегодняшним счетчикам"""
+        slot = random.randrange(COUNTER_SLOTS)
+        # Сортировка задает одинаковый порядок блокировок во всех транзакциях
+        rows = [(name, slot, value) for name, value in sorted(deltas.items()) if value]
+        if rows:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO stats_counters (name, slot, value) VALUES %s
+                ON CONFLICT (name, slot) DO UPDATE
+                SET value = stats_counters.value + EXCLUDED.value
+            """, rows)
+
+        rows = [(name, slot, value) for name, value in sorted((daily or {}).items()) if value]
+        if rows:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO daily_counters (day, name, slot, value) VALUES %s
+                ON CONFLICT (day, name, slot) DO UPDATE
+                SET value = daily_counters.value + EXCLUDED.value
+            """, rows, template="(CURRENT_DATE, %s, %s, %s)")
+
+    def _apply_subscription_delta(self, cur, user_id: int, sub: Dict, sign: int, count_total: bool):
+        """
+        Учесть (sign=1) или вычесть (sign=-1) подписку sub в агрегатах.
+        В месячные суммы и число активных попадают только активные подписки;
+        count_total меняет общее число подписок (добавление и удаление)
+        """
+        self._apply_subscription_deltas(cur, user_id, [(sub, sign, count_total)])
+
+    def _apply_subscription_deltas(self, cur, user_id: int, changes: List[Tuple[Dict, int, bool]]):
+        """
+        То же для списка изменений (sub, sign, count_total): разницы суммируются
+        в Python и записываются по одному запросу на каждую таблицу агрегатов
+        """
+        total_delta = active_delta = new_subscriptions = 0
+        monthly_delta = Decimal(0)
+        categories = defaultdict(lambda: [0, Decimal(0)])
+        counters = defaultdict(Decimal)
+
+        for sub, sign, count_total in changes:
+            active = bool(sub['is_active'])
+            sub_total = sign if count_total else 0
+            sub_active = sign if active else 0
+            if not sub_total and not sub_active:
+                continue
+            price = Decimal(sub['price']) if active else Decimal(0)
+            sub_monthly = sign * monthly_cost_decimal(price, sub['billing_cycle'])
+
+            total_delta += sub_total
+            active_delta += sub_active
+            monthly_delta += sub_monthly
+            if sub_active:
+                category = categories[(sub['category'] or '', sub['currency'] or '')]
+                category[0] += sub_active
+                category[1] += sub_monthly
+            counters['revenue:' + (sub['currency'] or '')] += sign * price
+            if count_total and sign > 0:
+                new_subscriptions += 1
+
+        if total_delta or active_delta or monthly_delta:
+            cur.execute("""
+                INSERT INTO user_spending_summary (user_id, total_subscriptions, active_subscriptions, monthly_cost)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (user_id) DO UPDATE
+                SET total_subscriptions = user_spending_summary.total_subscriptions + EXCLUDED.total_subscriptions,
+                    active_subscriptions = user_spending_summary.active_subscriptions + EXCLUDED.active_subscriptions,
+                    monthly_cost = user_spending_summary.monthly_cost + EXCLUDED.monthly_cost,
+                    updated_at = CURRENT_TIMESTAMP
+            """, (user_id, total_delta, active_delta, monthly_delta))
+
+        # Сортировка задает одинаковый порядок блокировок во всех транзакциях
+        rows = [
+            (user_id, category, currency, active, monthly)
+            for (category, currency), (active, monthly) in sorted(categories.items())
+            if active or monthly
         ]
-        
-        for cat in default_categories:
-            cur.execute("""
-                INSERT INTO categories (name, icon, color, translation_ru, translation_en)
-                VALUES (%s, %s, %s, %s, %s)
-                ON CONFLICT (name) DO NOTHING
-            """, cat)
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-        logger.info("Database initialized successfully")
-    
+        if rows:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO user_category_spending (user_id, category, currency, active_subscriptions, monthly_cost)
+                VALUES %s
+                ON CONFLICT (user_id, category, currency) DO UPDATE
+                SET active_subscriptions = user_category_spending.active_subscriptions
+                        + EXCLUDED.active_subscriptions,
+                    monthly_cost = user_category_spending.monthly_cost + EXCLUDED.monthly_cost
+            """, rows)
+
+        counters['total_subscriptions'] = total_delta
+        counters['active_subscriptions'] = active_delta
+        self._bump_counters(cur, counters, {'new_subscriptions': new_subscriptions} if new_subscriptions else None)
+
+    def _bump_data_version(self, cur, user_id: int) -> Optional[int]:
+        """
+        Новая версия данных пользователя (курсор cur — RealDictCursor).
+        Вызывается первой в транзакции записи (или после _lock_data_version): блокировка строки users
+        выстраивает записи одного пользователя в очередь, поэтому версии
+        фиксируются строго по возрастанию и годятся как курсор синхронизации
+        """
+        cur.execute("""
+            UPDATE users SET data_version = data_version + 1 WHERE user_id = %s
+            RETURNING data_version
+        """, (user_id,))
+        row = cur.fetchone()
+        return row['data_version'] if row else None
+
+    def _lock_data_version(self, cur, user_id: int) -> Optional[int]:
+        """
+        Заблокировать строку users и вернуть текущую версию данных.
+        Для записей, которые могут ничего не изменить (подписки нет):
+        порядок блокировок тот же, что с _bump_data_version, а версия
+        увеличивается только после изменения — клиенты не получают
+        новый ETag без новых данных
+        """
+        cur.execute("SELECT data_version FROM users WHERE user_id = %s FOR UPDATE", (user_id,))
+        row = cur.fetchone()
+        return row['data_version'] if row else None
+
     # === ПОЛЬЗОВАТЕЛИ ===
-    
+
     def add_user(self, user_id: int, username: str, full_name: str) -> bool:
         """Добавить нового пользователя"""
         try:
-            conn = self.get_connection()
-            cur = conn.cursor()
-            
-            cur.execute("""
-                INSERT INTO users (user_id, username, full_name)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (user_id) DO UPDATE
-                SET username = EXCLUDED.username,
-                    full_name = EXCLUDED.full_name,
-                    last_active = CURRENT_TIMESTAMP
-            """, (user_id, username, full_name))
-            
-            conn.commit()
-            cur.close()
-            conn.close()
+            with self.connection() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO users (user_id, username, full_name)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET username = EXCLUDED.username,
+                        full_name = EXCLUDED.full_name,
+                        last_active = CURRENT_TIMESTAMP,
+                        data_version = users.data_version + 1
+                    RETURNING (xmax = 0) AS inserted
+                """, (user_id, username, full_name))
+                if cur.fetchone()[0]:
+                    self._bump_counters(cur, {'total_users': 1}, {'new_users': 1})
+            self.user_cache.invalidate(user_id)
             return True
         except Exception as e:
             logger.error(f"Error adding user: {e}")
             return False
-    
+
     def get_user(self, user_id: int) -> Optional[Dict]:
         """Получить данные пользователя"""
+        cached = self.user_cache.get(user_id)
+        if cached is not None:
+            return dict(cached)
+
         try:
-            conn = self.get_connection()
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            
-            cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-            user = cur.fetchone()
-            
-            cur.close()
-            conn.close()
-            return dict(user) if user else None
+            with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
+                user = cur.fetchone()
+            if not user:
+                return None
+            self.user_cache.set(user_id, dict(user))
+            return dict(user)
         except Exception as e:
             logger.error(f"Error getting user: {e}")
             return None
-    
+
+    def get_user_payload(self, user_id: int, known_version: Optional[int] = None) -> Optional[Tuple[int, Optional[str]]]:
+        """
+        Пользователь и его подписки одним запросом в виде готового JSON
+        {"user": ..., "subscriptions": [...]}, собранного в PostgreSQL.
+        Возвращает (data_version, json); если версия равна known_version,
+        JSON не строится и вместо него возвращается None.
+        None — пользователя нет
+        """
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT u.data_version,
+                       CASE WHEN u.data_version = %s THEN NULL ELSE json_build_object(
+                           'user', to_json(u),
+                           'subscriptions', COALESCE((
+                               SELECT json_agg(s ORDER BY s.next_payment)
+                               FROM subscriptions s
+                               WHERE s.user_id = u.user_id
+                           ), '[]'::json)
+                       )::text END
+                FROM users u
+                WHERE u.user_id = %s
+            """, (known_version, user_id))
+            row = cur.fetchone()
+
+        return (row[0], row[1]) if row else None
+
     def get_user_language(self, user_id: int) -> str:
         """Получить язык пользователя"""
         user = self.get_user(user_id)
         return user.get('language', 'ru') if user else 'ru'
-    
+
     def update_user_language(self, user_id: int, language: str):
         """Обновить язык пользователя"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        cur.execute("UPDATE users SET language = %s WHERE user_id = %s", (language, user_id))
-        conn.commit()
-        cur.close()
-        conn.close()
-    
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE users SET language = %s, data_version = data_version + 1 WHERE user_id = %s
+            """, (language, user_id))
+        self.user_cache.invalidate(user_id)
+
     def update_user_notifications(self, user_id: int, enabled: bool):
         """Обновить настройки уведомлений"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        cur.execute("UPDATE users SET notifications_enabled = %s WHERE user_id = %s", (enabled, user_id))
-        conn.commit()
-        cur.close()
-        conn.close()
-    
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE users SET notifications_enabled = %s, data_version = data_version + 1 WHERE user_id = %s
+            """, (enabled, user_id))
+        self.user_cache.invalidate(user_id)
+
+    def update_user_display_currency(self, user_id: int, currency: str):
+        """Обновить валюту отображения итогов"""
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE users SET display_currency = %s, data_version = data_version + 1 WHERE user_id = %s
+            """, (currency, user_id))
+        self.user_cache.invalidate(user_id)
+
     def update_user_theme(self, user_id: int, theme: str):
         """Обновить тему пользователя"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        cur.execute("UPDATE users SET theme = %s WHERE user_id = %s", (theme, user_id))
-        conn.commit()
-        cur.close()
-        conn.close()
-    
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE users SET theme = %s, data_version = data_version + 1 WHERE user_id = %s
+            """, (theme, user_id))
+        self.user_cache.invalidate(user_id)
+
     def activate_premium_trial(self, user_id: int, days: int = 7):
         """Активировать пробный период Premium"""
-        conn = self.get_connection()
-        cur = conn.cursor()
         premium_until = datetime.now() + timedelta(days=days)
-        cur.execute("""
-            UPDATE users 
-            SET is_premium = TRUE, premium_until = %s 
-            WHERE user_id = %s
-        """, (premium_until, user_id))
-        conn.commit()
-        cur.close()
-        conn.close()
-    
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE users u
+                SET is_premium = TRUE, premium_until = %s, data_version = u.data_version + 1
+                FROM (SELECT user_id, is_premium FROM users WHERE user_id = %s FOR UPDATE) old
+                WHERE u.user_id = old.user_id
+                RETURNING old.is_premium
+            """, (premium_until, user_id))
+            row = cur.fetchone()
+            if row and not row[0]:
+                self._bump_counters(cur, {'premium_users': 1}, {'premium_conversions': 1})
+        self.user_cache.invalidate(user_id)
+
     # === ПОДПИСКИ ===
-    
+
     def add_subscription(self, user_id: int, data: Dict) -> int:
         """Добавить новую подписку"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        
-        cur.execute("""
-            INSERT INTO subscriptions 
-            (user_id, name, description, price, currency, category, billing_cycle, 
-             start_date, next_payment, trial_end_date, icon, color, website_url, notes)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        """, (
-            user_id,
-            data.get('name'),
-            data.get('description', ''),
-            data.get('price'),
-            data.get('currency', 'USD'),
-            data.get('category'),
-            data.get('billing_cycle', 'monthly'),
-            data.get('start_date'),
-            data.get('next_payment'),
-            data.get('trial_end_date'),
-            data.get('icon'),
-            data.get('color'),
-            data.get('website_url'),
-            data.get('notes')
-        ))
-        
-        subscription_id = cur.fetchone()[0]
-        
-        # Создать уведомления
-        self._create_notifications_for_subscription(cur, user_id, subscription_id, data.get('next_payment'))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-        
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            version = self._bump_data_version(cur, user_id)
+            cur.execute(f"""
+                INSERT INTO subscriptions
+                (user_id, name, description, price, currency, category, billing_cycle,
+                 start_date, next_payment, trial_end_date, icon, color, website_url, notes, row_version,
+                 billing_day)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, EXTRACT(DAY FROM %s::date))
+                RETURNING {SUBSCRIPTION_TOTALS_COLUMNS}
+            """, (
+                user_id,
+                data.get('name'),
+                data.get('description', ''),
+                data.get('price'),
+                data.get('currency', 'USD'),
+                data.get('category'),
+                data.get('billing_cycle', 'monthly'),
+                data.get('start_date'),
+                data.get('next_payment'),
+                data.get('trial_end_date'),
+                data.get('icon'),
+                data.get('color'),
+                data.get('website_url'),
+                data.get('notes'),
+                version,
+                data.get('next_payment')
+            ))
+
+            sub = cur.fetchone()
+            subscription_id = sub['id']
+            self._apply_subscription_delta(cur, user_id, sub, sign=1, count_total=True)
+            self._refresh_upcoming_charges(cur, [sub])
+
+            # Создать уведомления
+            self._create_notifications_for_subscription(cur, user_id, subscription_id, data.get('next_payment'))
+
+        self.user_cache.invalidate(user_id)
         logger.info(f"Subscription {subscription_id} added for user {user_id}")
         return subscription_id
-    
+
     def get_subscriptions(self, user_id: int, active_only: bool = False) -> List[Dict]:
         """Получить все подписки пользователя"""
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
         query = "SELECT * FROM subscriptions WHERE user_id = %s"
         if active_only:
             query += " AND is_active = TRUE"
         query += " ORDER BY next_payment ASC"
-        
-        cur.execute(query, (user_id,))
-        subscriptions = cur.fetchall()
-        
-        cur.close()
-        conn.close()
-        
-        return [dict(sub) for sub in subscriptions]
-    
+
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(query, (user_id,))
+            # RealDictRow — подкласс dict, копировать строки не нужно
+            return cur.fetchall()
+
+    def get_subscription_changes(self, user_id: int, since: Optional[int] = None) -> Optional[Dict]:
+        """
+        Изменения подписок после курсора since (версии данных пользователя):
+        измененные и новые строки и ID удаленных подписок. Без курсора или
+        с курсором из будущего (например, после восстановления БД) — полный
+        список с full=True. None — пользователя нет.
+
+        Курсор читается первым запросом: все записи с версией не больше него
+        уже зафиксированы и видны следующим запросам; записи, сделанные позже,
+        могут попасть в ответ повторно — клиент применяет их идемпотентно
+        (сначала строки, затем удаления)
+        """
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT data_version FROM users WHERE user_id = %s", (user_id,))
+            row = cur.fetchone()
+            if not row:
+                return None
+            cursor = row['data_version']
+            full = since is None or since <= 0 or since > cursor
+
+            if full:
+                cur.execute("""
+                    SELECT * FROM subscriptions WHERE user_id = %s ORDER BY next_payment ASC
+                """, (user_id,))
+                return {'cursor': cursor, 'full': True, 'subscriptions': cur.fetchall(), 'deleted': []}
+
+            cur.execute("""
+                SELECT * FROM subscriptions
+                WHERE user_id = %s AND row_version > %s
+                ORDER BY next_payment ASC
+            """, (user_id, since))
+            subscriptions = cur.fetchall()
+
+            cur.execute("""
+                SELECT DISTINCT subscription_id FROM subscription_history
+                WHERE user_id = %s AND action = 'delete' AND data_version > %s
+            """, (user_id, since))
+            deleted = [r['subscription_id'] for r in cur.fetchall()]
+
+        return {'cursor': cursor, 'full': False, 'subscriptions': subscriptions, 'deleted': deleted}
+
     def get_subscription(self, subscription_id: int) -> Optional[Dict]:
         """Получить подписку по ID"""
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute("SELECT * FROM subscriptions WHERE id = %s", (subscription_id,))
-        subscription = cur.fetchone()
-        
-        cur.close()
-        conn.close()
-        
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT * FROM subscriptions WHERE id = %s", (subscription_id,))
+            subscription = cur.fetchone()
+
         return dict(subscription) if subscription else None
-    
+
     def update_subscription(self, user_id: int, subscription_id: int, data: Dict):
         """Обновить подписку"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        
-        # Сохранить старые данные для истории (если Premium)
-        user = self.get_user(user_id)
-        if user and user.get('is_premium'):
-            old_data = self.get_subscription(subscription_id)
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            current = self._lock_data_version(cur, user_id)
+            if current is None:
+                return
+            # Старая строка нужна для агрегатов и истории; блокируем ее до конца транзакции.
+            # Читаем через тот же курсор, чтобы не занимать второе подключение из пула
             cur.execute("""
-                INSERT INTO subscription_history (subscription_id, user_id, action, old_data, new_data)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (subscription_id, user_id, 'update', psycopg2.extras.Json(old_data), psycopg2.extras.Json(data)))
-        
-        cur.execute("""
-            UPDATE subscriptions 
-            SET name = %s, description = %s, price = %s, currency = %s, category = %s,
-                billing_cycle = %s, next_payment = %s, trial_end_date = %s, 
-                icon = %s, color = %s, website_url = %s, notes = %s, updated_at = CURRENT_TIMESTAMP
-            WHERE id = %s AND user_id = %s
-        """, (
-            data.get('name'),
-            data.get('description'),
-            data.get('price'),
-            data.get('currency'),
-            data.get('category'),
-            data.get('billing_cycle'),
-            data.get('next_payment'),
-            data.get('trial_end_date'),
-            data.get('icon'),
-            data.get('color'),
-            data.get('website_url'),
-            data.get('notes'),
-            subscription_id,
-            user_id
-        ))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-    
+                SELECT * FROM subscriptions WHERE id = %s AND user_id = %s FOR UPDATE
+            """, (subscription_id, user_id))
+            old_data = cur.fetchone()
+            if not old_data:
+                return
+            version = self._bump_data_version(cur, user_id)
+
+            # Сохранить старые данные для истории (если Premium)
+            cur.execute("SELECT is_premium FROM users WHERE user_id = %s", (user_id,))
+            user = cur.fetchone()
+            if user and user['is_premium']:
+                cur.execute("""
+                    INSERT INTO subscription_history (subscription_id, user_id, action, old_data, new_data, data_version)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                """, (
+                    subscription_id, user_id, 'update',
+                    # В строке есть Decimal и даты: стандартный json.dumps их не принимает
+                    psycopg2.extras.Json(old_data, dumps=dumps_str),
+                    psycopg2.extras.Json(data, dumps=dumps_str),
+                    version
+                ))
+
+            cur.execute(f"""
+                UPDATE subscriptions
+                SET name = %s, description = %s, price = %s, currency = %s, category = %s,
+                    billing_cycle = %s, next_payment = %s, trial_end_date = %s,
+                    icon = %s, color = %s, website_url = %s, notes = %s,
+                    updated_at = CURRENT_TIMESTAMP, row_version = %s,
+                    -- Число списания меняется, только если пользователь сам перенес дату
+                    billing_day = CASE WHEN next_payment IS DISTINCT FROM %s::date
+                                       THEN EXTRACT(DAY FROM %s::date) ELSE billing_day END
+                WHERE id = %s AND user_id = %s
+                RETURNING {SUBSCRIPTION_TOTALS_COLUMNS}
+            """, (
+                data.get('name'),
+                data.get('description'),
+                data.get('price'),
+                data.get('currency'),
+                data.get('category'),
+                data.get('billing_cycle'),
+                data.get('next_payment'),
+                data.get('trial_end_date'),
+                data.get('icon'),
+                data.get('color'),
+                data.get('website_url'),
+                data.get('notes'),
+                version,
+                data.get('next_payment'),
+                data.get('next_payment'),
+                subscription_id,
+                user_id
+            ))
+            new_data = cur.fetchone()
+
+            self._apply_subscription_delta(cur, user_id, old_data, sign=-1, count_total=False)
+            self._apply_subscription_delta(cur, user_id, new_data, sign=1, count_total=False)
+            self._refresh_upcoming_charges(cur, [new_data])
+        self.user_cache.invalidate(user_id)
+
     def delete_subscription(self, user_id: int, subscription_id: int):
         """Удалить подписку"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        
-        cur.execute("DELETE FROM subscriptions WHERE id = %s AND user_id = %s", (subscription_id, user_id))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-    
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            current = self._lock_data_version(cur, user_id)
+            if current is None:
+                return
+            cur.execute("""
+                DELETE FROM subscriptions WHERE id = %s AND user_id = %s
+                RETURNING *
+            """, (subscription_id, user_id))
+            old_data = cur.fetchone()
+            if not old_data:
+                return
+            version = self._bump_data_version(cur, user_id)
+            self._apply_subscription_delta(cur, user_id, old_data, sign=-1, count_total=True)
+            # Запись об удалении: по ней клиенты убирают подписку при синхронизации
+            cur.execute("""
+                INSERT INTO subscription_history (subscription_id, user_id, action, old_data, data_version)
+                VALUES (%s, %s, 'delete', %s, %s)
+            """, (subscription_id, user_id, psycopg2.extras.Json(old_data, dumps=dumps_str), version))
+        self.user_cache.invalidate(user_id)
+
     def toggle_subscription_status(self, user_id: int, subscription_id: int):
         """Переключить статус активности подписки"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        
-        cur.execute("""
-            UPDATE subscriptions 
-            SET is_active = NOT is_active 
-            WHERE id = %s AND user_id = %s
-        """, (subscription_id, user_id))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-    
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            current = self._lock_data_version(cur, user_id)
+            if current is None:
+                return
+            # Строка users заблокирована: следующая версия известна заранее
+            cur.execute(f"""
+                UPDATE subscriptions
+                SET is_active = NOT is_active, updated_at = CURRENT_TIMESTAMP, row_version = %s
+                WHERE id = %s AND user_id = %s
+                RETURNING {SUBSCRIPTION_TOTALS_COLUMNS}
+            """, (current + 1, subscription_id, user_id))
+            new_data = cur.fetchone()
+            if not new_data:
+                return
+            self._bump_data_version(cur, user_id)
+            # Подписка целиком переходит в активные или выходит из них
+            sign = 1 if new_data['is_active'] else -1
+            self._apply_subscription_delta(cur, user_id, dict(new_data, is_active=True),
+                                           sign=sign, count_total=False)
+            self._refresh_upcoming_charges(cur, [new_data])
+        self.user_cache.invalidate(user_id)
+
+    def apply_subscription_batch(self, user_id: int, operations: List[Dict]) -> Optional[Dict]:
+        """
+        Пакет операций {"action": "add" | "update" | "delete" | "toggle",
+        "subscription_id": ..., "subscription": {...}} одной транзакцией:
+        одна новая версия данных и по одному запросу на каждый вид операций;
+        агрегаты, календарь списаний, история и уведомления пишутся пачками.
+        update меняет только переданные поля; каждая подписка встречается
+        в пакете не больше одного раза. Лимит бесплатной версии проверяется
+        один раз на пакет: удаления из пакета освобождают места, добавления
+        сверх лимита отклоняются.
+        Возвращает {"data_version": ..., "results": [...]} — результат каждой
+        операции в порядке запроса; None — пользователя нет
+        """
+        results: List[Optional[Dict]] = [None] * len(operations)
+        adds: List[int] = []
+        targets: Dict[int, int] = {}
+
+        def reject(index: int, action, error: str):
+            results[index] = {'action': action, 'ok': False, 'error': error}
+
+        def accept(index: int, action: str, row: Dict):
+            results[index] = {'action': action, 'ok': True, 'subscription_id': row['id'],
+                              'subscription': row if action != 'delete' else None}
+
+        for index, op in enumerate(operations):
+            action = op.get('action') if isinstance(op, dict) else None
+            if action == 'add':
+                if _valid_subscription_data(op.get('subscription'), required=True):
+                    adds.append(index)
+                else:
+                    reject(index, action, 'invalid')
+            elif action in ('update', 'delete', 'toggle'):
+                subscription_id = op.get('subscription_id')
+                if not isinstance(subscription_id, int) or isinstance(subscription_id, bool):
+                    reject(index, action, 'invalid')
+                elif action == 'update' and not _valid_subscription_data(op.get('subscription'), required=False):
+                    reject(index, action, 'invalid')
+                elif subscription_id in targets:
+                    reject(index, action, 'duplicate')
+                else:
+                    targets[subscription_id] = index
+            else:
+                reject(index, action, 'invalid')
+
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            current = self._lock_data_version(cur, user_id)
+            if current is None:
+                return None
+            # Версия увеличивается в конце и только если хоть одна операция применена
+            version = current + 1
+            cur.execute("""
+                SELECT is_premium, notifications_enabled, notification_days,
+                       (SELECT count(*) FROM subscriptions WHERE user_id = %s) AS total
+                FROM users WHERE user_id = %s
+            """, (user_id, user_id))
+            user = cur.fetchone()
+
+            # Старые строки нужны для агрегатов, истории и слияния полей;
+            # блокируем их до конца транзакции в одном порядке
+            old_rows: Dict[int, Dict] = {}
+            if targets:
+                cur.execute("""
+                    SELECT * FROM subscriptions
+                    WHERE user_id = %s AND id = ANY(%s)
+                    ORDER BY id
+                    FOR UPDATE
+                """, (user_id, list(targets)))
+                old_rows = {row['id']: row for row in cur.fetchall()}
+
+            by_action = defaultdict(list)
+            for subscription_id, index in targets.items():
+                if subscription_id in old_rows:
+                    by_action[operations[index]['action']].append(subscription_id)
+                else:
+                    reject(index, operations[index]['action'], 'not_found')
+
+            changes: List[Tuple[Dict, int, bool]] = []
+            refreshed: List[Dict] = []
+
+            if by_action['delete']:
+                cur.execute("""
+                    DELETE FROM subscriptions WHERE user_id = %s AND id = ANY(%s)
+                    RETURNING *
+                """, (user_id, by_action['delete']))
+                deleted = cur.fetchall()
+                # Записи об удалении: по ним клиенты убирают подписки при синхронизации
+                psycopg2.extras.execute_values(cur, """
+                    INSERT INTO subscription_history (subscription_id, user_id, action, old_data, data_version)
+                    VALUES %s
+                """, [
+                    (row['id'], user_id, psycopg2.extras.Json(row, dumps=dumps_str), version)
+                    for row in deleted
+                ], template="(%s, %s, 'delete', %s, %s)")
+                for row in deleted:
+                    changes.append((row, -1, True))
+                    accept(targets[row['id']], 'delete', row)
+
+            if by_action['update']:
+                updates = [(old_rows[sid], operations[targets[sid]]['subscription']) for sid in by_action['update']]
+                # Литералы VALUES без типа сравниваются между строками, поэтому все колонки с приведением
+                updated = psycopg2.extras.execute_values(cur, f"""
+                    UPDATE subscriptions s
+                    SET {', '.join(f'{field} = v.{field}' for field in SUBSCRIPTION_UPDATE_FIELDS)},
+                        updated_at = CURRENT_TIMESTAMP, row_version = v.row_version,
+                        billing_day = CASE WHEN s.next_payment IS DISTINCT FROM v.next_payment
+                                           THEN EXTRACT(DAY FROM v.next_payment) ELSE s.billing_day END
+                    FROM (VALUES %s) AS v (id, user_id, {', '.join(SUBSCRIPTION_UPDATE_FIELDS)}, row_version)
+                    WHERE s.id = v.id AND s.user_id = v.user_id
+                    RETURNING s.*
+                """, [
+                    (old['id'], user_id) + tuple(data.get(field, old[field]) for field in SUBSCRIPTION_UPDATE_FIELDS)
+                    + (version,)
+                    for old, data in updates
+                ], template="(%s::integer, %s::bigint, %s::text, %s::text, %s::numeric, %s::text, %s::text, "
+                            "%s::text, %s::date, %s::date, %s::text, %s::text, %s::text, %s::text, %s::bigint)",
+                    fetch=True)
+
+                if user['is_premium']:
+                    psycopg2.extras.execute_values(cur, """
+                        INSERT INTO subscription_history (subscription_id, user_id, action, old_data, new_data, data_version)
+                        VALUES %s
+                    """, [
+                        (old['id'], user_id, psycopg2.extras.Json(old, dumps=dumps_str),
+                         psycopg2.extras.Json(data, dumps=dumps_str), version)
+                        for old, data in updates
+                    ], template="(%s, %s, 'update', %s, %s, %s)")
+
+                for row in updated:
+                    changes.append((old_rows[row['id']], -1, False))
+                    changes.append((row, 1, False))
+                    refreshed.append(row)
+                    accept(targets[row['id']], 'update', row)
+
+            if by_action['toggle']:
+                cur.execute("""
+                    UPDATE subscriptions
+                    SET is_active = NOT is_active, updated_at = CURRENT_TIMESTAMP, row_version = %s
+                    WHERE user_id = %s AND id = ANY(%s)
+                    RETURNING *
+                """, (version, user_id, by_action['toggle']))
+                for row in cur.fetchall():
+                    # Подписка целиком переходит в активные или выходит из них
+                    changes.append((dict(row, is_active=True), 1 if row['is_active'] else -1, False))
+                    refreshed.append(row)
+                    accept(targets[row['id']], 'toggle', row)
+
+            if not user['is_premium']:
+                free = max(0, self.free_subscription_limit - (user['total'] - len(by_action['delete'])))
+                for index in adds[free:]:
+                    reject(index, 'add', 'limit')
+                adds = adds[:free]
+
+            if adds:
+                added = psycopg2.extras.execute_values(cur, """
+                    INSERT INTO subscriptions
+                    (user_id, name, description, price, currency, category, billing_cycle,
+                     start_date, next_payment, trial_end_date, icon, color, website_url, notes, row_version,
+                     billing_day)
+                    VALUES %s
+                    RETURNING *
+                """, [
+                    (
+                        user_id,
+                        data.get('name'),
+                        data.get('description', ''),
+                        data.get('price'),
+                        data.get('currency', 'USD'),
+                        data.get('category'),
+                        data.get('billing_cycle', 'monthly'),
+                        data.get('start_date'),
+                        data.get('next_payment'),
+                        data.get('trial_end_date'),
+                        data.get('icon'),
+                        data.get('color'),
+                        data.get('website_url'),
+                        data.get('notes'),
+                        version,
+                        data.get('next_payment')
+                    )
+                    for data in (operations[index]['subscription'] for index in adds)
+                ], template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, EXTRACT(DAY FROM %s::date))",
+                    fetch=True)
+
+                # RETURNING многострочного INSERT ... VALUES отдает строки в порядке VALUES
+                for index, row in zip(adds, added):
+                    changes.append((row, 1, True))
+                    refreshed.append(row)
+                    accept(index, 'add', row)
+
+                if user['notifications_enabled']:
+                    notification_days = user['notification_days'] if user['notification_days'] is not None else 3
+                    scheduled = [(row['id'], row['next_payment'] - timedelta(days=notification_days)) for row in added]
+                    psycopg2.extras.execute_values(cur, """
+                        INSERT INTO notifications (user_id, subscription_id, notification_type, scheduled_date)
+                        VALUES %s
+                    """, [(user_id, sid, when) for sid, when in scheduled], template="(%s, %s, 'renewal', %s)")
+                    # Разбудить планировщики уведомлений один раз на пакет; NOTIFY доставляется при коммите
+                    cur.execute("""
+                        SELECT pg_notify(%s, EXTRACT(EPOCH FROM (%s::timestamp - CURRENT_TIMESTAMP))::text)
+                    """, (self.notification_channel, min(when for _, when in scheduled)))
+
+            applied = sum(1 for r in results if r['ok'])
+            if not applied:
+                return {'data_version': current, 'results': results}
+            self._bump_data_version(cur, user_id)
+            self._apply_subscription_deltas(cur, user_id, changes)
+            if refreshed:
+                self._refresh_upcoming_charges(cur, refreshed)
+
+        self.user_cache.invalidate(user_id)
+        logger.info(f"Subscription batch for user {user_id}: {applied}/{len(results)} operations applied")
+        return {'data_version': version, 'results': results}
+
     # === СТАТИСТИКА ===
-    
+
     def get_user_stats(self, user_id: int) -> Dict:
-        """Получить статистику пользователя"""
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # Общая статистика
-        cur.execute("""
-            SELECT 
-                COUNT(*) as total_subscriptions,
-                COUNT(*) FILTER (WHERE is_active = TRUE) as active_subscriptions,
-                COALESCE(SUM(CASE 
-                    WHEN billing_cycle = 'monthly' THEN price
-                    WHEN billing_cycle = 'yearly' THEN price / 12
-                    WHEN billing_cycle = 'weekly' THEN price * 4
-                    ELSE price
-                END) FILTER (WHERE is_active = TRUE), 0) as monthly_cost
-            FROM subscriptions
-            WHERE user_id = %s
-        """, (user_id,))
-        
-        stats = dict(cur.fetchone())
+        """
+        Получить статистику пользователя из материализованных агрегатов.
+        Суммы пересчитываются в валюту отображения пользователя:
+        один множитель на валюту, без обращений к БД за курсами
+        """
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            # Общая статистика
+            cur.execute("""
+                SELECT u.display_currency,
+                       COALESCE(s.total_subscriptions, 0) AS total_subscriptions,
+                       COALESCE(s.active_subscriptions, 0) AS active_subscriptions
+                FROM users u
+                LEFT JOIN user_spending_summary s ON s.user_id = u.user_id
+                WHERE u.user_id = %s
+            """, (user_id,))
+
+            row = cur.fetchone()
+            stats = dict(row) if row else {'total_subscriptions': 0, 'active_subscriptions': 0}
+            currency = stats.pop('display_currency', None) or self.fx.base
+
+            # Суммы по категориям и валютам
+            cur.execute("""
+                SELECT category, currency, monthly_cost
+                FROM user_category_spending
+                WHERE user_id = %s AND active_subscriptions > 0
+            """, (user_id,))
+
+            rows = cur.fetchall()
+
+        factors = self.fx.factors((row['currency'] or None for row in rows), currency)
+        by_category, unconverted = {}, {}
+        for row in rows:
+            source = row['currency'] or None
+            factor = factors[source]
+            if factor is None:
+                unconverted[source] = unconverted.get(source, 0.0) + float(row['monthly_cost'])
+                continue
+            category = row['category'] or None
+            by_category[category] = by_category.get(category, 0.0) + float(row['monthly_cost']) * factor
+
+        stats['currency'] = currency
+        stats['monthly_cost'] = sum(by_category.values())
         stats['yearly_cost'] = stats['monthly_cost'] * 12
-        
-        # Статистика по категориям
-        cur.execute("""
-            SELECT 
-                category,
-                SUM(CASE 
-                    WHEN billing_cycle = 'monthly' THEN price
-                    WHEN billing_cycle = 'yearly' THEN price / 12
-                    WHEN billing_cycle = 'weekly' THEN price * 4
-                    ELSE price
-                END) as amount
-            FROM subscriptions
-            WHERE user_id = %s AND is_active = TRUE
-            GROUP BY category
-            ORDER BY amount DESC
-        """, (user_id,))
-        
-        stats['by_category'] = {row['category']: float(row['amount']) for row in cur.fetchall()}
-        
-        cur.close()
-        conn.close()
-        
+        stats['by_category'] = dict(sorted(by_category.items(), key=lambda item: item[1], reverse=True))
+        stats['unconverted'] = unconverted
         return stats
-    
+
+    def get_cost_columns(self, user_id: int) -> CostColumns:
+        """Активные подписки пользователя в колоночном виде для cost_engine"""
+        with self.connection() as conn, conn.cursor() as cur:
+            # Все колонки есть в idx_subscriptions_user_active_next (index-only scan)
+            cur.execute("""
+                SELECT price, billing_cycle, currency, category
+                FROM subscriptions
+                WHERE user_id = %s AND is_active = TRUE
+            """, (user_id,))
+
+            return CostColumns.from_rows(cur.fetchall(), price=0, cycle=1, currency=2, category=3)
+
     def get_upcoming_renewals(self, user_id: int, days: int = 30) -> List[Dict]:
-        """Получить предстоящие продления"""
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute("""
-            SELECT * FROM subscriptions
-            WHERE user_id = %s 
-            AND is_active = TRUE
-            AND next_payment BETWEEN CURRENT_DATE AND CURRENT_DATE + INTERVAL '%s days'
-            ORDER BY next_payment ASC
-        """, (user_id, days))
-        
-        renewals = cur.fetchall()
-        
-        cur.close()
-        conn.close()
-        
+        """
+        Предстоящие списания за days дней из календаря upcoming_charges.
+        Подписка с коротким периодом попадает в список столько раз, сколько
+        списаний приходится на окно; дата списания — charge_date
+        """
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT s.*, c.charge_date, c.amount
+                FROM upcoming_charges c
+                JOIN subscriptions s ON s.id = c.subscription_id
+                WHERE c.user_id = %s
+                AND c.charge_date BETWEEN CURRENT_DATE AND CURRENT_DATE + %s
+                ORDER BY c.charge_date ASC, s.id
+            """, (user_id, days))
+
+            renewals = cur.fetchall()
+
         return [dict(r) for r in renewals]
-    
+
+    def get_charge_calendar(self, user_id: int, days: int = 31) -> List[Dict]:
+        """Календарь списаний пользователя на days дней вперед"""
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT c.charge_date, c.subscription_id, s.name, c.amount, c.currency
+                FROM upcoming_charges c
+                JOIN subscriptions s ON s.id = c.subscription_id
+                WHERE c.user_id = %s
+                AND c.charge_date >= CURRENT_DATE AND c.charge_date < CURRENT_DATE + %s
+                ORDER BY c.charge_date, c.subscription_id
+            """, (user_id, days))
+
+            return cur.fetchall()
+
+    def get_cash_flow(self, user_id: int, months: int = 12, currency: Optional[str] = None) -> List[Dict]:
+        """
+        Списания по месяцам начиная с текущего, по валютам и итогом в currency.
+        Горизонт ограничен RENEWAL_HORIZON_DAYS
+        """
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT to_char(charge_date, 'YYYY-MM'), currency, SUM(amount)
+                FROM upcoming_charges
+                WHERE user_id = %s
+                AND charge_date >= CURRENT_DATE
+                AND charge_date < date_trunc('month', CURRENT_DATE) + make_interval(months => %s)
+                GROUP BY 1, 2
+            """, (user_id, months))
+
+            rows = cur.fetchall()
+
+        currency = currency or self.fx.base
+        factors = self.fx.factors((row[1] for row in rows), currency)
+        first_month = date.today().replace(day=1)
+        cash_flow = {}
+        for k in range(months):
+            month = (first_month.year * 12 + first_month.month - 1 + k)
+            key = f"{month // 12:04d}-{month % 12 + 1:02d}"
+            cash_flow[key] = {'month': key, 'total': 0.0, 'by_currency': {}, 'unconverted': {}}
+
+        for month, charge_currency, amount in rows:
+            bucket = cash_flow.get(month)
+            if bucket is None:
+                continue
+            bucket['by_currency'][charge_currency] = float(amount)
+            factor = factors[charge_currency]
+            if factor is None:
+                bucket['unconverted'][charge_currency] = float(amount)
+            else:
+                bucket['total'] += float(amount) * factor
+
+        return list(cash_flow.values())
+
+    def _refresh_upcoming_charges(self, cur, subscriptions: List[Dict]):
+        """Пересчитать календарь списаний подписок в текущей транзакции"""
+        cur.execute(
+            "DELETE FROM upcoming_charges WHERE subscription_id = ANY(%s)",
+            ([sub['id'] for sub in subscriptions],)
+        )
+
+        today = date.today()
+        rows = expand_charges(
+            (sub for sub in subscriptions if sub['is_active'] and sub['next_payment'] is not None),
+            today, today + timedelta(days=self.renewal_horizon_days)
+        )
+        if rows:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO upcoming_charges (subscription_id, user_id, charge_date, amount, currency)
+                VALUES %s
+                ON CONFLICT (subscription_id, charge_date) DO NOTHING
+            """, rows, page_size=1000)
+
+    def roll_next_payments(self, batch_size: int = 1000) -> Dict:
+        """
+        Перенести прошедшие next_payment активных подписок на ближайшую
+        будущую дату списания и создать для них напоминания.
+        Каждая пачка по id — один запрос: UPDATE всей пачки, INSERT
+        напоминаний и RETURNING строк для календаря в одной транзакции
+        """
+        result = {'advanced': 0, 'reminders': 0, 'batches': 0, 'elapsed_ms': 0.0}
+        started = time.perf_counter()
+        after_id = 0
+        while True:
+            with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"""
+                    WITH due AS (
+                        SELECT s.id, {NEXT_PAYMENT_SQL} AS next_payment, u.data_version + 1 AS row_version
+                        FROM subscriptions s
+                        JOIN users u ON u.user_id = s.user_id
+                        WHERE s.is_active = TRUE AND s.next_payment < CURRENT_DATE AND s.id > %s
+                        ORDER BY s.id
+                        LIMIT %s
+                        FOR UPDATE OF s, u SKIP LOCKED
+                    ), advanced AS (
+                        UPDATE subscriptions s
+                        SET next_payment = due.next_payment, updated_at = CURRENT_TIMESTAMP,
+                            row_version = due.row_version
+                        FROM due
+                        WHERE s.id = due.id
+                        RETURNING s.id, s.user_id, s.price, s.currency, s.category,
+                                  s.billing_cycle, s.next_payment, s.billing_day, s.is_active
+                    ), touched AS (
+                        UPDATE users
+                        SET data_version = data_version + 1
+                        WHERE user_id IN (SELECT user_id FROM advanced)
+                    ), reminders AS (
+                        INSERT INTO notifications (user_id, subscription_id, notification_type, scheduled_date)
+                        SELECT a.user_id, a.id, 'renewal', a.next_payment - COALESCE(u.notification_days, 3)
+                        FROM advanced a
+                        JOIN users u ON u.user_id = a.user_id
+                        WHERE u.notifications_enabled = TRUE
+                        RETURNING scheduled_date
+                    ), reminder_stats AS (
+                        SELECT COUNT(*) AS created, MIN(scheduled_date) AS first_due FROM reminders
+                    )
+                    SELECT advanced.*, reminder_stats.created AS reminders_created,
+                           reminder_stats.first_due AS first_reminder
+                    FROM advanced, reminder_stats
+                    ORDER BY advanced.id
+                """, (after_id, batch_size))
+                batch = cur.fetchall()
+                if not batch:
+                    break
+
+                reminders = batch[0]['reminders_created']
+                if reminders:
+                    # Разбудить планировщики уведомлений; NOTIFY доставляется при коммите
+                    cur.execute("""
+                        SELECT pg_notify(%s, EXTRACT(EPOCH FROM (%s::timestamp - CURRENT_TIMESTAMP))::text)
+                    """, (self.notification_channel, batch[0]['first_reminder']))
+                self._refresh_upcoming_charges(cur, batch)
+
+            # touched увеличил data_version этих пользователей
+            for user_id in {row['user_id'] for row in batch}:
+                self.user_cache.invalidate(user_id)
+            result['advanced'] += len(batch)
+            result['reminders'] += reminders
+            result['batches'] += 1
+            after_id = batch[-1]['id']
+            if len(batch) < batch_size:
+                break
+
+        result['elapsed_ms'] = (time.perf_counter() - started) * 1000
+        if result['advanced']:
+            logger.info(
+                f"Advanced next_payment for {result['advanced']} subscriptions, "
+                f"created {result['reminders']} reminders in {result['batches']} batches, "
+                f"{result['elapsed_ms']:.0f} ms"
+            )
+        return result
+
+    def refresh_upcoming_charges(self, batch_size: int = 1000) -> int:
+        """
+        Сдвинуть окно календаря списаний: удалить прошедшие даты и
+        достроить календарь всех активных подписок до горизонта
+        """
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM upcoming_charges WHERE charge_date < CURRENT_DATE")
+
+        total, after_id = 0, 0
+        while True:
+            with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"""
+                    SELECT {SUBSCRIPTION_TOTALS_COLUMNS}
+                    FROM subscriptions
+                    WHERE is_active = TRUE AND id > %s
+                    ORDER BY id
+                    LIMIT %s
+                """, (after_id, batch_size))
+                batch = cur.fetchall()
+                if not batch:
+                    break
+                self._refresh_upcoming_charges(cur, batch)
+
+            total += len(batch)
+            after_id = batch[-1]['id']
+            if len(batch) < batch_size:
+                break
+
+        return total
+
+    def run_renewal_maintenance(self, batch_size: int = 1000) -> Dict:
+        """
+        Периодическое обслуживание календаря: перенос next_payment
+        и сдвиг окна (окно достаточно сдвигать раз в сутки)
+        """
+        started = time.perf_counter()
+        rolled = self.roll_next_payments(batch_size)
+        refreshed = 0
+        if self._charges_refreshed_on != date.today():
+            refreshed = self.refresh_upcoming_charges(batch_size)
+            self._charges_refreshed_on = date.today()
+        result = {
+            'advanced': rolled['advanced'],
+            'reminders': rolled['reminders'],
+            'advance_ms': rolled['elapsed_ms'],
+            'refreshed': refreshed,
+            'elapsed_ms': (time.perf_counter() - started) * 1000,
+        }
+        logger.info(f"Renewal maintenance: {result}")
+        return result
+
     def get_admin_stats(self) -> Dict:
-        """Получить статистику для админ-панели"""
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # Общая статистика
-        cur.execute("""
-            SELECT 
-                (SELECT COUNT(*) FROM users) as total_users,
-                (SELECT COUNT(*) FROM users WHERE is_premium = TRUE) as premium_users,
-                (SELECT COUNT(*) FROM subscriptions) as total_subscriptions,
-                (SELECT COUNT(*) FROM subscriptions WHERE is_active = TRUE) as active_subscriptions,
-                (SELECT COALESCE(SUM(price), 0) FROM subscriptions WHERE is_active = TRUE) as total_revenue,
-                (SELECT COUNT(*) FROM users WHERE DATE(created_at) = CURRENT_DATE) as new_users_today,
-                (SELECT COUNT(*) FROM subscriptions WHERE DATE(created_at) = CURRENT_DATE) as new_subscriptions_today
-        """)
-        
-        stats = dict(cur.fetchone())
-        
-        cur.close()
-        conn.close()
-        
+        """Получить статистику для админ-панели из счетчиков"""
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT name, SUM(value) FROM stats_counters GROUP BY name")
+            totals = dict(cur.fetchall())
+            cur.execute("""
+                SELECT name, SUM(value) FROM daily_counters
+                WHERE day = CURRENT_DATE
+                GROUP BY name
+            """)
+            today = dict(cur.fetchall())
+
+        stats = {
+            name: int(totals.get(name, 0))
+            for name in ('total_users', 'premium_users', 'total_subscriptions', 'active_subscriptions')
+        }
+        # Выручка по валютам пересчитывается в базовую валюту курсов
+        revenue = {
+            name.split(':', 1)[1] or None: value
+            for name, value in totals.items() if name.startswith('revenue:') and value
+        }
+        stats['currency'] = self.fx.base
+        stats['total_revenue'], stats['unconverted_revenue'] = self.fx.convert_totals(revenue, self.fx.base)
+        stats['new_users_today'] = int(today.get('new_users', 0))
+        stats['new_subscriptions_today'] = int(today.get('new_subscriptions', 0))
         return stats
-    
+
+    def rollup_daily_stats(self) -> List:
+        """
+        Закрыть прошедшие дни: перенести дневные счетчики в daily_stats
+        и снять срез MRR по валютам за вчера. Повторный запуск ничего не меняет
+        """
+        with self.connection() as conn, conn.cursor() as cur:
+            # Несколько процессов бота не должны закрывать дни одновременно
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('rollup_daily_stats'))")
+
+            cur.execute("""
+                WITH days AS (
+                    SELECT d::date AS day
+                    FROM generate_series(
+                        COALESCE(
+                            (SELECT MAX(day) + 1 FROM daily_stats),
+                            (SELECT MIN(day) FROM daily_counters),
+                            CURRENT_DATE - 1
+                        ),
+                        CURRENT_DATE - 1,
+                        INTERVAL '1 day'
+                    ) d
+                ), totals AS (
+                    SELECT name, SUM(value) AS value FROM stats_counters GROUP BY name
+                )
+                INSERT INTO daily_stats (day, new_users, new_subscriptions, premium_conversions,
+                                         total_users, premium_users, active_subscriptions)
+                SELECT
+                    days.day,
+                    COALESCE(SUM(c.value) FILTER (WHERE c.name = 'new_users'), 0),
+                    COALESCE(SUM(c.value) FILTER (WHERE c.name = 'new_subscriptions'), 0),
+                    COALESCE(SUM(c.value) FILTER (WHERE c.name = 'premium_conversions'), 0),
+                    CASE WHEN days.day = CURRENT_DATE - 1
+                        THEN (SELECT value FROM totals WHERE name = 'total_users') END,
+                    CASE WHEN days.day = CURRENT_DATE - 1
+                        THEN (SELECT value FROM totals WHERE name = 'premium_users') END,
+                    CASE WHEN days.day = CURRENT_DATE - 1
+                        THEN (SELECT value FROM totals WHERE name = 'active_subscriptions') END
+                FROM days
+                LEFT JOIN daily_counters c ON c.day = days.day
+                GROUP BY days.day
+                ON CONFLICT (day) DO NOTHING
+                RETURNING day
+            """)
+            closed = sorted(row[0] for row in cur.fetchall())
+            if not closed:
+                return []
+
+            cur.execute("""
+                INSERT INTO daily_mrr (day, currency, mrr, active_subscriptions)
+                SELECT CURRENT_DATE - 1, currency, SUM(monthly_cost), SUM(active_subscriptions)
+                FROM user_category_spending
+                WHERE active_subscriptions > 0
+                GROUP BY currency
+                ON CONFLICT (day, currency) DO NOTHING
+            """)
+
+            # Счетчики закрытых дней больше не нужны
+            cur.execute("DELETE FROM daily_counters WHERE day <= %s", (closed[-1],))
+
+        logger.info(f"Daily stats rolled up for {closed[0]}..{closed[-1]}")
+        return closed
+
+    def get_daily_stats(self, days: int = 7) -> List[Dict]:
+        """История за последние days закрытых дней (новые сверху) с MRR по валютам"""
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT s.*,
+                       COALESCE(jsonb_object_agg(m.currency, m.mrr)
+                                FILTER (WHERE m.currency IS NOT NULL), '{}') AS mrr
+                FROM daily_stats s
+                LEFT JOIN daily_mrr m ON m.day = s.day
+                WHERE s.day >= CURRENT_DATE - %s
+                GROUP BY s.day
+                ORDER BY s.day DESC
+            """, (days,))
+
+            return [dict(row) for row in cur.fetchall()]
+
     # === КАТЕГОРИИ ===
-    
+
     def get_categories(self) -> List[Dict]:
         """Получить все категории"""
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute("SELECT * FROM categories ORDER BY name")
-        categories = cur.fetchall()
-        
-        cur.close()
-        conn.close()
-        
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT * FROM categories ORDER BY name")
+            categories = cur.fetchall()
+
         return [dict(cat) for cat in categories]
-    
+
     # === УВЕДОМЛЕНИЯ ===
-    
+
     def _create_notifications_for_subscription(self, cur, user_id: int, subscription_id: int, next_payment):
         """Создать уведомления для подписки"""
-        user = self.get_user(user_id)
-        if not user or not user.get('notifications_enabled'):
+        cur.execute("""
+            SELECT notifications_enabled, notification_days FROM users WHERE user_id = %s
+        """, (user_id,))
+        user = cur.fetchone()
+        if not user or not user[0]:
             return
-        
-        notification_days = user.get('notification_days', 3)
+
+        notification_days = user[1] if user[1] is not None else 3
+        if isinstance(next_payment, str):
+            next_payment = datetime.strptime(next_payment, '%Y-%m-%d')
         notification_date = next_payment - timedelta(days=notification_days)
-        
+
         cur.execute("""
             INSERT INTO notifications (user_id, subscription_id, notification_type, scheduled_date)
             VALUES (%s, %s, %s, %s)
         """, (user_id, subscription_id, 'renewal', notification_date))
-    
-    def get_pending_notifications(self) -> List[Dict]:
-        """Получить неотправленные уведомления"""
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute("""
-            SELECT n.*, s.name as subscription_name, s.price, u.language
-            FROM notifications n
-            JOIN subscriptions s ON n.subscription_id = s.id
-            JOIN users u ON n.user_id = u.user_id
-            WHERE n.is_sent = FALSE 
-            AND n.scheduled_date <= CURRENT_TIMESTAMP
-            AND u.notifications_enabled = TRUE
-        """)
-        
-        notifications = cur.fetchall()
-        
-        cur.close()
-        conn.close()
-        
-        return [dict(n) for n in notifications]
-    
-    def mark_notification_sent(self, notification_id: int):
-        """Отметить уведомление как отправленное"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        
+
+        # Разбудить планировщики уведомлений; NOTIFY доставляется при коммите
         cur.execute("""
-            UPDATE notifications 
-            SET is_sent = TRUE, sent_at = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (notification_id,))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+            SELECT pg_notify(%s, EXTRACT(EPOCH FROM (%s::timestamp - CURRENT_TIMESTAMP))::text)
+        """, (self.notification_channel, notification_date))
+
+    def get_seconds_until_next_notification(self) -> Optional[float]:
+        """
+        Через сколько секунд наступит срок ближайшего неотправленного уведомления
+        (с учетом аренды); None, если очередь пуста. Считается на стороне БД,
+        чтобы не зависеть от расхождения часов
+        """
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT EXTRACT(EPOCH FROM (
+                    MIN(GREATEST(n.scheduled_date, COALESCE(n.lease_until, n.scheduled_date)))
+                    - CURRENT_TIMESTAMP
+                ))
+                FROM notifications n
+                JOIN users u ON n.user_id = u.user_id
+                WHERE n.is_sent = FALSE
+                AND u.notifications_enabled = TRUE
+            """)
+            delay = cur.fetchone()[0]
+
+        return float(delay) if delay is not None else None
+
+    def create_listen_connection(self):
+        """Отдельное подключение (вне пула) с LISTEN на канал новых уведомлений"""
+        conn = psycopg2.connect(**self.connection_params)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN {self.notification_channel}")
+        return conn
+
+    def claim_notifications(self, worker_id: str, limit: int = 500, lease_seconds: int = 300) -> List[Dict]:
+        """
+        Атомарно арендовать до limit готовых к отправке уведомлений.
+        Строки, заблокированные другим воркером, пропускаются (SKIP LOCKED);
+        уведомления с истекшей арендой (воркер упал или не смог отправить)
+        снова становятся доступны
+        """
+        with self.connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                WITH claimable AS (
+                    SELECT n.id, n.claimed_by AS previous_owner
+                    FROM notifications n
+                    JOIN users u ON n.user_id = u.user_id
+                    WHERE n.is_sent = FALSE
+                    AND n.scheduled_date <= CURRENT_TIMESTAMP
+                    AND u.notifications_enabled = TRUE
+                    AND (n.lease_until IS NULL OR n.lease_until < CURRENT_TIMESTAMP)
+                    ORDER BY n.id
+                    LIMIT %s
+                    FOR UPDATE OF n SKIP LOCKED
+                ), claimed AS (
+                    UPDATE notifications n
+                    SET claimed_by = %s,
+                        lease_until = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                    FROM claimable c
+                    WHERE n.id = c.id
+                    RETURNING n.*, c.previous_owner
+                )
+                SELECT claimed.*, s.name as subscription_name, s.price, u.language
+                FROM claimed
+                JOIN subscriptions s ON claimed.subscription_id = s.id
+                JOIN users u ON claimed.user_id = u.user_id
+                ORDER BY claimed.id
+            """, (limit, worker_id, lease_seconds))
+
+            notifications = cur.fetchall()
+
+        reclaimed = sum(1 for n in notifications if n['previous_owner'])
+        if reclaimed:
+            logger.warning(f"Worker {worker_id} reclaimed {reclaimed} notifications with expired leases")
+        return notifications
+
+    def mark_notifications_sent(self, notification_ids: List[int]):
+        """Отметить пачку уведомлений как отправленные одним запросом"""
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE notifications
+                SET is_sent = TRUE, sent_at = CURRENT_TIMESTAMP, lease_until = NULL
+                WHERE id = ANY(%s)
+            """, (list(notification_ids),))
+
+
+class AsyncDatabase:
+    """
+    Асинхронная обертка над Database с тем же набором методов.
+    Блокирующие вызовы psycopg2 выполняются через DBDispatcher:
+    ограниченный пул потоков размером с пул подключений, с очередью
+    ограниченной длины и метриками по каждому методу
+    """
+
+    def __init__(self, db: Database, dispatcher: Optional[DBDispatcher] = None):
+        from config import DB_DISPATCH_MAX_QUEUE, DB_DISPATCH_QUEUE_TIMEOUT, DB_SLOW_CALL_MS
+
+        self.db = db
+        self.dispatcher = dispatcher or DBDispatcher(
+            max_workers=db.pool.max_size,
+            max_queue=DB_DISPATCH_MAX_QUEUE,
+            queue_timeout=DB_DISPATCH_QUEUE_TIMEOUT,
+            slow_call_ms=DB_SLOW_CALL_MS
+        )
+
+    def __getattr__(self, name):
+        attr = getattr(self.db, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            return await self.dispatcher.run(attr, *args, **kwargs)
+
+        return call
+
+    async def iter_claimed_notifications(self, worker_id: str, page_size: int = 500,
+                                         lease_seconds: int = 300) -> AsyncIterator[List[Dict]]:
+        """
+        Арендовать и перебрать готовые уведомления пачками по page_size.
+        Каждую пачку нужно отметить отправленной до запроса следующей;
+        неудачные остаются арендованными до конца аренды, поэтому
+        перебор завершается, когда свободных уведомлений не осталось
+        """
+        while True:
+            page = await self.dispatcher.run(self.db.claim_notifications, worker_id, page_size, lease_seconds)
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+
+    def dispatcher_stats(self) -> Dict:
+        """Метрики очереди вызовов БД"""
+        return self.dispatcher.stats()
+
+    def cache_stats(self) -> Dict:
+        """Счетчики кэша пользователей (без обращения к пулу потоков)"""
+        return self.db.cache_stats()
+
+    def close(self):
+        """Остановить пул потоков и закрыть подключения"""
+        self.dispatcher.shutdown()
+        self.db.close()
@@ -0,0 +1,133 @@
+"""
+Диспетчер блокирующих вызовов БД
+Выполняет синхронные запросы в ограниченном пуле потоков,
+чтобы медленный запрос одного пользователя не останавливал event loop.
+Модуль не зависит от конфигурации бота и используется обоими ботами
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class DispatcherOverloadedError(Exception):
+    """Очередь вызовов БД переполнена (сработала защита от перегрузки)"""
+
+
+class DBDispatcher:
+    """
+    Ограниченный пул потоков для вызовов БД с метриками.
+
+    Одновременно принимается не более max_workers + max_queue вызовов;
+    остальные ждут свободного места до queue_timeout секунд и затем
+    получают DispatcherOverloadedError
+    """
+
+    def __init__(self, max_workers: int, max_queue: int, queue_timeout: Optional[float] = None,
+                 slow_call_ms: float = 500, name: str = 'db'):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_workers + max_queue
+        self.queue_timeout = queue_timeout
+        self.slow_call_ms = slow_call_ms
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._rejected = 0
+        self._calls: Dict[str, Dict] = {}
+
+    def _get_slots(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        return self._slots
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """Выполнить func(*args, **kwargs) в пуле потоков и вернуть результат"""
+        slots = self._get_slots()
+        try:
+            await asyncio.wait_for(slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._rejected += 1
+            raise DispatcherOverloadedError(
+                f"{self.name}: {self.max_pending} calls already pending"
+            ) from None
+
+        with self._lock:
+            self._pending += 1
+        submitted = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(
+                self._executor,
+                functools.partial(self._timed_call, func, submitted, args, kwargs)
+            )
+        finally:
+            with self._lock:
+                self._pending -= 1
+            slots.release()
+
+    def _timed_call(self, func: Callable, submitted: float, args, kwargs):
+        started = time.perf_counter()
+        with self._lock:
+            self._running += 1
+        failed = False
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            finished = time.perf_counter()
+            self._record(getattr(func, '__qualname__', repr(func)),
+                         started - submitted, finished - started, failed)
+
+    def _record(self, call_name: str, queued: float, elapsed: float, failed: bool):
+        with self._lock:
+            self._running -= 1
+            stats = self._calls.setdefault(call_name, {
+                'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'queue_ms': 0.0
+            })
+            stats['calls'] += 1
+            stats['errors'] += failed
+            stats['total_ms'] += elapsed * 1000
+            stats['max_ms'] = max(stats['max_ms'], elapsed * 1000)
+            stats['queue_ms'] += queued * 1000
+
+        if elapsed * 1000 >= self.slow_call_ms:
+            logger.warning(f"Slow DB call {call_name}: {elapsed * 1000:.0f} ms "
+                           f"(queued {queued * 1000:.0f} ms)")
+
+    def stats(self) -> Dict:
+        """Метрики: глубина очереди, активные вызовы и время по каждому вызову"""
+        with self._lock:
+            calls = {
+                name: {
+                    'calls': s['calls'],
+                    'errors': s['errors'],
+                    'avg_ms': s['total_ms'] / s['calls'],
+                    'max_ms': s['max_ms'],
+                    'avg_queue_ms': s['queue_ms'] / s['calls'],
+                }
+                for name, s in self._calls.items()
+            }
+            return {
+                'workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'pending': self._pending,
+                'running': self._running,
+                'queued': self._pending - self._running,
+                'rejected': self._rejected,
+                'calls': calls,
+            }
+
+    def shutdown(self):
+        """Дождаться завершения вызовов и остановить пул потоков"""
+        self._executor.shutdown(wait=True)
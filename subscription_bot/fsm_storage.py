@@ -0,0 +1,194 @@
+"""
+Хранилища состояний FSM
+PostgresStorage — UNLOGGED-таблица fsm_storage в основной БД с очисткой по TTL;
+redis — штатный RedisStorage aiogram (подходит любой сервер с протоколом Redis).
+BatchedStorage держит состояние и данные в памяти на время апдейта:
+не больше одного чтения и одной записи на ключ, сколько бы раз обработчик
+ни вызывал get_state/get_data/update_data
+"""
+import contextvars
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional, Tuple
+from aiogram import Dispatcher
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+logger = logging.getLogger(__name__)
+
+# Записи FSM текущего апдейта: {строковый ключ: _Record}; None вне апдейта
+_update_records: contextvars.ContextVar[Optional[Dict[str, '_Record']]] = contextvars.ContextVar(
+    'fsm_update_records', default=None
+)
+
+
+def storage_key(key: StorageKey) -> str:
+    """Строковый ключ записи: bot:chat:user:thread:destiny"""
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+
+def _state_name(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+class PostgresStorage(BaseStorage):
+    """Состояния FSM в таблице fsm_storage; db — AsyncDatabase"""
+
+    def __init__(self, db, ttl: int):
+        self.db = db
+        self.ttl = ttl
+
+    async def get_record(self, key: StorageKey) -> Tuple[Optional[str], Dict]:
+        record = await self.db.get_fsm_record(storage_key(key), self.ttl)
+        return record if record is not None else (None, {})
+
+    async def set_records(self, records):
+        """Записать пачку (StorageKey, state, data) одним обращением к БД"""
+        await self.db.save_fsm_records([(storage_key(key), state, data) for key, state, data in records])
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        _, data = await self.get_record(key)
+        await self.set_records([(key, _state_name(state), data)])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self.get_record(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        state, _ = await self.get_record(key)
+        await self.set_records([(key, state, dict(data))])
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self.get_record(key))[1])
+
+    async def cleanup(self) -> int:
+        """Удалить записи старше TTL (периодическая задача)"""
+        return await self.db.cleanup_fsm_records(self.ttl)
+
+    async def close(self) -> None:
+        pass
+
+
+class _Record:
+    __slots__ = ('key', 'state', 'data', 'dirty')
+
+    def __init__(self, key: StorageKey, state: Optional[str], data: Dict):
+        self.key = key
+        self.state = state
+        self.data = data
+        self.dirty = False
+
+
+class BatchedStorage(BaseStorage):
+    """
+    Обертка над любым хранилищем: внутри batch() запись читается один раз
+    при первом обращении, изменения копятся в памяти и записываются при выходе.
+    Вне batch() вызовы передаются хранилищу напрямую
+    """
+
+    def __init__(self, inner: BaseStorage):
+        self.inner = inner
+        self.reads = 0
+        self.writes = 0
+
+    @asynccontextmanager
+    async def batch(self):
+        """Границы апдейта: все изменения FSM записываются при выходе"""
+        records: Dict[str, _Record] = {}
+        token = _update_records.set(records)
+        try:
+            yield
+        finally:
+            _update_records.reset(token)
+            await self._flush(records)
+
+    async def _read(self, key: StorageKey) -> Tuple[Optional[str], Dict]:
+        self.reads += 1
+        if isinstance(self.inner, PostgresStorage):
+            return await self.inner.get_record(key)
+        return await self.inner.get_state(key), await self.inner.get_data(key)
+
+    async def _record(self, key: StorageKey) -> Optional[_Record]:
+        records = _update_records.get()
+        if records is None:
+            return None
+        name = storage_key(key)
+        record = records.get(name)
+        if record is None:
+            state, data = await self._read(key)
+            record = records[name] = _Record(key, state, dict(data))
+        return record
+
+    async def _flush(self, records: Dict[str, _Record]):
+        dirty = [record for record in records.values() if record.dirty]
+        if not dirty:
+            return
+        self.writes += 1
+        if isinstance(self.inner, PostgresStorage):
+            await self.inner.set_records([(r.key, r.state, r.data) for r in dirty])
+            return
+        for record in dirty:
+            await self.inner.set_state(record.key, record.state)
+            await self.inner.set_data(record.key, record.data)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        if record is None:
+            return await self.inner.set_state(key, state)
+        record.state = _state_name(state)
+        record.dirty = True
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._record(key)
+        if record is None:
+            return await self.inner.get_state(key)
+        return record.state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._record(key)
+        if record is None:
+            return await self.inner.set_data(key, data)
+        record.data = dict(data)
+        record.dirty = True
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await self._record(key)
+        if record is None:
+            return await self.inner.get_data(key)
+        return dict(record.data)
+
+    async def close(self) -> None:
+        await self.inner.close()
+
+    def stats(self) -> Dict:
+        return {'backend': type(self.inner).__name__, 'reads': self.reads, 'writes': self.writes}
+
+
+class BatchedDispatcher(Dispatcher):
+    """
+    Диспетчер, открывающий пакет FSM на весь апдейт. Пакет открывается
+    до middleware aiogram, поэтому чтение raw_state тоже попадает в пакет
+    """
+
+    def __init__(self, *, storage: BatchedStorage, **kwargs):
+        super().__init__(storage=storage, **kwargs)
+        self.batched_storage = storage
+
+    async def feed_update(self, bot, update, **kwargs):
+        async with self.batched_storage.batch():
+            return await super().feed_update(bot, update, **kwargs)
+
+
+def create_storage(backend: str, db=None, redis_url: str = '', ttl: int = 86400) -> BatchedStorage:
+    """Хранилище по настройке FSM_STORAGE: 'memory', 'postgres' или 'redis'"""
+    if backend == 'postgres':
+        inner = PostgresStorage(db, ttl)
+    elif backend == 'redis':
+        # redis — необязательная зависимость, нужна только этому режиму
+        from aiogram.fsm.storage.redis import RedisStorage
+        inner = RedisStorage.from_url(redis_url, state_ttl=ttl, data_ttl=ttl)
+    else:
+        inner = MemoryStorage()
+
+    logger.info(f"FSM storage: {type(inner).__name__}")
+    return BatchedStorage(inner)
@@ -0,0 +1,120 @@
+"""
+Middleware бота управления подписками
+Загрузка данных пользователя один раз на апдейт, ограничение параллельности
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+
+class UserContext:
+    """
+    Строка пользователя из таблицы users, загруженная один раз на апдейт.
+    Изменения настроек выполняются через методы контекста, чтобы
+    обработчик и клавиатуры видели актуальные значения без повторного SELECT
+    """
+
+    def __init__(self, db, user_id: int, data: Optional[Dict] = None):
+        self.db = db
+        self.user_id = user_id
+        self.data = data or {}
+
+    @property
+    def exists(self) -> bool:
+        return bool(self.data)
+
+    @property
+    def language(self) -> str:
+        return self.data.get('language') or 'ru'
+
+    @property
+    def theme(self) -> str:
+        return self.data.get('theme') or 'light'
+
+    @property
+    def display_currency(self) -> str:
+        return self.data.get('display_currency') or 'USD'
+
+    @property
+    def notifications_enabled(self) -> bool:
+        return self.data.get('notifications_enabled', True)
+
+    @property
+    def is_premium(self) -> bool:
+        return bool(self.data.get('is_premium'))
+
+    async def refresh(self):
+        """Перечитать пользователя из БД"""
+        self.data = await self.db.get_user(self.user_id) or {}
+
+    async def update_language(self, language: str):
+        await self.db.update_user_language(self.user_id, language)
+        self.data['language'] = language
+
+    async def update_notifications(self, enabled: bool):
+        await self.db.update_user_notifications(self.user_id, enabled)
+        self.data['notifications_enabled'] = enabled
+
+    async def update_display_currency(self, currency: str):
+        await self.db.update_user_display_currency(self.user_id, currency)
+        self.data['display_currency'] = currency
+
+    async def update_theme(self, theme: str):
+        await self.db.update_user_theme(self.user_id, theme)
+        self.data['theme'] = theme
+
+    async def activate_premium_trial(self, days: int = 7):
+        await self.db.activate_premium_trial(self.user_id, days=days)
+        await self.refresh()
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Кладет UserContext в data['user_ctx'] для обработчиков"""
+
+    def __init__(self, db):
+        self.db = db
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        from_user = data.get('event_from_user')
+        if from_user is not None:
+            user = await self.db.get_user(from_user.id)
+            data['user_ctx'] = UserContext(self.db, from_user.id, user)
+        return await handler(event, data)
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """
+    Outer middleware на dp.update: не больше limit апдейтов обрабатываются
+    одновременно, остальные ждут своей очереди (webhook принимает апдейты
+    в фоне, и без ограничения всплеск создал бы неограниченное число задач к БД)
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit)
+        self.waiting = 0
+        self.running = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.running -= 1
+            self._semaphore.release()
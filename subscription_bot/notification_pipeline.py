@@ -0,0 +1,314 @@
+"""
+Многопроцессная рассылка уведомлений
+producer (процесс бота) арендует уведомления пачками и раскладывает их
+по процессам-отправителям через консистентное хеширование user_id: чат всегда
+обслуживает один процесс, поэтому лимит на чат соблюдается локально.
+Каждый отправитель рендерит тексты и шлет их через свою aiohttp-сессию
+со своим token bucket (NOTIFICATION_GLOBAL_RATE делится между процессами).
+collector (процесс бота) собирает ID отправленных и подтверждает их
+в БД пачками
+"""
+import asyncio
+import logging
+import multiprocessing
+import queue
+import sys
+import time
+import types
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, List
+import aiohttp
+from notifications import render_notification
+from rate_limit import PerChatLimiter, TokenBucket
+from sharding import HashRing
+
+logger = logging.getLogger(__name__)
+
+SEND_MESSAGE_URL = 'https://api.telegram.org/bot{token}/sendMessage'
+
+# Поля уведомления, нужные отправителю (остальное не передается между процессами)
+SENDER_FIELDS = ('id', 'user_id', 'notification_type', 'language', 'subscription_name', 'price')
+
+
+@contextmanager
+def _main_module_hidden():
+    """
+    spawn заново выполняет в дочернем процессе запущенный скрипт (bot.py)
+    со всей его инициализацией: пулом БД, Bot, FSM storage. Отправителю
+    нужен только этот модуль, поэтому на время запуска процесса главный
+    модуль подменяется пустым и в дочерний процесс не передается
+    """
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main
+
+
+def run_sender(name: str, token: str, tasks, results, rate: float, per_chat_interval: float,
+               max_in_flight: int, max_retries: int):
+    """Точка входа процесса-отправителя"""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(_sender_main(name, token, tasks, results, rate, per_chat_interval, max_in_flight, max_retries))
+
+
+async def _sender_main(name, token, tasks, results, rate, per_chat_interval, max_in_flight, max_retries):
+    loop = asyncio.get_running_loop()
+    global_limiter = TokenBucket(rate)
+    chat_limiter = PerChatLimiter(per_chat_interval)
+    in_flight = asyncio.Semaphore(max_in_flight)
+    url = SEND_MESSAGE_URL.format(token=token)
+
+    async with aiohttp.ClientSession() as session:
+        retries = 0
+
+        async def send(notification: Dict) -> bool:
+            nonlocal retries
+            text = render_notification(notification)
+            async with in_flight:
+                for attempt in range(max_retries + 1):
+                    await chat_limiter.acquire(notification['user_id'])
+                    await global_limiter.acquire()
+                    try:
+                        async with session.post(url, json={'chat_id': notification['user_id'], 'text': text}) as response:
+                            payload = await response.json()
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        logger.error(f"Error sending notification {notification['id']}: {e}")
+                        return False
+
+                    if payload.get('ok'):
+                        return True
+                    retry_after = (payload.get('parameters') or {}).get('retry_after')
+                    if retry_after is None:
+                        logger.error(f"Notification {notification['id']} rejected: {payload.get('description')}")
+                        return False
+                    # Флуд-лимит: притормозить все отправки этого процесса
+                    retries += 1
+                    logger.warning(f"Telegram RetryAfter {retry_after}s "
+                                   f"(notification {notification['id']}, attempt {attempt + 1})")
+                    global_limiter.pause(retry_after)
+            return False
+
+        while True:
+            batch = await loop.run_in_executor(None, tasks.get)
+            if batch is None:
+                break
+            started = time.monotonic()
+            retries = 0
+            sent = await asyncio.gather(*(send(n) for n in batch))
+            results.put((
+                name,
+                [n['id'] for n, ok in zip(batch, sent) if ok],
+                sum(1 for ok in sent if not ok),
+                retries,
+                time.monotonic() - started,
+            ))
+
+
+class StageMetrics:
+    """Счетчик этапа: сколько элементов прошло и сколько времени этап был занят"""
+
+    __slots__ = ('items', 'calls', 'busy')
+
+    def __init__(self):
+        self.items = 0
+        self.calls = 0
+        self.busy = 0.0
+
+    def add(self, items: int, seconds: float):
+        self.items += items
+        self.calls += 1
+        self.busy += seconds
+
+    def as_dict(self, elapsed: float) -> Dict:
+        return {
+            'items': self.items,
+            'calls': self.calls,
+            'busy_s': round(self.busy, 3),
+            'per_second': round(self.items / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+
+
+class NotificationPipeline:
+    """Процессы-отправители и collector; run() обрабатывает одну выборку уведомлений"""
+
+    def __init__(self, db, token: str, workers: int, rate: float, per_chat_interval: float,
+                 max_in_flight: int, max_retries: int, ack_batch: int = 500, ack_interval: float = 1.0,
+                 max_pending: int = 5000):
+        self.db = db
+        self.token = token
+        self.worker_count = workers
+        # Общий лимит процесса бота делится между отправителями
+        self.sender_args = (rate / workers, per_chat_interval, max_in_flight, max_retries)
+        self.ack_batch = ack_batch
+        self.ack_interval = ack_interval
+        self.max_pending = max_pending
+        self.ring = HashRing()
+        self.tasks: Dict[str, object] = {}
+        self.processes: Dict[str, multiprocessing.Process] = {}
+        # Метка текущего процесса узла кольца: результаты, которые упавший
+        # процесс успел отправить, не уменьшают счетчик его замены
+        self.labels: Dict[str, str] = {}
+        self.restarts = 0
+        self.last_run: Dict = {}
+        self._context = multiprocessing.get_context('spawn')
+        self._results = None
+        self._collector = None
+        self._pending: Dict[str, int] = defaultdict(int)
+        self._drained = asyncio.Event()
+        self._to_ack: List[int] = []
+        self._reset_metrics()
+
+    def _reset_metrics(self):
+        self.producer = StageMetrics()
+        self.senders = defaultdict(StageMetrics)
+        self.collector = StageMetrics()
+        self.failed = 0
+        self.retries = 0
+        self.lost = 0
+
+    def _spawn(self, name: str):
+        """Запустить процесс-отправитель узла name с новой очередью"""
+        label = f"{name}#{self.restarts}"
+        self.tasks[name] = self._context.Queue()
+        self.labels[name] = label
+        self.processes[name] = self._context.Process(
+            target=run_sender,
+            args=(label, self.token, self.tasks[name], self._results) + self.sender_args,
+            name=label,
+            daemon=True
+        )
+        with _main_module_hidden():
+            self.processes[name].start()
+
+    def start(self):
+        """Запустить процессы-отправители и collector"""
+        self._results = self._context.Queue()
+        for i in range(self.worker_count):
+            name = f"sender-{i}"
+            self._spawn(name)
+            self.ring.add_node(name)
+        self._collector = asyncio.create_task(self._collect())
+        logger.info(f"Notification pipeline started with {self.worker_count} senders")
+
+    def stop(self):
+        for name, tasks in self.tasks.items():
+            tasks.put(None)
+        for process in self.processes.values():
+            process.join(timeout=5)
+        if self._collector is not None:
+            self._collector.cancel()
+
+    def _replace_dead(self):
+        """
+        Перезапустить упавших отправителей с новыми очередями: узел остается
+        в кольце, и его пользователи не попадают в очередь, которую никто не читает.
+        Уведомления, переданные упавшему процессу, снова арендуются
+        после истечения аренды
+        """
+        for name, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            lost = self._pending.pop(name, 0)
+            self.lost += lost
+            logger.error(f"Notification sender {self.labels[name]} died with exit code {process.exitcode}, "
+                         f"{lost} notifications left to lease expiry; restarting")
+            self.restarts += 1
+            self._spawn(name)
+        self._check_drained()
+
+    def _check_drained(self):
+        if not any(self._pending.values()):
+            self._drained.set()
+
+    # === PRODUCER ===
+
+    async def run(self, batches: AsyncIterator[List[Dict]]) -> Dict:
+        """Разослать все пачки из batches; вернуть метрики этапов"""
+        self._reset_metrics()
+        started = time.monotonic()
+        self._drained.set()
+        self._replace_dead()
+
+        async for batch in batches:
+            produced_at = time.monotonic()
+            by_sender = defaultdict(list)
+            for notification in batch:
+                by_sender[self.ring.node_for(notification['user_id'])].append(
+                    {field: notification.get(field) for field in SENDER_FIELDS}
+                )
+            for name, items in by_sender.items():
+                self.tasks[name].put(items)
+                self._pending[name] += len(items)
+            self._drained.clear()
+            self.producer.add(len(batch), time.monotonic() - produced_at)
+
+            # Не арендовать больше, чем отправители успеют до истечения аренды
+            while sum(self._pending.values()) >= self.max_pending:
+                self._replace_dead()
+                await asyncio.sleep(0.05)
+
+        while not self._drained.is_set():
+            self._replace_dead()
+            try:
+                await asyncio.wait_for(self._drained.wait(), self.ack_interval)
+            except asyncio.TimeoutError:
+                pass
+        await self._flush_acks()
+
+        elapsed = time.monotonic() - started
+        self.last_run = {
+            'elapsed_s': round(elapsed, 3),
+            'producer': self.producer.as_dict(elapsed),
+            'senders': {name: m.as_dict(elapsed) for name, m in sorted(self.senders.items())},
+            'collector': self.collector.as_dict(elapsed),
+            'failed': self.failed,
+            'retries': self.retries,
+            'lost': self.lost,
+            'restarts': self.restarts,
+        }
+        return self.last_run
+
+    # === COLLECTOR ===
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        last_flush = time.monotonic()
+        while True:
+            try:
+                label, sent_ids, failed, retries, seconds = await loop.run_in_executor(
+                    None, self._results.get, True, self.ack_interval
+                )
+                name = label.rsplit('#', 1)[0]
+            except queue.Empty:
+                name = None
+
+            if name is not None:
+                self.senders[name].add(len(sent_ids) + failed, seconds)
+                self.failed += failed
+                self.retries += retries
+                self._to_ack.extend(sent_ids)
+
+            if len(self._to_ack) >= self.ack_batch or (self._to_ack and time.monotonic() - last_flush >= self.ack_interval):
+                await self._flush_acks()
+                last_flush = time.monotonic()
+
+            # Подтверждения упавшего процесса учтены выше, но его счетчик уже сброшен
+            if name is not None and self.labels.get(name) == label:
+                self._pending[name] = max(0, self._pending[name] - len(sent_ids) - failed)
+                self._check_drained()
+
+    async def _flush_acks(self):
+        """Одно UPDATE на накопленные ID; неподтвержденные вернутся в очередь по истечении аренды"""
+        if not self._to_ack:
+            return
+        ids, self._to_ack = self._to_ack, []
+        started = time.monotonic()
+        try:
+            await self.db.mark_notifications_sent(ids)
+        except Exception as e:
+            logger.error(f"Failed to acknowledge {len(ids)} notifications: {e}")
+            return
+        self.collector.add(len(ids), time.monotonic() - started)
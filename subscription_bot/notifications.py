@@ -3,29 +3,117 @@
 Автоматическая отправка уведомлений о продлении подписок
 """
 import asyncio
+import heapq
 import logging
+import os
+import socket
+import time
 from datetime import datetime
 from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from config import (
+    NOTIFICATION_GLOBAL_RATE, NOTIFICATION_PER_CHAT_INTERVAL,
+    NOTIFICATION_MAX_IN_FLIGHT, NOTIFICATION_BATCH_SIZE, NOTIFICATION_MAX_RETRIES,
+    NOTIFICATION_LEASE_SECONDS, NOTIFICATION_CHECK_INTERVAL, NOTIFICATION_LISTEN
+)
+from rate_limit import TokenBucket, PerChatLimiter
 
 logger = logging.getLogger(__name__)
 
+# Тексты уведомлений по типу и языку; неизвестный тип — общее уведомление,
+# любой язык, кроме русского, — английский
+NOTIFICATION_TEMPLATES = {
+    'renewal': {
+        'ru': """🔔 Напоминание о продлении подписки
+
+💳 Подписка: {name}
+💰 Сумма: ${price}
+📅 Скоро спишутся средства
+
+Не забудьте проверить баланс!""",
+        'en': """🔔 Subscription renewal reminder
+
+💳 Subscription: {name}
+💰 Amount: ${price}
+📅 Funds will be debited soon
+
+Don't forget to check your balance!""",
+    },
+    'trial_end': {
+        'ru': """⏰ Окончание пробного периода
+
+💳 Подписка: {name}
+💰 После окончания пробного периода будет списано: ${price}
+
+Если вы не хотите продолжать, отмените подписку!""",
+        'en': """⏰ Trial period ending
+
+💳 Subscription: {name}
+💰 After trial ends, you will be charged: ${price}
+
+If you don't want to continue, cancel the subscription!""",
+    },
+    'default': {
+        'ru': """📢 Уведомление
+
+💳 Подписка: {name}""",
+        'en': """📢 Notification
+
+💳 Subscription: {name}""",
+    },
+}
+
+
+def render_notification(notification: dict) -> str:
+    """Текст уведомления (без обращений к боту и БД, годится для процессов пайплайна)"""
+    templates = NOTIFICATION_TEMPLATES.get(notification['notification_type'], NOTIFICATION_TEMPLATES['default'])
+    template = templates['ru'] if notification.get('language', 'ru') == 'ru' else templates['en']
+    return template.format(name=notification['subscription_name'], price=notification['price'])
+
 class NotificationService:
-    def __init__(self, bot: Bot, db):
-        """Инициализация сервиса уведомлений"""
+    def __init__(self, bot: Bot, db, pipeline=None):
+        """
+        Инициализация сервиса уведомлений. С pipeline (NotificationPipeline)
+        отправка идет в отдельных процессах, иначе в этом event loop
+        """
         self.bot = bot
         self.db = db
+        self.pipeline = pipeline
         self.is_running = False
+        # Уникальный ID процесса: под ним воркер арендует уведомления
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        # Общий лимит бота и лимит на чат; RetryAfter приостанавливает общий лимит
+        self.global_limiter = TokenBucket(NOTIFICATION_GLOBAL_RATE)
+        self.chat_limiter = PerChatLimiter(NOTIFICATION_PER_CHAT_INTERVAL)
+        self.in_flight = asyncio.Semaphore(NOTIFICATION_MAX_IN_FLIGHT)
+        # Куча моментов (time.monotonic) ближайших уведомлений и событие пробуждения
+        self._timers = []
+        self._wakeup = asyncio.Event()
+        self._listen_conn = None
     
     async def start(self):
         """Запустить сервис уведомлений"""
         self.is_running = True
         logger.info("Notification service started")
         
+        if self.pipeline is not None:
+            self.pipeline.start()
+        
+        if NOTIFICATION_LISTEN:
+            await self._start_listener()
+        
         while self.is_running:
             try:
                 await self.check_and_send_notifications()
-                # Проверять каждые 5 минут
-                await asyncio.sleep(300)
+                
+                # Все закоммиченные уведомления учтены запросом MIN, поэтому
+                # куча пересобирается; до следующей проверки ее пополняет NOTIFY
+                self._timers.clear()
+                delay = await self.db.get_seconds_until_next_notification()
+                if delay is not None:
+                    self.schedule(delay)
+                
+                await self._wait_for_due()
             except Exception as e:
                 logger.error(f"Error in notification service: {e}")
                 await asyncio.sleep(60)
@@ -33,77 +121,134 @@ class NotificationService:
     def stop(self):
         """Остановить сервис уведомлений"""
         self.is_running = False
+        self._wakeup.set()
+        self._stop_listener()
+        if self.pipeline is not None:
+            self.pipeline.stop()
         logger.info("Notification service stopped")
     
+    def schedule(self, delay: float):
+        """Запланировать проверку через delay секунд"""
+        heapq.heappush(self._timers, time.monotonic() + max(delay, 0))
+        self._wakeup.set()
+    
+    async def _wait_for_due(self):
+        """
+        Спать до ближайшего уведомления из кучи. NOTIFICATION_CHECK_INTERVAL
+        ограничивает сон сверху на случай, если LISTEN/NOTIFY недоступен
+        """
+        while self.is_running:
+            now = time.monotonic()
+            if self._timers and self._timers[0] <= now:
+                while self._timers and self._timers[0] <= now:
+                    heapq.heappop(self._timers)
+                return
+            
+            timeout = NOTIFICATION_CHECK_INTERVAL
+            if self._timers:
+                timeout = min(timeout, self._timers[0] - now)
+            
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
+    
+    async def _start_listener(self):
+        """Подписаться на NOTIFY о новых уведомлениях (add_subscription)"""
+        try:
+            self._listen_conn = await self.db.create_listen_connection()
+        except Exception as e:
+            logger.warning(f"LISTEN unavailable, falling back to polling: {e}")
+            return
+        
+        asyncio.get_running_loop().add_reader(self._listen_conn.fileno(), self._on_notify)
+    
+    def _on_notify(self):
+        """Обработать NOTIFY: payload - секунды до срока нового уведомления"""
+        try:
+            self._listen_conn.poll()
+        except Exception as e:
+            logger.warning(f"LISTEN connection lost, falling back to polling: {e}")
+            self._stop_listener()
+            return
+        
+        while self._listen_conn.notifies:
+            notify = self._listen_conn.notifies.pop(0)
+            try:
+                self.schedule(float(notify.payload))
+            except ValueError:
+                self.schedule(0)
+    
+    def _stop_listener(self):
+        if self._listen_conn is None:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self._listen_conn.fileno())
+        except Exception:
+            pass
+        self._listen_conn.close()
+        self._listen_conn = None
+    
     async def check_and_send_notifications(self):
         """Проверить и отправить неотправленные уведомления"""
-        notifications = self.db.get_pending_notifications()
+        if self.pipeline is not None:
+            metrics = await self.pipeline.run(self.db.iter_claimed_notifications(
+                self.worker_id, NOTIFICATION_BATCH_SIZE, NOTIFICATION_LEASE_SECONDS
+            ))
+            if metrics['producer']['items']:
+                logger.info(f"Notification pipeline: {metrics}")
+            return
         
-        for notification in notifications:
-            try:
-                await self.send_notification(notification)
-                self.db.mark_notification_sent(notification['id'])
-            except Exception as e:
-                logger.error(f"Error sending notification {notification['id']}: {e}")
+        started = time.monotonic()
+        sent_total = 0
+        pending_total = 0
+        # Очередь арендуется пачками: несколько процессов бота делят таблицу
+        # notifications без повторных отправок, память не зависит от бэклога
+        async for batch in self.db.iter_claimed_notifications(
+            self.worker_id, NOTIFICATION_BATCH_SIZE, NOTIFICATION_LEASE_SECONDS
+        ):
+            pending_total += len(batch)
+            sent_ids = await self.send_batch(batch)
+            if sent_ids:
+                # Одно UPDATE на пачку вместо запроса на каждое сообщение
+                await self.db.mark_notifications_sent(sent_ids)
+            sent_total += len(sent_ids)
+        
+        if pending_total:
+            logger.info(f"Notifications sent: {sent_total}/{pending_total} "
+                        f"in {time.monotonic() - started:.1f}s")
+    
+    async def send_batch(self, notifications: list) -> list:
+        """Отправить пачку уведомлений параллельно; вернуть ID отправленных"""
+        results = await asyncio.gather(*(self._send_limited(n) for n in notifications))
+        return [n['id'] for n, sent in zip(notifications, results) if sent]
+    
+    async def _send_limited(self, notification: dict) -> bool:
+        """Отправить одно уведомление с учетом лимитов Telegram"""
+        async with self.in_flight:
+            for attempt in range(NOTIFICATION_MAX_RETRIES + 1):
+                await self.chat_limiter.acquire(notification['user_id'])
+                await self.global_limiter.acquire()
+                try:
+                    await self.send_notification(notification)
+                    return True
+                except TelegramRetryAfter as e:
+                    # Флуд-лимит действует на весь бот: притормозить все отправки
+                    logger.warning(f"Telegram RetryAfter {e.retry_after}s "
+                                   f"(notification {notification['id']}, attempt {attempt + 1})")
+                    self.global_limiter.pause(e.retry_after)
+                except Exception as e:
+                    logger.error(f"Error sending notification {notification['id']}: {e}")
+                    return False
+        return False
     
     async def send_notification(self, notification: dict):
         """Отправить уведомление пользователю"""
         user_id = notification['user_id']
-        subscription_name = notification['subscription_name']
-        price = notification['price']
-        notification_type = notification['notification_type']
-        language = notification.get('language', 'ru')
-        
-        if notification_type == 'renewal':
-            # Уведомление о продлении
-            if language == 'ru':
-                text = f"""🔔 Напоминание о продлении подписки
-
-💳 Подписка: {subscription_name}
-💰 Сумма: ${price}
-📅 Скоро спишутся средства
-
-Не забудьте проверить баланс!"""
-            else:
-                text = f"""🔔 Subscription renewal reminder
-
-💳 Subscription: {subscription_name}
-💰 Amount: ${price}
-📅 Funds will be debited soon
-
-Don't forget to check your balance!"""
-        
-        elif notification_type == 'trial_end':
-            # Уведомление об окончании пробного периода
-            if language == 'ru':
-                text = f"""⏰ Окончание пробного периода
-
-💳 Подписка: {subscription_name}
-💰 После окончания пробного периода будет списано: ${price}
-
-Если вы не хотите продолжать, отмените подписку!"""
-            else:
-                text = f"""⏰ Trial period ending
-
-💳 Subscription: {subscription_name}
-💰 After trial ends, you will be charged: ${price}
-
-If you don't want to continue, cancel the subscription!"""
-        
-        else:
-            # Общее уведомление
-            if language == 'ru':
-                text = f"""📢 Уведомление
-
-💳 Подписка: {subscription_name}"""
-            else:
-                text = f"""📢 Notification
-
-💳 Subscription: {subscription_name}"""
-        
         try:
-            await self.bot.send_message(user_id, text)
-            logger.info(f"Notification sent to user {user_id} for subscription {subscription_name}")
+            await self.bot.send_message(user_id, render_notification(notification))
+            logger.info(f"Notification sent to user {user_id} for subscription {notification['subscription_name']}")
         except Exception as e:
             logger.error(f"Failed to send notification to user {user_id}: {e}")
             raise
@@ -0,0 +1,49 @@
+"""
+Фоновые периодические задачи бота
+(закрытие дней статистики, курсы валют, календарь списаний)
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    """Вызывает func каждые interval секунд; первый вызов сразу после запуска"""
+
+    def __init__(self, name: str, func: Callable[[], Awaitable], interval: float, run_at_start: bool = True):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.run_at_start = run_at_start
+        self.is_running = False
+        self._stopped = asyncio.Event()
+
+    async def start(self):
+        """Запустить задачу"""
+        self.is_running = True
+        logger.info(f"Periodic task {self.name} started")
+
+        if not self.run_at_start:
+            await self._sleep()
+
+        while self.is_running:
+            try:
+                await self.func()
+            except Exception as e:
+                logger.error(f"Error in periodic task {self.name}: {e}")
+
+            await self._sleep()
+
+    async def _sleep(self):
+        try:
+            await asyncio.wait_for(self._stopped.wait(), timeout=self.interval)
+        except asyncio.TimeoutError:
+            pass
+
+    def stop(self):
+        """Остановить задачу"""
+        self.is_running = False
+        self._stopped.set()
+        logger.info(f"Periodic task {self.name} stopped")
@@ -0,0 +1,72 @@
+"""
+Ограничители скорости отправки сообщений
+Лимиты Telegram: около 30 сообщений в секунду на бота и 1 сообщение в секунду на чат
+"""
+import asyncio
+import time
+from typing import Dict
+
+
+class TokenBucket:
+    """Асинхронный token bucket: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Дождаться и забрать один токен (ожидающие обслуживаются по очереди)"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Остановить выдачу токенов (например, после RetryAfter от Telegram)"""
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0
+        self._updated = self._paused_until
+
+
+class PerChatLimiter:
+    """Минимальный интервал между сообщениями в один чат"""
+
+    def __init__(self, interval: float, max_tracked: int = 10000):
+        self.interval = interval
+        self.max_tracked = max_tracked
+        self._next_allowed: Dict[int, float] = {}
+
+    async def acquire(self, chat_id: int):
+        """Дождаться, когда в чат можно отправить следующее сообщение"""
+        now = time.monotonic()
+        if len(self._next_allowed) > self.max_tracked:
+            self._prune(now)
+
+        slot = max(now, self._next_allowed.get(chat_id, 0.0))
+        self._next_allowed[chat_id] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _prune(self, now: float):
+        self._next_allowed = {
+            chat_id: next_allowed
+            for chat_id, next_allowed in self._next_allowed.items()
+            if next_allowed > now
+        }
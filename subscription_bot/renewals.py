@@ -0,0 +1,103 @@
+"""
+Календарь списаний по подпискам
+Разворачивает период оплаты в конкретные даты списаний. Номер списания
+отсчитывается от опорной даты (next_payment), а число месяца для помесячных
+периодов — от billing_day, который не меняется при переносе next_payment:
+подписка на 31-е после 29 февраля списывается 31 марта, а не 29-го
+"""
+from datetime import date, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from cost_engine import CYCLE_STEPS, DEFAULT_CYCLE, add_months
+
+
+def occurrence(anchor: date, cycle: str, n: int, billing_day: Optional[int] = None) -> date:
+    """Дата n-го списания после опорной (billing_day — число месяца списания)"""
+    step_months, step_days = CYCLE_STEPS.get(cycle, CYCLE_STEPS[DEFAULT_CYCLE])
+    if step_days:
+        return anchor + timedelta(days=n * step_days)
+    return add_months(anchor, n * step_months, billing_day)
+
+
+def first_occurrence_index(anchor: date, cycle: str, day: date, billing_day: Optional[int] = None) -> int:
+    """Номер первого списания, приходящегося на day или позже"""
+    if anchor >= day:
+        return 0
+
+    step_months, step_days = CYCLE_STEPS.get(cycle, CYCLE_STEPS[DEFAULT_CYCLE])
+    if step_days:
+        return -(-(day - anchor).days // step_days)
+
+    months = (day.year - anchor.year) * 12 + day.month - anchor.month
+    n = max(0, months // step_months)
+    while occurrence(anchor, cycle, n, billing_day) < day:
+        n += 1
+    return n
+
+
+def next_occurrence(anchor: date, cycle: str, day: date, billing_day: Optional[int] = None) -> date:
+    """Ближайшая дата списания не раньше day"""
+    return occurrence(anchor, cycle, first_occurrence_index(anchor, cycle, day, billing_day), billing_day)
+
+
+def iter_occurrences(anchor: date, cycle: str, start: date, end: date,
+                     billing_day: Optional[int] = None) -> Iterator[date]:
+    """Даты списаний в полуинтервале [start, end)"""
+    n = first_occurrence_index(anchor, cycle, start, billing_day)
+    charge = occurrence(anchor, cycle, n, billing_day)
+    while charge < end:
+        yield charge
+        n += 1
+        charge = occurrence(anchor, cycle, n, billing_day)
+
+
+def expand_charges(subscriptions: Iterable[Dict], start: date, end: date) -> List[Tuple]:
+    """
+    Строки для таблицы upcoming_charges:
+    (subscription_id, user_id, charge_date, amount, currency)
+    """
+    rows = []
+    for sub in subscriptions:
+        for charge in iter_occurrences(sub['next_payment'], sub['billing_cycle'], start, end, sub.get('billing_day')):
+            rows.append((sub['id'], sub['user_id'], charge, sub['price'], sub['currency']))
+    return rows
+
+
+def next_occurrence_sql(anchor: str = 'next_payment', cycle: str = 'billing_cycle', day: str = 'CURRENT_DATE',
+                       billing_day: Optional[str] = None) -> str:
+    """
+    SQL-выражение next_occurrence(anchor, cycle, day, billing_day) для anchor < day
+    с теми же шагами CYCLE_STEPS: число шагов считается сразу, без цикла.
+    billing_day — колонка с числом месяца списания (NULL — число anchor)
+    """
+    month_start = f"date_trunc('month', {anchor}::timestamp)"
+    day_of_month = f"COALESCE({billing_day}, EXTRACT(DAY FROM {anchor})::int)" if billing_day else f"EXTRACT(DAY FROM {anchor})::int"
+
+    def add_months_sql(months: str) -> str:
+        # Как add_months: число day_of_month, но не позже последнего дня месяца
+        return (
+            f"LEAST(({month_start} + make_interval(months => {months}, days => {day_of_month} - 1))::date,"
+            f" ({month_start} + make_interval(months => {months} + 1) - interval '1 day')::date)"
+        )
+
+    months_between = (
+        f"((EXTRACT(YEAR FROM {day}) - EXTRACT(YEAR FROM {anchor})) * 12"
+        f" + EXTRACT(MONTH FROM {day}) - EXTRACT(MONTH FROM {anchor}))::int"
+    )
+
+    def step_expr(step_months: int, step_days: int) -> str:
+        if step_days:
+            return f"{anchor} + {step_days} * CEIL(({day} - {anchor}) / {step_days}.0)::int"
+        # Первый кандидат не раньше месяца day; если в этом месяце день
+        # списания уже прошел, берется следующий шаг
+        months = f"{step_months} * CEIL({months_between} / {step_months}.0)::int"
+        candidate = add_months_sql(months)
+        return (
+            f"CASE WHEN {candidate} < {day}"
+            f" THEN {add_months_sql(f'{months} + {step_months}')}"
+            f" ELSE {candidate} END"
+        )
+
+    branches = ' '.join(
+        f"WHEN {cycle} = '{name}' THEN {step_expr(*step)}" for name, step in CYCLE_STEPS.items()
+    )
+    return f"CASE {branches} ELSE {step_expr(*CYCLE_STEPS[DEFAULT_CYCLE])} END"
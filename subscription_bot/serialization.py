@@ -0,0 +1,54 @@
+"""
+JSON для API Web App, данных из Mini App и JSONB-колонок
+Строки RealDictCursor сериализуются как есть, без копирования в dict:
+Decimal становится числом, date/datetime — строкой ISO 8601.
+Если установлен orjson, используется он, иначе стандартный json.
+Модуль не зависит от конфигурации бота
+"""
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # необязательная зависимость
+    orjson = None
+
+
+def _default(value):
+    """Типы, которых нет в JSON"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+_encoder = json.JSONEncoder(default=_default, ensure_ascii=False, separators=(',', ':'))
+
+
+def dumps_stdlib(obj: Any) -> bytes:
+    return _encoder.encode(obj).encode()
+
+
+def dumps_orjson(obj: Any) -> bytes:
+    # NON_STR_KEYS: в разбивках по категориям и валютам бывает ключ None
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+dumps = dumps_orjson if orjson is not None else dumps_stdlib
+
+
+def dumps_str(obj: Any) -> str:
+    """То же, что dumps, но строкой (psycopg2.extras.Json(..., dumps=dumps_str))"""
+    return dumps(obj).decode()
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
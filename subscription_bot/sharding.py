@@ -0,0 +1,84 @@
+"""
+Консистентное хеширование для распределения пользователей по процессам.
+Каждый узел занимает vnodes точек на кольце: нагрузка распределяется
+равномерно, а при добавлении или удалении узла переезжает только
+примерно 1/N ключей. Хеш стабилен между процессами и перезапусками
+(в отличие от встроенного hash())
+"""
+import bisect
+import hashlib
+from collections import Counter
+from typing import Dict, Hashable, Iterable, List, Optional
+
+
+def stable_hash(value) -> int:
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Кольцо узлов с виртуальными точками"""
+
+    def __init__(self, nodes: Iterable[Hashable] = (), vnodes: int = 128):
+        self.vnodes = vnodes
+        self._nodes: List[Hashable] = []
+        self._points: List[int] = []
+        self._owners: List[Hashable] = []
+        for node in nodes:
+            self.add_node(node)
+
+    @property
+    def nodes(self) -> List[Hashable]:
+        return list(self._nodes)
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __contains__(self, node) -> bool:
+        return node in self._nodes
+
+    def _rebuild(self):
+        ring = sorted(
+            (stable_hash(f"{node}#{i}"), node)
+            for node in self._nodes
+            for i in range(self.vnodes)
+        )
+        self._points = [point for point, _ in ring]
+        self._owners = [node for _, node in ring]
+
+    def add_node(self, node: Hashable):
+        if node not in self._nodes:
+            self._nodes.append(node)
+            self._rebuild()
+
+    def remove_node(self, node: Hashable):
+        if node in self._nodes:
+            self._nodes.remove(node)
+            self._rebuild()
+
+    def node_for(self, key) -> Optional[Hashable]:
+        """Узел, отвечающий за key: первая точка кольца по часовой стрелке"""
+        if not self._points:
+            return None
+        index = bisect.bisect_right(self._points, stable_hash(key))
+        return self._owners[index % len(self._owners)]
+
+    def distribution(self, keys: Iterable) -> Dict[Hashable, int]:
+        """Сколько ключей приходится на каждый узел"""
+        return dict(Counter(self.node_for(key) for key in keys))
+
+
+def update_user_id(update: Dict) -> int:
+    """
+    ID пользователя из сырого апдейта Telegram (from у сообщений и callback'ов,
+    user у my_chat_member и т.п.); для апдейтов без пользователя — ID чата или 0
+    """
+    for field, event in update.items():
+        if field == 'update_id' or not isinstance(event, dict):
+            continue
+        user = event.get('from') or event.get('user')
+        if user:
+            return user['id']
+        chat = event.get('chat') or (event.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+    return 0
@@ -0,0 +1,208 @@
+"""
+Статика Mini App
+При запуске файлы из webapp/static читаются в память, получают имена
+с хешем содержимого (css/style.css -> css/style.<hash>.css) и заранее
+сжатые варианты gzip и brotli (если установлен brotli). Ссылки /static/...
+в index.html и CSS заменяются на имена с хешем: такие файлы отдаются
+с Cache-Control immutable и больше не скачиваются клиентами, а index.html
+перепроверяется по ETag при каждом открытии
+"""
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+from typing import Dict, Optional, Tuple
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:  # необязательная зависимость
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+CACHE_IMMUTABLE = 'public, max-age=31536000, immutable'
+CACHE_REVALIDATE = 'no-cache'
+
+COMPRESSIBLE_TYPES = ('application/javascript', 'application/json', 'application/manifest+json',
+                      'application/xml', 'image/svg+xml')
+
+# Ссылка на файл статики в HTML или CSS
+STATIC_REF = re.compile(r'/static/([\w./-]+)')
+
+
+def accepted_encodings(header: str) -> Dict[str, float]:
+    """Кодировки из Accept-Encoding с их q"""
+    result = {}
+    for part in (header or '').split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        result[coding] = q
+    return result
+
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=6).hexdigest()
+
+
+def hashed_name(path: str, data: bytes) -> str:
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{content_hash(data)}{ext}"
+
+
+class Asset:
+    """Файл в памяти: тип, ETag и варианты тела по Content-Encoding"""
+
+    __slots__ = ('content_type', 'charset', 'etag', 'variants')
+
+    def __init__(self, data: bytes, content_type: str, min_size: int):
+        compressible = is_compressible(content_type)
+        self.content_type = content_type
+        self.charset = 'utf-8' if compressible else None
+        # Слабый тег: у сжатых вариантов разные байты, но одно содержимое
+        self.etag = f'W/"{content_hash(data)}"'
+        self.variants = {'identity': data}
+        if compressible and len(data) >= min_size:
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) < len(data):
+                self.variants['gzip'] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data):
+                    self.variants['br'] = compressed
+
+    def select(self, accept_encoding: str) -> Tuple[str, bytes]:
+        """Самый компактный вариант, который принимает клиент"""
+        accepted = accepted_encodings(accept_encoding)
+        for coding in ('br', 'gzip'):
+            if coding in self.variants and accepted.get(coding, accepted.get('*', 0)) > 0:
+                return coding, self.variants[coding]
+        return 'identity', self.variants['identity']
+
+
+class StaticAssets:
+    """index.html и /static/ из каталога root, собранные в память"""
+
+    def __init__(self, root: str, min_size: int = 512):
+        self.root = root
+        self.min_size = min_size
+        self.assets: Dict[str, Tuple[Asset, str]] = {}
+        self.urls: Dict[str, str] = {}
+        self.index: Optional[Asset] = None
+
+    def _read_files(self) -> Dict[str, bytes]:
+        static_dir = os.path.join(self.root, 'static')
+        files = {}
+        for dirpath, _, filenames in os.walk(static_dir):
+            for filename in filenames:
+                full_path = os.path.join(dirpath, filename)
+                path = os.path.relpath(full_path, static_dir).replace(os.sep, '/')
+                with open(full_path, 'rb') as f:
+                    files[path] = f.read()
+        return files
+
+    def _rewrite(self, data: bytes) -> bytes:
+        """Заменить ссылки /static/<путь> на имена с хешем"""
+        text = data.decode('utf-8')
+        return STATIC_REF.sub(lambda m: self.url(m.group(1)) if m.group(1) in self.urls else m.group(0),
+                              text).encode('utf-8')
+
+    def _add(self, path: str, data: bytes):
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        asset = Asset(data, content_type, self.min_size)
+        self.urls[path] = hashed_name(path, data)
+        self.assets[self.urls[path]] = (asset, CACHE_IMMUTABLE)
+        # Старые клиенты и внешние ссылки без хеша получают тот же файл, но с перепроверкой
+        self.assets[path] = (asset, CACHE_REVALIDATE)
+
+    def build(self):
+        """
+        Прочитать и сжать файлы. CSS обрабатывается после остальных файлов:
+        ссылки на картинки и шрифты внутри него тоже получают хеш
+        """
+        self.assets.clear()
+        self.urls.clear()
+        files = self._read_files()
+        for path in sorted(files, key=lambda p: (p.endswith('.css'), p)):
+            data = files[path]
+            if path.endswith('.css'):
+                data = self._rewrite(data)
+            self._add(path, data)
+
+        index_path = os.path.join(self.root, 'index.html')
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                self.index = Asset(self._rewrite(f.read()), 'text/html', self.min_size)
+        logger.info(f"Static assets built: {self.stats()}")
+
+    def url(self, path: str) -> str:
+        """URL файла статики с хешем (или без него, если файл не найден)"""
+        return '/static/' + self.urls.get(path, path)
+
+    def _respond(self, request: web.Request, asset: Asset, cache_control: str) -> web.Response:
+        headers = {'Cache-Control': cache_control, 'ETag': asset.etag, 'Vary': 'Accept-Encoding'}
+        if asset.etag in (tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')):
+            return web.Response(status=304, headers=headers)
+
+        coding, body = asset.select(request.headers.get('Accept-Encoding', ''))
+        if coding != 'identity':
+            headers['Content-Encoding'] = coding
+        return web.Response(body=body, headers=headers, content_type=asset.content_type, charset=asset.charset)
+
+    async def handle_index(self, request: web.Request) -> web.Response:
+        if self.index is None:
+            raise web.HTTPNotFound()
+        return self._respond(request, self.index, CACHE_REVALIDATE)
+
+    async def handle_static(self, request: web.Request) -> web.Response:
+        found = self.assets.get(request.match_info['path'])
+        if found is None:
+            raise web.HTTPNotFound()
+        return self._respond(request, *found)
+
+    def register(self, app: web.Application):
+        app.router.add_get('/static/{path:.+}', self.handle_static, name='static')
+        app.router.add_get('/', self.handle_index)
+
+    def stats(self) -> Dict:
+        unique = {id(asset): asset for asset, _ in self.assets.values()}.values()
+        return {
+            'files': len(self.urls),
+            'bytes': sum(len(asset.variants['identity']) for asset in unique),
+            'gzip': sum(len(asset.variants.get('gzip', asset.variants['identity'])) for asset in unique),
+            'br': sum(len(asset.variants['br']) for asset in unique if 'br' in asset.variants),
+        }
+
+
+def compression_middleware(min_size: int):
+    """
+    Сжатие JSON-ответов API от min_size байт (gzip/deflate по Accept-Encoding,
+    средствами aiohttp). Мелкие ответы не сжимаются: выигрыш меньше затрат
+    """
+    @web.middleware
+    async def middleware(request, handler):
+        response = await handler(request)
+        if (isinstance(response, web.Response)
+                and response.content_type == 'application/json'
+                and 'Content-Encoding' not in response.headers
+                and isinstance(response.body, (bytes, bytearray))
+                and len(response.body) >= min_size):
+            response.enable_compression()
+            response.headers['Vary'] = 'Accept-Encoding'
+        return response
+    return middleware
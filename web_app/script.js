@@ -384,6 +384,113 @@ document.addEventListener('DOMContentLoaded', function() {
         document.getElementById('total-expenses').textContent = `${totalExpenses.toFixed(2)} RUB/мес`;
         document.getElementById('upcoming-renewals').textContent = `${upcomingRenewals} подписок`;
         document.getElementById('free-trials').textContent = `${freeTrials} активных`;
+
+        renderServerExpenses();
+    }
+
+    // Итог расходов считает сервер (/api/stats, cost_engine) с учетом периода оплаты
+    // и в валюте отображения; без пользователя Telegram или при ошибке остается
+    // локальная сумма. Ответ запрашивается после изменения данных, а перерисовка
+    // статистики берет последний полученный
+    let serverStats = null;
+
+    function renderServerExpenses() {
+        if (!serverStats) {
+            return;
+        }
+
+        let text = `${serverStats.monthly_cost.toFixed(2)} ${serverStats.currency}/мес`;
+        // Суммы в валютах без курса в итог не входят и показываются отдельно
+        const unconverted = Object.entries(serverStats.unconverted)
+            .map(([currency, amount]) => `${amount.toFixed(2)} ${currency === 'null' ? 'RUB' : currency}`);
+        if (unconverted.length) {
+            text += ` + ${unconverted.join(' + ')} без курса`;
+        }
+        document.getElementById('total-expenses').textContent = text;
+    }
+
+    function loadServerExpenses(userId) {
+        fetch(`/api/stats?user_id=${userId}`)
+            .then(response => response.ok ? response.json() : Promise.reject(response.status))
+            .then(data => {
+                serverStats = data.stats;
+                renderServerExpenses();
+            })
+            .catch(() => {});
+    }
+
+    // Подписки с сервера хранятся в localStorage вместе с курсором синхронизации:
+    // при открытии список сразу рисуется из кэша, а с сервера запрашиваются
+    // только изменения после курсора (/api/subscriptions/changes)
+    const SYNC_STORAGE_KEY = 'subscriptions-sync';
+
+    function loadSyncState(userId) {
+        try {
+            const state = JSON.parse(localStorage.getItem(SYNC_STORAGE_KEY));
+            if (state && state.userId === userId) {
+                return state;
+            }
+        } catch (e) {}
+        return { userId: userId, cursor: 0, subscriptions: {} };
+    }
+
+    function renderServerSubscriptions(subscriptions) {
+        const subscriptionsList = document.getElementById('subscriptions-list');
+        subscriptionsList.innerHTML = '';
+
+        if (subscriptions.length === 0) {
+            const emptyState = document.createElement('div');
+            emptyState.className = 'empty-state';
+            emptyState.innerHTML = '<p>У вас пока нет подписок. Нажмите "Добавить подписку", чтобы начать.</p>';
+            subscriptionsList.appendChild(emptyState);
+        }
+
+        subscriptions
+            .sort((a, b) => (a.next_payment || '').localeCompare(b.next_payment || ''))
+            .forEach(sub => addSubscriptionToUI({
+                name: sub.name,
+                amount: sub.price,
+                start_date: sub.start_date,
+                end_date: sub.next_payment,
+                free_trial_end_date: sub.trial_end_date,
+                notes: sub.notes,
+                is_active: sub.is_active
+            }));
+        updateStatistics();
+    }
+
+    function syncSubscriptions() {
+        const user = tg && tg.initDataUnsafe && tg.initDataUnsafe.user;
+        if (!user || !user.id) {
+            return;
+        }
+
+        const state = loadSyncState(user.id);
+        if (state.cursor) {
+            renderServerSubscriptions(Object.values(state.subscriptions));
+        }
+
+        fetch(`/api/subscriptions/changes?user_id=${user.id}&since=${state.cursor}`)
+            .then(response => response.ok ? response.json() : Promise.reject(response.status))
+            .then(changes => {
+                if (changes.full) {
+                    state.subscriptions = {};
+                }
+                // Сначала строки, затем удаления: так повторно пришедшие изменения безопасны
+                changes.subscriptions.forEach(sub => { state.subscriptions[sub.id] = sub; });
+                changes.deleted.forEach(id => { delete state.subscriptions[id]; });
+
+                const changed = changes.full || changes.subscriptions.length || changes.deleted.length;
+                state.cursor = changes.cursor;
+                localStorage.setItem(SYNC_STORAGE_KEY, JSON.stringify(state));
+                if (changed) {
+                    renderServerSubscriptions(Object.values(state.subscriptions));
+                }
+                if (changed || !serverStats) {
+                    loadServerExpenses(user.id);
+                }
+            })
+            .catch(() => {});
     }
 
     // Функция для показа уведомлений
@@ -462,8 +569,11 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
-    // Инициализация с тестовыми данными (для демонстрации)
-    if (document.getElementById('subscriptions-list').querySelector('.empty-state')) {
+    // Инициализация с тестовыми данными (для демонстрации вне Telegram)
+    const telegramUser = tg && tg.initDataUnsafe && tg.initDataUnsafe.user;
+    if (telegramUser && telegramUser.id) {
+        syncSubscriptions();
+    } else if (document.getElementById('subscriptions-list').querySelector('.empty-state')) {
         // Добавим несколько тестовых подписок для демонстрации
         const testSubscriptions = [
             {